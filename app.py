@@ -1,335 +1,3923 @@
-from flask import Flask, request, jsonify ,Response
+from flask import Flask, request, jsonify ,Response, g, send_file
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:  # 异步模式为可选依赖：pip install aiohttp
+    aiohttp = None
+    web = None
+try:
+    import orjson
+except ImportError:  # 可选依赖：pip install orjson，未安装时使用标准库 json 序列化
+    orjson = None
 import time
+import bisect
+import logging
 import random
+import re
+import atexit
 import json
 import os
+import sys
+import asyncio
 import base64
+import hashlib
+import hmac
+import itertools
+import threading
+import weakref
+import contextvars
+import sqlite3
+import zlib
+import socket
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from contextlib import contextmanager
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse, unquote
+from werkzeug.http import parse_etags, quote_etag
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
+# 慢请求日志单独使用一个 logger，便于输出到独立文件
+slow_logger = logging.getLogger(__name__ + '.slow')
 
-cookie_str = ''
+# 未配置账号池时使用的 Cookie
+cookie_str = os.environ.get('QQMUSIC_COOKIE', '')
+
+# 上游连接池与超时配置，进程内所有 QQMusic 实例共享
+POOL_CONNECTIONS = 4  # 按上游主机划分的连接池数量（u.y.qq.com、c.y.qq.com 等）
+POOL_MAXSIZE = 32  # 每个上游主机保持的 keep-alive 连接数
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+}
+LYRIC_HEADERS = {
+    'Accept': '*/*',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Referer': 'https://y.qq.com/',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36'
+}
+MAC_HEADERS = {
+    "accept-language": "zh-CN,zh;q=0.9,en;q=0.8",
+    "referer": "https://i.y.qq.com",
+    "user-agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 13_2_3 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.0.3 Mobile/15E148 Safari/604.1",
+    "content-type": "application/json",
+    "accept": "application/json",
+    "Host": "u.y.qq.com",
+    "Connection": "Keep-Alive"
+}
+FILE_CONFIG = {
+    '128': {'s': 'M500', 'e': '.mp3', 'bitrate': '128kbps'},
+    '320': {'s': 'M800', 'e': '.mp3', 'bitrate': '320kbps'},
+    'flac': {'s': 'F000', 'e': '.flac', 'bitrate': 'FLAC'},
+    'master': {'s': 'AI00', 'e': '.flac', 'bitrate': 'Master'},
+    'atmos_2': {'s': 'Q000', 'e': '.flac', 'bitrate': 'Atmos 2'},
+    'atmos_51': {'s': 'Q001', 'e': '.flac', 'bitrate': 'Atmos 5.1'},
+    'ogg_640': {'s': 'O801', 'e': '.ogg', 'bitrate': '640kbps'},
+    'ogg_320': {'s': 'O800', 'e': '.ogg', 'bitrate': '320kbps'},
+    'ogg_192': {'s': 'O600', 'e': '.ogg', 'bitrate': '192kbps'},
+    'ogg_96': {'s': 'O400', 'e': '.ogg', 'bitrate': '96kbps'},
+    'aac_192': {'s': 'C600', 'e': '.m4a', 'bitrate': '192kbps'},
+    'aac_96': {'s': 'C400', 'e': '.m4a', 'bitrate': '96kbps'},
+    'aac_48': {'s': 'C200', 'e': '.m4a', 'bitrate': '48kbps'}
+}
+
+# 歌曲详情 file 字段中各音质对应的大小字段，(字段, 下标) 表示取数组中的一项
+# 未列出或详情中缺少对应字段的音质视为未知，仍会请求 vkey
+FILE_SIZE_KEYS = {
+    '128': 'size_128mp3',
+    '320': 'size_320mp3',
+    'flac': 'size_flac',
+    'master': ('size_new', 0),
+    'atmos_2': ('size_new', 1),
+    'atmos_51': ('size_new', 2),
+    'ogg_192': 'size_192ogg',
+    'ogg_96': 'size_96ogg',
+    'aac_192': 'size_192aac',
+    'aac_96': 'size_96aac',
+    'aac_48': 'size_48aac',
+}
+
+# /songs 批量解析：单次请求的条目上限，以及每次上游请求合并的歌曲数 / filename 数
+BULK_MAX_ITEMS = 1000
+BULK_DETAIL_CHUNK_SIZE = 20
+BULK_VKEY_CHUNK_SIZE = 100
+
+# /song 默认解析的音质
+SONG_FILE_TYPES = ['aac_48','aac_96','aac_192','ogg_96','ogg_192','ogg_320','ogg_640','atmos_51','atmos_2','master','flac','320','128']
+
+# 上游限速：每个主机的令牌桶 (速率 次/秒, 突发容量)，所有线程共享
+UPSTREAM_RATE_LIMITS = {
+    'u.y.qq.com': (20, 40),
+    'c.y.qq.com': (10, 20),
+    'c6.y.qq.com': (10, 20),
+}
+UPSTREAM_DEFAULT_RATE = (10, 20)
+# 多进程部署时（serve.py 设置 QQMUSIC_WORKERS）各进程只使用上述速率的 1/N，合计不超过配置
+WORKER_COUNT = max(1, int(os.environ.get('QQMUSIC_WORKERS', 1)))
+# 上游返回这些状态码或请求失败时速率减半，之后每次成功恢复配置速率的 5%
+THROTTLE_STATUS = {429, 500, 502, 503, 504}
+RATE_BACKOFF_FACTOR = 0.5
+RATE_RECOVERY_STEP = 0.05
+RATE_MIN_FRACTION = 0.05
+
+# 账号池：JSON 文件 [{"cookie": "...", "vip": true, "weight": 1}, ...]，文件不存在时只使用 cookie_str
+COOKIE_POOL_FILE = os.environ.get('QQMUSIC_COOKIE_POOL', 'cookies.json')
+# 需要会员账号才能获取的音质，其余音质优先使用非会员账号
+VIP_FILE_TYPES = {'320', 'flac', 'master', 'atmos_2', 'atmos_51', 'ogg_640', 'ogg_320'}
+# 账号健康度：错误率或会员音质空 purl 率（滑动平均）超过阈值时暂时剔除
+ACCOUNT_EWMA_ALPHA = 0.2
+ACCOUNT_MIN_SAMPLES = 10
+ACCOUNT_ERROR_RATE = 0.5
+ACCOUNT_EMPTY_RATE = 0.9
+ACCOUNT_EJECT_SECONDS = 300
+
+# 播放 URL 缓存：vkey 在上游有效期内可复用，TTL 取 min(URL_CACHE_TTL, 上游 expiration * URL_CACHE_TTL_RATIO)
+URL_CACHE_SIZE = 10000
+URL_CACHE_TTL = 1800
+URL_CACHE_TTL_RATIO = 0.5
+
+# /song 响应缓存：序列化后的响应体按 (url, 参数, cookie 标识) 缓存，有效期与 Cache-Control 的 max-age
+# 取 music_urls 中最早过期的播放链接的剩余时间，不含播放链接时为 SONG_RESPONSE_TTL
+SONG_RESPONSE_CACHE_SIZE = 10000
+SONG_RESPONSE_TTL = 300
+
+# 查询缓存后端：memory（进程内，默认）、sqlite:///path/to/cache.db（同一主机的多个进程共享）、
+# redis://[:password@]host:port/db（多节点共享），保存 vkey 播放链接，共享后端还保存歌曲信息与歌词
+CACHE_URL = os.environ.get('QQMUSIC_CACHE', 'memory')
+CACHE_PREFIX = 'qqmusic:'
+CACHE_TIMEOUT = 1
+# 防击穿：共享后端下同一 key 只由一个节点请求上游，其他节点最多等待 CACHE_LOCK_WAIT 秒
+CACHE_LOCK_TTL = 10
+CACHE_LOCK_WAIT = 2
+CACHE_LOCK_POLL = 0.05
+
+# 预热：按请求频率（每轮衰减一半）选出最热的 WARMER_TOP_N 首歌曲，播放链接在过期前 WARMER_AHEAD 秒、
+# 歌曲信息在存储过期前重新解析；QQMUSIC_WARMER=0 时不启动后台线程
+WARMER_ENABLED = os.environ.get('QQMUSIC_WARMER', '1') != '0'
+WARMER_TOP_N = 200
+WARMER_INTERVAL = 60
+WARMER_AHEAD = 120
+WARMER_WORKERS = 4
+WARMER_MAX_TRACKED = 100000
+# 管理接口预加载的歌曲按该次数计入热度，之后随衰减回落
+WARMER_PRELOAD_WEIGHT = 100
+# 管理接口令牌（请求头 X-Admin-Token），未设置时管理接口关闭，所有请求返回 403
+ADMIN_TOKEN = os.environ.get('QQMUSIC_ADMIN_TOKEN', '')
+
+# /metrics 延迟直方图的桶上限（秒）
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# 耗时超过该秒数的请求把完整的 span 树写入慢请求日志，0 表示关闭
+SLOW_REQUEST_SECONDS = float(os.environ.get('QQMUSIC_SLOW_REQUEST', 0))
+
+# /stream 音频代理：每次转发的块大小、到音频 CDN 的 keep-alive 连接数，以及转发给客户端的响应头
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_POOL_MAXSIZE = 64
+STREAM_FORWARD_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'Last-Modified', 'ETag')
+# CDN 拒绝缓存中的链接时（vkey 已失效）丢弃缓存并重新解析
+STREAM_EXPIRED_STATUS = {403, 404}
+
+# 本地音频缓存：QQMUSIC_AUDIO_CACHE 为缓存目录（为空时关闭），总大小超过 QQMUSIC_AUDIO_CACHE_SIZE 字节时按 LRU 淘汰
+AUDIO_CACHE_DIR = os.environ.get('QQMUSIC_AUDIO_CACHE', '')
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get('QQMUSIC_AUDIO_CACHE_SIZE', 10 * 1024 ** 3))
+AUDIO_CACHE_WORKERS = 2
+AUDIO_MIME_TYPES = {'.mp3': 'audio/mpeg', '.flac': 'audio/flac', '.ogg': 'audio/ogg', '.m4a': 'audio/mp4'}
+# 前置 nginx 时设为映射到缓存目录的 internal location（如 /_audio/），命中缓存时只返回 X-Accel-Redirect 头，
+# 由 nginx 以 sendfile 发送文件并处理 Range；为空时由本进程读取文件发送
+AUDIO_ACCEL_REDIRECT = os.environ.get('QQMUSIC_AUDIO_ACCEL_REDIRECT', '')
+
+# 负缓存：VIP 限制/不存在的音质以及不存在的歌曲，TTL 比正常结果短，切换 Cookie 时清空
+NEGATIVE_CACHE_SIZE = 50000
+NEGATIVE_CACHE_TTL = 300
+
+# 短链接缓存：c6.y.qq.com 分享短链 -> 重定向后的 URL，短链不会变化，只按 LRU 淘汰并持久化到 JSON 文件
+SHORT_LINK_HOSTS = ('c6.y.qq.com',)
+SHORT_LINK_CACHE_FILE = os.environ.get('QQMUSIC_SHORT_LINK_CACHE', 'short_links.json')
+SHORT_LINK_CACHE_SIZE = 50000
+SHORT_LINK_SAVE_EVERY = 100
+
+# 歌曲链接解析：/n/ryqq/songDetail/<mid>、/songDetail/<mid>、/n/yqq/song/<mid>.html，
+# 以及查询参数或 # 片段中的 songmid=、mid=、songid=、id=
+SONG_PATH_RE = re.compile(r'/(?:songDetail|song)/([0-9A-Za-z]+)')
+SONG_PARAM_RE = re.compile(r'[?&#/](songmid|mid|songid|id)=([0-9A-Za-z]+)')
+# 合法的 songmid，同时用作本地音频缓存的文件名
+SONGMID_RE = re.compile(r'[0-9A-Za-z]+')
+
+# 专辑与歌单链接：/n/ryqq/albumDetail/<mid>、/n/yqq/album/<mid>.html、/n/ryqq/playlist/<id>，
+# 以及分享页 album.html?albummid= / albumId=、taoge.html?id=
+COLLECTION_PATH_RE = re.compile(r'/(albumDetail|album|playlist)/([0-9A-Za-z]+)')
+COLLECTION_PARAM_RE = re.compile(r'[?&#](albummid|albumMid|albumId|albumid|id|disstid)=([0-9A-Za-z]+)')
+# 曲目列表每页的曲目数：第一页得到总数后，其余各页合并为一次 musicu.fcg 请求
+COLLECTION_PAGE_SIZE = 100
+COLLECTION_MAX_TRACKS = 5000
+# 曲目逐组解析 vkey 并输出，每组的歌曲数
+COLLECTION_CHUNK_SIZE = 100
+
+# 歌曲信息与歌词的本地持久化存储（SQLite），QQMUSIC_METADATA_DB 设为空字符串时禁用
+METADATA_DB = os.environ.get('QQMUSIC_METADATA_DB', 'metadata.db')
+# 记录超过该时间（秒）后视为过期，重新请求上游
+METADATA_MAX_AGE = int(os.environ.get('QQMUSIC_METADATA_MAX_AGE', 7 * 24 * 3600))
+
+_session = None
+_stream_session = None
+_session_lock = threading.Lock()
+_async_sessions = weakref.WeakKeyDictionary()
+
+
+def get_session():
+    """
+    获取进程共享的 requests.Session，复用到各上游主机的 TCP+TLS 连接
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                # 不保存上游下发的 Cookie，避免不同请求之间串号
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                _session = session
+    return _session
+
+
+def get_stream_session():
+    """
+    获取音频代理使用的 requests.Session，与接口请求的连接池分开，长时间的音频传输不占用接口连接
+    """
+    global _stream_session
+    if _stream_session is None:
+        with _session_lock:
+            if _stream_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=STREAM_POOL_MAXSIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                _stream_session = session
+    return _stream_session
+
+
+def get_async_session():
+    """
+    获取当前事件循环共享的 aiohttp.ClientSession，需在协程中调用
+    """
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_CONNECTIONS * POOL_MAXSIZE, limit_per_host=POOL_MAXSIZE)
+        timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        # DummyCookieJar 不保存上游下发的 Cookie
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout, cookie_jar=aiohttp.DummyCookieJar())
+        _async_sessions[loop] = session
+    return session
+
+
+def split_song_id(song_id):
+    """
+    ids() 返回纯数字时视为 songid，否则视为 songmid，返回 (mid, sid)
+    """
+    try:
+        # 如果 songmid 是数字，视为 songid (sid)
+        return 0, int(song_id)
+    except ValueError:
+        # 否则视为 songmid (mid)
+        return song_id, 0
+
+
+@lru_cache(maxsize=4096)
+def parse_collection_url(url):
+    """
+    从 y.qq.com 专辑或歌单链接中解析 (类型, ID)，类型为 'album' 或 'playlist'；不是专辑或歌单链接时返回 None
+
+    专辑 ID 为 albummid 或数字 albumId，歌单 ID 为数字 disstid
+    """
+    if not url:
+        return None
+    parsed = urlparse(url)
+    host = parsed.hostname or ''
+    if host != 'y.qq.com' and not host.endswith('.y.qq.com'):
+        return None
+
+    path = COLLECTION_PATH_RE.search(parsed.path)
+    if path:
+        kind = 'playlist' if path.group(1) == 'playlist' else 'album'
+        cid = path.group(2)
+    else:
+        page = parsed.path.rsplit('/', 1)[-1]
+        params = dict(COLLECTION_PARAM_RE.findall(url))
+        if page == 'album.html':
+            kind = 'album'
+            cid = params.get('albummid') or params.get('albumMid') or params.get('albumId') or params.get('albumid')
+        elif page == 'taoge.html':
+            kind = 'playlist'
+            cid = params.get('id') or params.get('disstid')
+        else:
+            return None
+    if not cid or (kind == 'playlist' and not cid.isdigit()):
+        return None
+    return kind, cid
+
+
+@lru_cache(maxsize=4096)
+def parse_song_url(url):
+    """
+    不发起网络请求，从 y.qq.com / i.y.qq.com 链接中解析 (mid, sid)，缺少的一项为 '' / 0
+
+    不是 QQ 音乐链接或解析不到任何 ID 时返回 None
+    """
+    if not url:
+        return None
+    host = urlparse(url).hostname or ''
+    if host != 'y.qq.com' and not host.endswith('.y.qq.com'):
+        return None
+    # 歌单分享页的 id= 是歌单 ID，不能当作 songid
+    if parse_collection_url(url):
+        return None
+
+    params = {}
+    for name, value in SONG_PARAM_RE.findall(url):
+        params.setdefault(name, value)
+    path = SONG_PATH_RE.search(url)
+    mid = params.get('songmid') or params.get('mid') or (path.group(1) if path else '')
+    sid = params.get('songid') or params.get('id') or ''
+    if not sid.isdigit():
+        # id= 参数的值不是数字时按 songmid 处理
+        mid, sid = mid or sid, ''
+    if not mid and not sid:
+        return None
+    return mid, int(sid or 0)
+
+
+def is_short_link(url):
+    return bool(url) and urlparse(url).hostname in SHORT_LINK_HOSTS
+
+
+def chunked(items, size):
+    """
+    将列表按 size 切分
+    """
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+def first_available(urls, file_types):
+    """
+    按 file_types 顺序取第一个已解析的音质
+    """
+    for file_type in file_types:
+        if file_type in urls:
+            return {file_type: urls[file_type]}
+    return {}
+
+
+class UpstreamError(requests.RequestException):
+    """
+    上游返回了非 0 的 code 或缺少所需的模块，与网络错误、HTTP 错误一样按 502 处理
+    """
+
+
+def upstream_json(data, op):
+    """
+    检查上游返回的 JSON：不是对象或顶层 code 非 0 时抛出 UpstreamError
+    """
+    if not isinstance(data, dict):
+        raise UpstreamError(f'upstream {op} returned an unexpected response')
+    if data.get('code'):
+        raise UpstreamError(f"upstream {op} returned code {data['code']}")
+    return data
+
+
+def upstream_code(data):
+    """
+    返回上游 JSON 中第一个非 0 的 code（先顶层，再各模块），都为 0 时返回 0；
+    musicu.fcg 被限流或出错时仍返回 HTTP 200，只能从 code 判断
+    """
+    if not isinstance(data, dict):
+        return 0
+    for value in itertools.chain([data], data.values()):
+        if isinstance(value, dict) and value.get('code'):
+            return value['code']
+    return 0
+
+
+def module_data(data, key):
+    """
+    取出 musicu.fcg 返回中 key 模块的 data，缺少该模块或模块的 code 非 0 时抛出 UpstreamError
+    """
+    module = data.get(key)
+    if not isinstance(module, dict):
+        raise UpstreamError(f'upstream response is missing {key}')
+    if module.get('code'):
+        raise UpstreamError(f"upstream {key} returned code {module['code']}")
+    return module.get('data') or {}
+
+
+def _flag(value, default=True):
+    if value is None:
+        return default
+    return value.strip().lower() not in ('0', 'false', 'no', 'off')
+
+
+def parse_song_options(args):
+    """
+    解析 /song 的可选参数
+
+    types=flac,320   只解析指定音质
+    prefer=flac,320  按顺序只返回第一个可用音质
+    lyric=0          不获取歌词
+    detail=0         不返回歌曲详情（仍会在缺少 mid/id 时请求详情）
+    """
+    raw = args.get('prefer', args.get('types'))
+    if raw is None:
+        file_types = list(SONG_FILE_TYPES)
+    else:
+        file_types = [file_type.strip() for file_type in raw.split(',') if file_type.strip()]
+        invalid = [file_type for file_type in file_types if file_type not in FILE_CONFIG]
+        if invalid:
+            raise ValueError(f"Invalid file_type: {', '.join(invalid)}")
+    return {
+        'file_types': file_types,
+        'prefer': args.get('prefer') is not None,
+        'lyric': _flag(args.get('lyric')),
+        'detail': _flag(args.get('detail')),
+    }
+
+
+@lru_cache(maxsize=32)
+def cookie_identity(cookie_str):
+    """
+    Cookie 的短标识，用于区分不同账号下的缓存条目
+    """
+    return hashlib.sha1(cookie_str.encode('utf-8')).hexdigest()[:16]
+
+
+@lru_cache(maxsize=32)
+def parse_cookies(cookie_str):
+    """
+    解析 Cookie 字符串，结果按字符串缓存，调用方不要修改返回的字典
+    """
+    cookies = {}
+    for cookie in cookie_str.split(';'):
+        cookie = cookie.strip()
+        if '=' not in cookie:
+            continue
+        key, value = cookie.split('=', 1)
+        cookies[key] = value
+    return cookies
+
+
+class TTLCache:
+    """
+    线程安全的 LRU 缓存，每个条目带过期时间，并记录命中/未命中次数
+
+    也是查询缓存的进程内后端，get_many/set_many/add/delete 与 SQLiteCache、RedisCache 接口一致
+    """
+
+    shared = False
+
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (过期时间, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def get_many(self, keys):
+        """
+        批量查询，返回 {key: value}，不包含未命中的 key
+        """
+        results = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                results[key] = value
+        return results
+
+    def set_many(self, mapping, ttl=None):
+        for key, value in mapping.items():
+            self.set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """
+        key 不存在（或已过期）时写入并返回 True，否则返回 False
+        """
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > time.monotonic():
+                return False
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def remaining_many(self, keys):
+        """
+        返回 {key: 剩余有效秒数}，不包含不存在或已过期的 key
+        """
+        now = time.monotonic()
+        with self._lock:
+            items = {key: self._data.get(key) for key in keys}
+        return {key: item[0] - now for key, item in items.items() if item is not None and item[0] > now}
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+    def __contains__(self, key):
+        # 只判断是否存在且未过期，不计入命中统计
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[0] > time.monotonic()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def cache_key(key):
+    """
+    将元组形式的缓存 key 转换为共享后端使用的字符串
+    """
+    if isinstance(key, tuple):
+        key = ':'.join(str(part) for part in key)
+    return CACHE_PREFIX + str(key)
+
+
+class SQLiteCache:
+    """
+    基于 SQLite 的查询缓存后端，同一主机上的多个进程可共享同一个文件
+
+    值以 JSON 保存，过期时间使用墙上时间，过期条目在写入时定期清理
+    """
+
+    shared = True
+
+    def __init__(self, path, ttl=600, purge_every=1000):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+        db = self._connect()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)')
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            self._local.db = db
+        return db
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        names = {cache_key(key): key for key in keys}
+        results = {}
+        # SQLite 单条语句的参数数量有限，分批查询
+        for chunk in chunked(list(names), 500):
+            rows = self._connect().execute(
+                f'SELECT key, value FROM cache WHERE key IN ({",".join("?" * len(chunk))}) AND expires > ?',
+                (*chunk, time.time()),
+            )
+            for name, value in rows:
+                results[names[name]] = json.loads(value)
+        self.hits += len(results)
+        self.misses += len(keys) - len(results)
+        return results
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, mapping, ttl=None):
+        if not mapping:
+            return
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        db = self._connect()
+        db.executemany(
+            'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+            [(cache_key(key), json.dumps(value, ensure_ascii=False), expires) for key, value in mapping.items()],
+        )
+        self._writes += len(mapping)
+        if self._writes >= self.purge_every:
+            self._writes = 0
+            db.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+
+    def add(self, key, value, ttl=None):
+        now = time.time()
+        db = self._connect()
+        db.execute('DELETE FROM cache WHERE key = ? AND expires <= ?', (cache_key(key), now))
+        cursor = db.execute(
+            'INSERT OR IGNORE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+            (cache_key(key), json.dumps(value), now + (self.ttl if ttl is None else ttl)),
+        )
+        return cursor.rowcount == 1
+
+    def delete(self, *keys):
+        self._connect().executemany('DELETE FROM cache WHERE key = ?', [(cache_key(key),) for key in keys])
+
+    def remaining_many(self, keys):
+        names = {cache_key(key): key for key in keys}
+        now = time.time()
+        results = {}
+        for chunk in chunked(list(names), 500):
+            rows = self._connect().execute(
+                f'SELECT key, expires FROM cache WHERE key IN ({",".join("?" * len(chunk))}) AND expires > ?',
+                (*chunk, now),
+            )
+            for name, expires in rows:
+                results[names[name]] = expires - now
+        return results
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self.delete(key)
+        return value
+
+    def clear(self):
+        self._connect().execute('DELETE FROM cache')
+
+    def stats(self):
+        size = self._connect().execute('SELECT COUNT(*) FROM cache WHERE expires > ?', (time.time(),)).fetchone()[0]
+        return {'size': size, 'hits': self.hits, 'misses': self.misses}
+
+    def __contains__(self, key):
+        row = self._connect().execute(
+            'SELECT 1 FROM cache WHERE key = ? AND expires > ?', (cache_key(key), time.time())
+        ).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self.stats()['size']
+
+
+class RedisError(Exception):
+    """
+    Redis 服务器返回的错误回复
+    """
+
+
+class RedisCache:
+    """
+    使用 RESP 协议的网络查询缓存后端，多个节点共享 vkey、歌曲信息与歌词
+
+    每个线程一条连接；连接或服务器出错时按未命中处理并断开重连，不影响正常解析
+    """
+
+    shared = True
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None, ttl=600, timeout=CACHE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.ttl = ttl
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._local = threading.local()
+
+    @classmethod
+    def from_url(cls, url, ttl=600):
+        parsed = urlparse(url)
+        db = int(parsed.path.strip('/') or 0)
+        password = unquote(parsed.password) if parsed.password else None
+        return cls(parsed.hostname or '127.0.0.1', parsed.port or 6379, db, password, ttl)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = (sock, sock.makefile('rb'))
+            self._local.conn = conn
+            if self.password:
+                self._execute([('AUTH', self.password)])
+            if self.db:
+                self._execute([('SELECT', self.db)])
+        return conn
+
+    def _disconnect(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    @staticmethod
+    def _encode(command):
+        parts = [str(arg).encode('utf-8') if not isinstance(arg, bytes) else arg for arg in command]
+        out = [b'*%d\r\n' % len(parts)]
+        for part in parts:
+            out.append(b'$%d\r\n%s\r\n' % (len(part), part))
+        return b''.join(out)
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('connection closed')
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            return body.decode('utf-8')
+        if kind == b'-':
+            return RedisError(body.decode('utf-8'))
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            length = int(body)
+            if length < 0:
+                return None
+            return reader.read(length + 2)[:-2]
+        if kind == b'*':
+            length = int(body)
+            return None if length < 0 else [self._read(reader) for _ in range(length)]
+        raise ConnectionError(f'unexpected reply {line!r}')
+
+    def _execute(self, commands):
+        """
+        以流水线方式发送多条命令，按顺序返回回复
+        """
+        sock, reader = self._connect()
+        sock.sendall(b''.join(self._encode(command) for command in commands))
+        replies = [self._read(reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def _call(self, commands, fallback):
+        try:
+            return self._execute(commands)
+        except (OSError, RedisError) as e:
+            self.errors += 1
+            self._disconnect()
+            logger.warning("缓存服务器请求失败: %s", e)
+            return fallback
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        replies = self._call([('MGET', *[cache_key(key) for key in keys])], None)
+        values = replies[0] if replies else [None] * len(keys)
+        results = {key: json.loads(value) for key, value in zip(keys, values) if value is not None}
+        self.hits += len(results)
+        self.misses += len(keys) - len(results)
+        return results
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, mapping, ttl=None):
+        if not mapping:
+            return
+        ms = max(1, int((self.ttl if ttl is None else ttl) * 1000))
+        self._call([
+            ('SET', cache_key(key), json.dumps(value, ensure_ascii=False), 'PX', ms) for key, value in mapping.items()
+        ], None)
+
+    def add(self, key, value, ttl=None):
+        ms = max(1, int((self.ttl if ttl is None else ttl) * 1000))
+        # 服务器不可用时视为获得锁，由本节点自行请求上游
+        replies = self._call([('SET', cache_key(key), json.dumps(value), 'PX', ms, 'NX')], ['OK'])
+        return replies[0] == 'OK'
+
+    def delete(self, *keys):
+        if keys:
+            self._call([('DEL', *[cache_key(key) for key in keys])], None)
+
+    def remaining_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        replies = self._call([('PTTL', cache_key(key)) for key in keys], None) or []
+        return {key: ms / 1000 for key, ms in zip(keys, replies) if ms > 0}
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self.delete(key)
+        return value
+
+    def clear(self):
+        """
+        删除所有带 CACHE_PREFIX 前缀的 key
+        """
+        cursor = '0'
+        while True:
+            replies = self._call([('SCAN', cursor, 'MATCH', CACHE_PREFIX + '*', 'COUNT', 1000)], None)
+            if not replies:
+                return
+            cursor, names = replies[0]
+            if names:
+                self._call([('DEL', *names)], None)
+            if cursor in (b'0', '0'):
+                return
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'errors': self.errors}
+
+    def __contains__(self, key):
+        replies = self._call([('EXISTS', cache_key(key))], [0])
+        return replies[0] == 1
+
+
+def create_cache(url, maxsize=1024, ttl=600):
+    """
+    按 CACHE_URL 的格式创建查询缓存后端
+    """
+    if not url or url == 'memory':
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+    if url.startswith('sqlite:'):
+        path = url[len('sqlite:'):]
+        return SQLiteCache(path[2:] if path.startswith('//') else path, ttl=ttl)
+    if url.startswith('redis://'):
+        return RedisCache.from_url(url, ttl=ttl)
+    raise ValueError(f'Unsupported cache backend: {url}')
+
+
+class LinkCache:
+    """
+    线程安全的持久化 LRU 映射（短链接 -> 重定向后的 URL），不设过期时间
+
+    每新增 SHORT_LINK_SAVE_EVERY 条以及进程退出时写回 path，path 为 None 时只保存在内存中
+    """
+
+    def __init__(self, path=None, maxsize=SHORT_LINK_CACHE_SIZE, save_every=SHORT_LINK_SAVE_EVERY):
+        self.path = path
+        self.maxsize = maxsize
+        self.save_every = save_every
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._dirty = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                items = json.load(f)
+        except (OSError, ValueError):
+            # 文件损坏时从空缓存开始，下次保存时覆盖
+            return
+        with self._lock:
+            for key, value in items[-self.maxsize:]:
+                self._data[key] = value
+
+    def save(self):
+        with self._lock:
+            if not self.path or not self._dirty:
+                return
+            items = list(self._data.items())
+            self._dirty = 0
+        # 先写临时文件再替换，避免多个写入者或中途退出留下半个文件
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(items, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning("保存短链接缓存失败: %s", e)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            self._dirty += 1
+            flush = self._dirty >= self.save_every
+        if flush:
+            self.save()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._dirty = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MetadataStore:
+    """
+    基于 SQLite 的歌曲信息与歌词存储，可按 mid 或 id 查询，歌词使用 zlib 压缩
+
+    每个线程使用独立连接，WAL 模式下多个进程可以共享同一个数据库文件
+    """
+
+    def __init__(self, path, max_age=METADATA_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS songs (id INTEGER PRIMARY KEY, mid TEXT UNIQUE, info TEXT NOT NULL, updated REAL NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS lyrics (id INTEGER PRIMARY KEY, lyric BLOB NOT NULL, trans BLOB NOT NULL, updated REAL NOT NULL)')
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            self._local.db = db
+        return db
+
+    def _fresh(self, updated, max_age=None):
+        return time.time() - updated < (self.max_age if max_age is None else max_age)
+
+    def get_song(self, mid='', sid=0, max_age=None):
+        """
+        按 id（优先）或 mid 查询歌曲信息，不存在或已过期时返回 None；max_age 可临时缩短有效期
+        """
+        if sid:
+            row = self._connect().execute('SELECT info, updated FROM songs WHERE id = ?', (int(sid),)).fetchone()
+        elif mid:
+            row = self._connect().execute('SELECT info, updated FROM songs WHERE mid = ?', (mid,)).fetchone()
+        else:
+            return None
+        if row is None or not self._fresh(row[1], max_age):
+            return None
+        return json.loads(row[0])
+
+    def put_song(self, info):
+        """
+        保存 _normalize_song 整理后的歌曲信息，同时记录 mid 与 id 的对应关系
+        """
+        self.put_songs([info])
+
+    def put_songs(self, infos):
+        """
+        在一个事务中保存多首歌曲的信息，缺少 mid 或 id 的条目忽略
+        """
+        infos = [info for info in infos if info.get('mid') and info.get('id')]
+        if not infos:
+            return
+        db = self._connect()
+        now = time.time()
+        # mid 与 id 一一对应，先删除可能冲突的旧记录
+        db.execute('BEGIN')
+        try:
+            db.executemany('DELETE FROM songs WHERE mid = ? AND id != ?', [(info['mid'], int(info['id'])) for info in infos])
+            db.executemany(
+                'INSERT OR REPLACE INTO songs (id, mid, info, updated) VALUES (?, ?, ?, ?)',
+                [(int(info['id']), info['mid'], json.dumps(info, ensure_ascii=False), now) for info in infos],
+            )
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            db.execute('ROLLBACK')
+            raise
+
+    def get_lyric(self, mid='', sid=0):
+        """
+        按 id 或 mid 查询歌词 {'lyric', 'tylyric'}，不存在或已过期时返回 None
+        """
+        if not sid and mid:
+            row = self._connect().execute('SELECT id FROM songs WHERE mid = ?', (mid,)).fetchone()
+            sid = row[0] if row else 0
+        if not sid:
+            return None
+        row = self._connect().execute('SELECT lyric, trans, updated FROM lyrics WHERE id = ?', (int(sid),)).fetchone()
+        if row is None or not self._fresh(row[2]):
+            return None
+        return {'lyric': zlib.decompress(row[0]).decode('utf-8'), 'tylyric': zlib.decompress(row[1]).decode('utf-8')}
+
+    def put_lyric(self, sid, lyric):
+        """
+        保存 _parse_lyric 解析出的歌词，没有歌词的歌曲也会记录，避免重复请求
+        """
+        if not sid or 'error' in lyric:
+            return
+        self._connect().execute(
+            'INSERT OR REPLACE INTO lyrics (id, lyric, trans, updated) VALUES (?, ?, ?, ?)',
+            (
+                int(sid),
+                zlib.compress(lyric.get('lyric', '').encode('utf-8')),
+                zlib.compress(lyric.get('tylyric', '').encode('utf-8')),
+                time.time(),
+            ),
+        )
+
+    def clear(self):
+        db = self._connect()
+        db.execute('DELETE FROM songs')
+        db.execute('DELETE FROM lyrics')
+
+    def stats(self):
+        db = self._connect()
+        return {
+            'songs': db.execute('SELECT COUNT(*) FROM songs').fetchone()[0],
+            'lyrics': db.execute('SELECT COUNT(*) FROM lyrics').fetchone()[0],
+        }
+
+
+_metadata_store = None
+_metadata_store_lock = threading.Lock()
+
+
+def get_metadata_store():
+    """
+    获取进程共享的歌曲信息存储，首次使用时打开 METADATA_DB，未配置时返回 None
+    """
+    global _metadata_store
+    if _metadata_store is None and METADATA_DB:
+        with _metadata_store_lock:
+            if _metadata_store is None:
+                _metadata_store = MetadataStore(METADATA_DB)
+    return _metadata_store
+
+
+class AudioCache:
+    """
+    本地音频缓存：按 (songmid, 音质) 保存完整的音频文件，总大小超过预算时淘汰最久未访问的文件
+
+    下载中的文件以 .part 结尾，中断后下次用 Range 从已下载的位置续传；未在下载的 .part 同样计入总大小，
+    超出预算时先于完整文件淘汰。命中时更新文件的 mtime，重启后按 mtime 恢复访问顺序
+    """
+
+    def __init__(self, path, max_bytes=AUDIO_CACHE_MAX_BYTES, workers=AUDIO_CACHE_WORKERS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._files = OrderedDict()  # 文件名 -> 大小，最近访问的在末尾
+        self._parts = OrderedDict()  # 未在下载的 .part 对应的文件名 -> 已下载的大小
+        self._downloading = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='audio-cache')
+        self.bytes = 0
+        self.part_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(path, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def filename(songmid, file_type):
+        # songmid 来自请求参数，拼入路径前必须排除 / 与 .. 等字符
+        if not SONGMID_RE.fullmatch(songmid):
+            raise ValueError(f'invalid songmid: {songmid!r}')
+        return f"{songmid}.{file_type}{FILE_CONFIG[file_type]['e']}"
+
+    def _scan(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        with self._lock:
+            for _, name, size in sorted(entries):
+                if name.endswith('.part'):
+                    self._parts[name[:-len('.part')]] = size
+                    self.part_bytes += size
+                else:
+                    self._files[name] = size
+                    self.bytes += size
+            self._evict()
+
+    def _evict(self):
+        # 调用方持有 self._lock；已打开的文件被删除后仍可继续读完。
+        # 不完整的 .part 先淘汰，正在下载的 .part 不在 _parts 中
+        while self.bytes + self.part_bytes > self.max_bytes and (self._parts or self._files):
+            if self._parts:
+                name, size = self._parts.popitem(last=False)
+                self.part_bytes -= size
+                name += '.part'
+            else:
+                name, size = self._files.popitem(last=False)
+                self.bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def get(self, songmid, file_type):
+        """
+        返回已缓存文件的路径，未缓存时返回 None
+        """
+        name = self.filename(songmid, file_type)
+        with self._lock:
+            size = self._files.get(name)
+            if size is None:
+                self.misses += 1
+                return None
+            self._files.move_to_end(name)
+            self.hits += 1
+        path = os.path.join(self.path, name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # 文件被外部删除
+            with self._lock:
+                if self._files.pop(name, None) is not None:
+                    self.bytes -= size
+            return None
+        return path
+
+    def prefetch(self, qqmusic, songmid, file_type):
+        """
+        在后台线程下载到缓存，同一文件同时只下载一次；已缓存或正在下载时返回 False
+        """
+        name = self.filename(songmid, file_type)
+        with self._lock:
+            if name in self._files or name in self._downloading:
+                return False
+            self._downloading.add(name)
+        self._executor.submit(self._prefetch, qqmusic, songmid, file_type, name)
+        return True
+
+    def _prefetch(self, qqmusic, songmid, file_type, name):
+        try:
+            self.download(qqmusic, songmid, file_type)
+        except (requests.RequestException, OSError) as e:
+            # 保留 .part，下次访问时续传
+            logger.warning("audio cache download failed for %s: %s", name, e)
+        finally:
+            with self._lock:
+                self._downloading.discard(name)
+
+    def download(self, qqmusic, songmid, file_type):
+        """
+        下载（或从 .part 续传）到缓存并返回文件路径，音质不可用时返回 None
+        """
+        name = self.filename(songmid, file_type)
+        part = os.path.join(self.path, name + '.part')
+        with self._lock:
+            # 下载期间 .part 的大小不断变化，不计入 part_bytes，结束时按结果重新登记
+            self.part_bytes -= self._parts.pop(name, 0)
+        try:
+            return self._download(qqmusic, songmid, file_type, name, part)
+        finally:
+            self._track_part(name, part)
+
+    def _download(self, qqmusic, songmid, file_type, name, part):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        response = qqmusic.open_stream(songmid, file_type, f'bytes={offset}-' if offset else None)
+        if response is None:
+            return None
+        with response:
+            total = self._total_size(response, offset)
+            # 416 且完整大小等于 .part 的大小：上次已下载完整但未来得及改名；
+            # 大小不一致时 .part 与上游的文件对不上（文件已变化或 .part 损坏），无法续传
+            complete = response.status_code == 416 and offset and total == offset
+            stale = response.status_code == 416 and offset and not complete
+            if not complete and not stale:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    # 上游忽略了 Range，从头下载
+                    offset = 0
+                with open(part, 'ab' if offset else 'wb') as f:
+                    for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                        f.write(chunk)
+        if stale:
+            # 删除后不带 Range 从头下载
+            os.remove(part)
+            return self._download(qqmusic, songmid, file_type, name, part)
+        size = os.path.getsize(part)
+        if total is not None and size != total:
+            if size > total:
+                os.remove(part)
+            raise OSError(f'incomplete download: {size} of {total} bytes')
+        path = os.path.join(self.path, name)
+        os.replace(part, path)
+        with self._lock:
+            self.bytes += size - self._files.pop(name, 0)
+            self._files[name] = size
+            self._evict()
+        return path
+
+    def _track_part(self, name, part):
+        """
+        下载结束（完成或失败）后登记留下的 .part，计入总大小以便淘汰
+        """
+        try:
+            size = os.path.getsize(part)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self.part_bytes += size - self._parts.pop(name, 0)
+            self._parts[name] = size
+            self._evict()
+
+    @staticmethod
+    def _total_size(response, offset):
+        """
+        从 Content-Range（bytes a-b/总大小）或 Content-Length 得到完整文件的大小，未知时返回 None
+        """
+        content_range = response.headers.get('Content-Range', '')
+        if '/' in content_range and content_range.rsplit('/', 1)[1].isdigit():
+            return int(content_range.rsplit('/', 1)[1])
+        length = response.headers.get('Content-Length')
+        if response.status_code == 200 and length and length.isdigit():
+            return int(length)
+        return None
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._files), 'bytes': self.bytes, 'part_bytes': self.part_bytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions, 'downloading': len(self._downloading)}
+
+
+_audio_cache = None
+_audio_cache_lock = threading.Lock()
+
+
+def get_audio_cache():
+    """
+    获取进程共享的本地音频缓存，未配置 AUDIO_CACHE_DIR 时返回 None
+    """
+    global _audio_cache
+    if _audio_cache is None and AUDIO_CACHE_DIR:
+        with _audio_cache_lock:
+            if _audio_cache is None:
+                _audio_cache = AudioCache(AUDIO_CACHE_DIR)
+    return _audio_cache
+
+
+class TokenBucket:
+    """
+    令牌桶，速率可按上游反馈自适应调整（失败时乘性降低，成功时加性恢复）
+    """
+
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        取出一个令牌，返回调用方需要等待的秒数；令牌不足时预支，后来者排在其后
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def penalize(self):
+        with self._lock:
+            self.rate = max(self.max_rate * RATE_MIN_FRACTION, self.rate * RATE_BACKOFF_FACTOR)
+
+    def reward(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_RECOVERY_STEP)
+
+
+class RateLimiter:
+    """
+    按上游主机划分的令牌桶限速器，空闲时不产生额外延迟
+    """
+
+    def __init__(self, limits=None, default=UPSTREAM_DEFAULT_RATE, share=None):
+        self.limits = UPSTREAM_RATE_LIMITS if limits is None else limits
+        self.default = default
+        # 本进程可使用的速率比例
+        self.share = 1 / WORKER_COUNT if share is None else share
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, host):
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(host)
+                if bucket is None:
+                    rate, burst = self.limits.get(host, self.default)
+                    bucket = self._buckets[host] = TokenBucket(rate * self.share, max(1, burst * self.share))
+        return bucket
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def rates(self):
+        """
+        返回 {host: 当前速率}
+        """
+        with self._lock:
+            return {host: bucket.rate for host, bucket in self._buckets.items()}
+
+    def acquire(self, host):
+        delay = self.bucket(host).reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, host):
+        delay = self.bucket(host).reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def report(self, host, ok):
+        """
+        根据上游结果调整速率：被限流或出错时降低，成功时逐步恢复
+        """
+        if ok:
+            self.bucket(host).reward()
+        else:
+            self.bucket(host).penalize()
+
+
+class Account:
+    """
+    账号池中的一个账号，Cookie 只在加载时解析一次
+    """
+
+    def __init__(self, cookie_str, vip=False, weight=1):
+        self.cookie_str = cookie_str
+        self.cookies = parse_cookies(cookie_str)
+        self.id = cookie_identity(cookie_str)
+        self.vip = vip
+        self.weight = max(weight, 0.01)
+        self.next_at = 0.0  # 加权轮转的虚拟时间，越小越优先
+        self.ejected_until = 0.0
+        self.error_rate = 0.0
+        self.empty_rate = 0.0
+        self.samples = 0
+        self.vip_samples = 0
+        self.requests = 0
+        self.errors = 0
+        self.empty = 0
+
+    def stats(self):
+        return {
+            'id': self.id,
+            'vip': self.vip,
+            'requests': self.requests,
+            'errors': self.errors,
+            'empty': self.empty,
+            'error_rate': round(self.error_rate, 3),
+            'empty_rate': round(self.empty_rate, 3),
+            'ejected': self.ejected_until > time.monotonic(),
+        }
+
+
+class CookiePool:
+    """
+    多账号负载均衡：按权重轮流使用（同权重时即最近最少使用），
+    记录每个账号的错误率和会员音质空 purl 率，不健康的账号暂时剔除
+    """
+
+    def __init__(self, accounts):
+        if not accounts:
+            raise ValueError('cookie pool is empty')
+        self.accounts = accounts
+        self.id = cookie_identity('\n'.join(sorted(account.cookie_str for account in accounts)))
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path, fallback=''):
+        """
+        从 JSON 文件加载账号池，文件不存在时使用 fallback Cookie 组成单账号的池
+        """
+        if not os.path.exists(path):
+            return cls([Account(fallback, vip=True)])
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        return cls([
+            Account(entry['cookie'], vip=entry.get('vip', False), weight=entry.get('weight', 1))
+            for entry in entries
+        ])
+
+    def acquire(self, vip=False):
+        """
+        选出下一个使用的账号；vip=True 时只在会员账号中选择，
+        否则优先非会员账号，把会员账号留给需要它的音质
+        """
+        with self._lock:
+            now = time.monotonic()
+            # 全部被剔除时仍从所有账号中选择，避免服务完全不可用
+            healthy = [account for account in self.accounts if account.ejected_until <= now] or self.accounts
+            if vip:
+                candidates = [account for account in healthy if account.vip] or healthy
+            else:
+                candidates = [account for account in healthy if not account.vip] or healthy
+            account = min(candidates, key=lambda account: account.next_at)
+            account.next_at = max(account.next_at, now) + 1 / account.weight
+            account.requests += 1
+            return account
+
+    def report(self, account, error):
+        """
+        记录一次上游请求的结果
+        """
+        with self._lock:
+            account.samples += 1
+            account.errors += bool(error)
+            account.error_rate += ACCOUNT_EWMA_ALPHA * (bool(error) - account.error_rate)
+            if account.samples >= ACCOUNT_MIN_SAMPLES and account.error_rate > ACCOUNT_ERROR_RATE:
+                self._eject(account)
+
+    def report_urls(self, account, requested, empty):
+        """
+        记录一次 vkey 请求中会员音质的数量与 purl 为空的数量
+        """
+        if not requested:
+            return
+        with self._lock:
+            account.vip_samples += requested
+            account.empty += empty
+            # 按本次请求的音质数量加权，批量请求与逐个请求的衰减速度一致
+            alpha = 1 - (1 - ACCOUNT_EWMA_ALPHA) ** requested
+            account.empty_rate += alpha * (empty / requested - account.empty_rate)
+            if account.vip and account.vip_samples >= ACCOUNT_MIN_SAMPLES and account.empty_rate > ACCOUNT_EMPTY_RATE:
+                # 会员音质几乎全部为空，通常是会员过期或 Cookie 失效
+                self._eject(account)
+                # 负缓存按账号池标识记录，该账号返回的空 purl 会让其他会员账号也不再尝试这些音质
+                negative_cache.clear()
+
+    def _eject(self, account):
+        account.ejected_until = time.monotonic() + ACCOUNT_EJECT_SECONDS
+        account.error_rate = 0.0
+        account.empty_rate = 0.0
+        account.samples = 0
+        account.vip_samples = 0
+
+    def stats(self):
+        with self._lock:
+            return [account.stats() for account in self.accounts]
+
+
+_cookie_pool = None
+_cookie_pool_lock = threading.Lock()
+
+
+def get_cookie_pool():
+    """
+    获取进程共享的账号池，首次使用时加载 COOKIE_POOL_FILE
+    """
+    global _cookie_pool
+    if _cookie_pool is None:
+        with _cookie_pool_lock:
+            if _cookie_pool is None:
+                _cookie_pool = CookiePool.from_file(COOKIE_POOL_FILE, cookie_str)
+    return _cookie_pool
+
+
+def reload_cookie_pool():
+    """
+    重新加载账号池，账号变化后之前记录的空结果不再可信
+    """
+    global _cookie_pool
+    with _cookie_pool_lock:
+        _cookie_pool = CookiePool.from_file(COOKIE_POOL_FILE, cookie_str)
+    negative_cache.clear()
+    return _cookie_pool
+
+
+class SingleFlight:
+    """
+    合并并发的相同查询：同一 key 同时只有一个调用方请求上游，其余调用方等待并共享其结果
+    """
+
+    class _Call:
+        __slots__ = ('event', 'result', 'error')
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        执行 fn()，同一 key 正在执行时等待并返回同一个结果
+        """
+        return self.do_many([key], lambda keys: {key: fn()})[key]
+
+    def do_many(self, keys, fn):
+        """
+        批量版本：fn(未在执行中的 keys) 返回 {key: result}，
+        其中已有其他调用方在请求的 key 直接等待对方的结果
+        """
+        calls = {}
+        mine = []
+        with self._lock:
+            for key in keys:
+                call = self._calls.get(key)
+                if call is None:
+                    call = self._calls[key] = self._Call()
+                    mine.append(key)
+                calls[key] = call
+
+        if mine:
+            results = {}
+            error = None
+            try:
+                results = fn(mine)
+            except BaseException as e:
+                error = e
+            with self._lock:
+                for key in mine:
+                    del self._calls[key]
+            for key in mine:
+                calls[key].result = results.get(key)
+                calls[key].error = error
+                calls[key].event.set()
+            if error is not None:
+                raise error
+
+        output = {}
+        for key, call in calls.items():
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            output[key] = call.result
+        return output
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight 的 asyncio 版本，用于同一事件循环内的并发协程
+    """
 
-class QQMusic:
     def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        return (await self.do_many([key], lambda keys: self._single(key, fn)))[key]
+
+    async def _single(self, key, fn):
+        return {key: await fn()}
+
+    async def do_many(self, keys, fn):
+        loop = asyncio.get_running_loop()
+        futures = {}
+        mine = []
+        for key in keys:
+            future = self._calls.get(key)
+            if future is None:
+                future = self._calls[key] = loop.create_future()
+                mine.append(key)
+            futures[key] = future
+
+        if mine:
+            try:
+                results = await fn(mine)
+            except BaseException as e:
+                for key in mine:
+                    del self._calls[key]
+                    if isinstance(e, asyncio.CancelledError):
+                        futures[key].cancel()
+                    else:
+                        futures[key].set_exception(e)
+                        futures[key].exception()  # 标记异常已读取，避免无人等待时的警告
+                raise
+            for key in mine:
+                del self._calls[key]
+                futures[key].set_result(results.get(key))
+
+        return {key: await asyncio.shield(future) for key, future in futures.items()}
+
+
+# 查询缓存（按 CACHE_URL 选择后端），播放 URL 的 key 为 (songmid, file_type, cookie 标识)，
+# 共享后端中歌曲信息为 ('song', id) / ('song', mid)，歌词为 ('lyric', id)
+music_url_cache = create_cache(CACHE_URL, maxsize=URL_CACHE_SIZE, ttl=URL_CACHE_TTL)
+# 已知为空的结果，key 为 ('url', songmid, file_type, cookie 标识) 或 ('song', mid, sid, cookie 标识)
+negative_cache = TTLCache(maxsize=NEGATIVE_CACHE_SIZE, ttl=NEGATIVE_CACHE_TTL)
+_negative_cookie_id = None
+# 分享短链接的重定向结果，进程退出时写回文件
+short_link_cache = LinkCache(SHORT_LINK_CACHE_FILE)
+atexit.register(short_link_cache.save)
+# 序列化后的 /song 响应，key 见 song_response_key
+song_response_cache = TTLCache(maxsize=SONG_RESPONSE_CACHE_SIZE, ttl=SONG_RESPONSE_TTL)
+# 进程内所有 QQMusic 上游请求共享的限速器
+upstream_limiter = RateLimiter()
+# 合并进程内并发的相同上游查询
+upstream_flight = SingleFlight()
+async_flight = AsyncSingleFlight()
+
+
+class CacheWarmer:
+    """
+    按请求频率在后台提前刷新热门歌曲的播放链接与歌曲信息，使其缓存不会过期
+
+    频率每轮衰减一半；刷新按批量接口分块，由最多 workers 个线程并发执行，仍经过全局限速
+    """
+
+    def __init__(self, top_n=WARMER_TOP_N, interval=WARMER_INTERVAL, ahead=WARMER_AHEAD, workers=WARMER_WORKERS):
+        self.top_n = top_n
+        self.interval = interval
+        self.ahead = ahead
+        self.workers = workers
+        self.scores = {}  # songmid -> 热度
+        self.types = {}  # songmid -> {file_type: None}，请求过的音质
+        self.refreshed = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def track(self, songmid, file_types, weight=1):
+        """
+        记录一次对 songmid 的请求
+        """
+        if not songmid:
+            return
+        with self._lock:
+            self.scores[songmid] = self.scores.get(songmid, 0) + weight
+            self.types.setdefault(songmid, {}).update(dict.fromkeys(file_types))
+            if len(self.scores) > WARMER_MAX_TRACKED:
+                self._decay()
+
+    def _decay(self):
+        for songmid in list(self.scores):
+            self.scores[songmid] /= 2
+            if self.scores[songmid] < 0.5:
+                del self.scores[songmid]
+                self.types.pop(songmid, None)
+
+    def hot(self):
+        """
+        返回当前最热的 top_n 首歌曲 [(songmid, [file_type])]
+        """
+        with self._lock:
+            top = sorted(self.scores, key=self.scores.get, reverse=True)[:self.top_n]
+            return [(songmid, list(self.types.get(songmid, ()))) for songmid in top]
+
+    def due(self, qqmusic, hot):
+        """
+        找出需要刷新的播放链接 key 与歌曲 key
+        """
+        keys = [(songmid, file_type, qqmusic.cookie_id) for songmid, file_types in hot for file_type in file_types]
+        remaining = qqmusic.url_cache.remaining_many(keys)
+        urls = [
+            key for key in keys
+            if remaining.get(key, 0) < self.ahead and not negative_cache.get(('url',) + key)
+        ]
+        songs = []
+        if qqmusic.store:
+            max_age = max(0, qqmusic.store.max_age - self.ahead)
+            songs = [
+                ('song', songmid, 0, qqmusic.cookie_id) for songmid, _ in hot
+                if qqmusic.store.get_song(songmid, max_age=max_age) is None
+            ]
+        return urls, songs
+
+    def run_once(self, qqmusic=None):
+        """
+        执行一轮刷新，返回 {'urls': 刷新的播放链接数, 'songs': 刷新的歌曲数}
+        """
+        qqmusic = qqmusic or QQMusic()
+        urls, songs = self.due(qqmusic, self.hot())
+        jobs = [
+            (qqmusic._fetch_songs, chunk) for chunk in chunked(songs, BULK_DETAIL_CHUNK_SIZE)
+        ] + [
+            (lambda keys: qqmusic._fetch_shared(keys, qqmusic._fetch_url_pairs), chunk)
+            for chunk in chunked(urls, BULK_VKEY_CHUNK_SIZE)
+        ]
+        if jobs:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(fetch, chunk) for fetch, chunk in jobs]
+            for future in futures:
+                try:
+                    future.result()
+                except (requests.RequestException, ValueError, KeyError) as e:
+                    self.errors += 1
+                    logger.warning("预热请求失败: %s", e)
+        with self._lock:
+            self.refreshed += len(urls) + len(songs)
+            self._decay()
+        return {'urls': len(urls), 'songs': len(songs)}
+
+    def start(self):
+        """
+        启动后台预热线程，重复调用无效
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='cache-warmer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                # 预热失败不能让后台线程退出
+                self.errors += 1
+                logger.exception("预热失败: %s", e)
+
+    def stats(self):
+        with self._lock:
+            return {'tracked': len(self.scores), 'refreshed': self.refreshed, 'errors': self.errors}
+
+
+class Metrics:
+    """
+    Prometheus 文本格式的计数器、仪表与直方图，不依赖第三方库
+
+    每次记录只在锁内更新一个字典项，开销可以常驻生产环境
+    """
+
+    HELP = {
+        'qqmusic_http_requests_total': ('counter', '按接口与状态码统计的请求数'),
+        'qqmusic_http_request_duration_seconds': ('histogram', '接口请求耗时（流式响应只统计到开始发送）'),
+        'qqmusic_http_in_flight': ('gauge', '正在处理的请求数'),
+        'qqmusic_upstream_requests_total': ('counter', '按操作与结果统计的上游请求数'),
+        'qqmusic_upstream_duration_seconds': ('histogram', '上游请求耗时，不含限速等待'),
+        'qqmusic_upstream_in_flight': ('gauge', '正在进行的上游请求数'),
+        'qqmusic_upstream_wait_seconds_total': ('counter', '按主机统计的限速等待总时间'),
+        'qqmusic_vkey_files_total': ('counter', '按音质统计的 vkey 查询数'),
+        'qqmusic_vkey_empty_total': ('counter', '按音质统计的 purl 为空（VIP 限制/不存在）的次数'),
+        'qqmusic_cache_requests_total': ('counter', '按缓存与结果统计的查询数'),
+        'qqmusic_audio_cache_bytes': ('gauge', '本地音频缓存占用的字节数'),
+        'qqmusic_upstream_rate': ('gauge', '各上游主机当前的限速速率（次/秒）'),
+        'qqmusic_warmer_refreshed_total': ('counter', '预热器刷新的条目数'),
+        'qqmusic_warmer_tracked': ('gauge', '预热器正在统计的歌曲数'),
+    }
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self._values = {}  # (name, labels) -> 数值
+        self._histograms = {}  # (name, labels) -> [各桶计数..., 总和, 总数]
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            histogram[index] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def value(self, name, labels=()):
+        with self._lock:
+            return self._values.get((name, labels), 0)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ''
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in pairs) + '}'
+
+    def render(self, gauges=()):
+        """
+        输出 Prometheus 文本格式，gauges 为抓取时计算的 [(name, labels, value)]
+        """
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+        for name, labels, value in gauges:
+            values[(name, labels)] = value
+
+        lines = []
+        names = sorted({name for name, _ in values} | {name for name, _ in histograms})
+        for name in names:
+            kind, help_text = self.HELP.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (metric, labels), value in sorted(values.items(), key=lambda item: str(item[0])):
+                if metric == name:
+                    lines.append(f'{name}{self._labels(labels)} {value}')
+            for (metric, labels), histogram in sorted(histograms.items(), key=lambda item: str(item[0])):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), histogram):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{self._labels(labels)} {histogram[-2]}')
+                lines.append(f'{name}_count{self._labels(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+
+# 进程内共享的监控指标
+metrics = Metrics()
+
+# 当前请求正在进行的 span，asyncio 任务与线程各自持有，未开始追踪时为 None
+_current_span = contextvars.ContextVar('qqmusic_span', default=None)
+
+
+def start_trace(name='request'):
+    """
+    开始追踪当前请求，返回 (根 span, 用于 end_trace 的 token)
+    """
+    span = {'name': name, 'start': time.perf_counter(), 'dur': None, 'attrs': {}, 'children': []}
+    return span, _current_span.set(span)
+
+
+def end_trace(span, token):
+    span['dur'] = time.perf_counter() - span['start']
+    _current_span.reset(token)
+    return span
+
+
+@contextmanager
+def trace_span(name, **attrs):
+    """
+    在当前追踪下记录一个子 span；没有进行中的追踪（如后台预热线程）时不做任何事
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = {'name': name, 'start': time.perf_counter(), 'dur': None, 'attrs': attrs, 'children': []}
+    parent['children'].append(span)
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        span['dur'] = time.perf_counter() - span['start']
+        _current_span.reset(token)
+
+
+def trace_tree(span, origin=None):
+    """
+    将 span 转换为可 JSON 序列化的树，时间单位为毫秒，start_ms 相对于请求开始
+    """
+    origin = span['start'] if origin is None else origin
+    dur = span['dur'] if span['dur'] is not None else time.perf_counter() - span['start']
+    node = {'name': span['name'], 'start_ms': round((span['start'] - origin) * 1000, 2), 'dur_ms': round(dur * 1000, 2)}
+    node.update(span['attrs'])
+    if span['children']:
+        node['children'] = [trace_tree(child, origin) for child in span['children']]
+    return node
+
+
+def server_timing(root):
+    """
+    生成 Server-Timing 头：每个已结束的 span 一项，同名 span（如多次 vkey 请求）依次编号，最后为 total
+    """
+    entries = []
+    seen = {}
+    def walk(span):
+        for child in span['children']:
+            if child['dur'] is not None:
+                count = seen[child['name']] = seen.get(child['name'], 0) + 1
+                name = child['name'] if count == 1 else f"{child['name']}-{count}"
+                entries.append(f"{name};dur={child['dur'] * 1000:.2f}")
+            walk(child)
+    walk(root)
+    entries.append(f"total;dur={(time.perf_counter() - root['start']) * 1000:.2f}")
+    return ', '.join(entries)
+
+
+def log_slow_request(root, path):
+    if SLOW_REQUEST_SECONDS and root['dur'] is not None and root['dur'] >= SLOW_REQUEST_SECONDS:
+        slow_logger.warning("slow request %s %.1fms %s", path, root['dur'] * 1000, json.dumps(trace_tree(root), ensure_ascii=False))
+
+
+def collect_gauges():
+    """
+    抓取时从各缓存、限速器与预热器的统计中读取的指标
+    """
+    gauges = []
+    caches = {'url': music_url_cache, 'negative': negative_cache, 'short_link': short_link_cache,
+              'song_response': song_response_cache}
+    for cache, instance in caches.items():
+        stats = instance.stats()
+        gauges.append(('qqmusic_cache_requests_total', (('cache', cache), ('result', 'hit')), stats['hits']))
+        gauges.append(('qqmusic_cache_requests_total', (('cache', cache), ('result', 'miss')), stats['misses']))
+    audio_cache = get_audio_cache()
+    if audio_cache is not None:
+        stats = audio_cache.stats()
+        gauges.append(('qqmusic_cache_requests_total', (('cache', 'audio'), ('result', 'hit')), stats['hits']))
+        gauges.append(('qqmusic_cache_requests_total', (('cache', 'audio'), ('result', 'miss')), stats['misses']))
+        gauges.append(('qqmusic_audio_cache_bytes', (), stats['bytes']))
+        gauges.append(('qqmusic_audio_cache_partial_bytes', (), stats['part_bytes']))
+    for host, rate in upstream_limiter.rates().items():
+        gauges.append(('qqmusic_upstream_rate', (('host', host),), round(rate, 3)))
+    stats = cache_warmer.stats()
+    gauges.append(('qqmusic_warmer_refreshed_total', (), stats['refreshed']))
+    gauges.append(('qqmusic_warmer_tracked', (), stats['tracked']))
+    return gauges
+
+
+# 进程内共享的热门歌曲预热器
+cache_warmer = CacheWarmer()
+
+
+class QQMusic:
+    def __init__(self, session=None, url_cache=None):
         self.base_url = 'https://u.y.qq.com/cgi-bin/musicu.fcg'
         self.guid = '10000'
         self.uin = '0'
         self.cookies = {}
-        self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+        # 默认使用账号池，每次上游请求选择一个账号；set_cookies 后固定使用指定 Cookie
+        self.pool = get_cookie_pool()
+        self.cookie_id = self.pool.id
+        self.session = session or get_session()
+        self.url_cache = music_url_cache if url_cache is None else url_cache
+        # 歌曲信息与歌词几乎不会变化，优先从本地存储读取
+        self.store = get_metadata_store()
+        self.flight = upstream_flight
+        self.limiter = upstream_limiter
+        self.warmer = cache_warmer
+        self.timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        self.headers = HEADERS
+        self._headers = LYRIC_HEADERS
+        self.mac_headers = MAC_HEADERS
+        self.file_config = FILE_CONFIG
+        self.song_url = 'https://c.y.qq.com/v8/fcg-bin/fcg_play_single_song.fcg'
+        self.lyric_url = 'https://c.y.qq.com/lyric/fcgi-bin/fcg_query_lyric_new.fcg'
+
+    def _request(self, method, url, account=None, op='other', decode=False, **kwargs):
+        """
+        所有上游请求的统一出口：先经过全局限速，再按返回结果调整该主机的速率；
+        使用账号池时同时记录所用账号的健康度，op 为 /metrics 中的操作名
+
+        decode=True 时返回解码后的 JSON，HTTP 状态异常或顶层 code 非 0 时抛出 requests.RequestException
+        """
+        host = urlparse(url).hostname
+        if account is None and 'cookies' not in kwargs:
+            account = self._pick_account()
+        if account is not None:
+            kwargs['cookies'] = account.cookies
+        start = time.perf_counter()
+        self.limiter.acquire(host)
+        started = time.perf_counter()
+        metrics.inc('qqmusic_upstream_wait_seconds_total', (('host', host),), started - start)
+        kwargs.setdefault('cookies', self.cookies)
+        kwargs.setdefault('headers', self.headers)
+        kwargs.setdefault('timeout', self.timeout)
+        labels = (('op', op),)
+        metrics.inc('qqmusic_upstream_in_flight', labels)
+        try:
+            with trace_span(f'upstream.{op}'):
+                response = getattr(self.session, method)(url, **kwargs)
+                data = response.json() if decode and response.status_code < 400 else None
+        except requests.RequestException:
+            self.limiter.report(host, False)
+            self._report_account(account, True)
+            metrics.inc('qqmusic_upstream_requests_total', labels + (('result', 'error'),))
+            raise
+        finally:
+            metrics.inc('qqmusic_upstream_in_flight', labels, -1)
+            metrics.observe('qqmusic_upstream_duration_seconds', labels, time.perf_counter() - started)
+        ok = response.status_code not in THROTTLE_STATUS and not upstream_code(data)
+        metrics.inc('qqmusic_upstream_requests_total', labels + (('result', 'ok' if ok else 'throttled'),))
+        self.limiter.report(host, ok)
+        self._report_account(account, not ok)
+        if not decode:
+            return response
+        response.raise_for_status()
+        return upstream_json(data, op)
+
+    def _post_json(self, url, account=None, op='other', **kwargs):
+        """
+        POST 请求并返回解码后的 JSON，与 AsyncQQMusic._post_json 对应
+        """
+        return self._request('post', url, account=account, op=op, decode=True, **kwargs)
+
+    def _pick_account(self, file_types=()):
+        """
+        从账号池选择账号，请求中包含会员音质时只使用会员账号；固定 Cookie 时返回 None
+        """
+        if self.pool is None:
+            return None
+        return self.pool.acquire(vip=any(file_type in VIP_FILE_TYPES for file_type in file_types))
+
+    def _report_account(self, account, error):
+        if account is not None:
+            self.pool.report(account, error)
+
+    def _report_urls(self, account, requested, urls, data):
+        """
+        统计会员音质的空 purl 数量，用于发现会员过期的账号；requested 为 {urls 中的 key: file_type}
+        """
+        if account is None or not data.get('midurlinfo'):
+            return
+        vip_keys = [key for key, file_type in requested.items() if file_type in VIP_FILE_TYPES]
+        self.pool.report_urls(account, len(vip_keys), sum(1 for key in vip_keys if key not in urls))
+
+    def set_cookies(self, cookie_str):
+        global _negative_cookie_id
+        self.pool = None
+        self.cookies = parse_cookies(cookie_str)
+        self.cookie_id = cookie_identity(cookie_str)
+        # 配置的 Cookie 变化后（如换成会员账号），之前记录的空结果不再可信
+        if _negative_cookie_id != self.cookie_id:
+            if _negative_cookie_id is not None:
+                negative_cache.clear()
+            _negative_cookie_id = self.cookie_id
+
+    def ids(self, url):
+        """
+        从不同类型的 URL 中提取歌曲 ID，支持重定向和 /songDetail/ URL 形式
+        """
+        return self._parse_song_id(self._resolve_short_link(url))
+
+    def _resolve_short_link(self, url):
+        """
+        分享短链接需要请求一次获取重定向后的URL，结果长期缓存；其他 URL 原样返回
+        """
+        if not is_short_link(url):
+            return url
+        location = short_link_cache.get(url)
+        if location is None:
+            response = self._request('get', url, op='redirect', allow_redirects=False, cookies=None, headers=None)
+            location = response.headers.get('Location')  # 获取重定向的URL
+            if location:
+                short_link_cache.set(url, location)
+        return location
+
+    def _parse_song_id(self, url):
+        """
+        从（重定向后的）URL 中解析歌曲 ID，不发起网络请求
+        """
+        ids = parse_song_url(url)
+        if ids is None:
+            return None
+        mid, sid = ids
+        return mid or str(sid)
+
+    def song_ids(self, url):
+        """
+        从同时带有 songmid 和 songid 参数的 URL 中提取 (mid, id)，缺少任一项时返回 None
+        """
+        ids = parse_song_url(url)
+        if ids and ids[0] and ids[1]:
+            return ids
+        return None
+
+    def get_music_url(self, songmid, file_type='flac'):
+        """
+        获取音乐播放URL
+        """
+        if file_type not in self.file_config:
+            raise ValueError("Invalid file_type. Choose from 'm4a', '128', '320', 'flac', 'ape', 'dts")
+
+        return self.get_music_urls(songmid, [file_type]).get(file_type)
+
+    def open_stream(self, songmid, file_type, byte_range=None):
+        """
+        通过 get_music_url 解析播放链接（复用缓存中仍有效的 vkey），以流式请求打开音频并转发 Range
+
+        返回未读取正文的 requests.Response，由调用方分块读取并关闭；音质不可用时返回 None
+        """
+        headers = dict(self.headers, **{'Accept-Encoding': 'identity'})
+        if byte_range:
+            headers['Range'] = byte_range
+        for attempt in range(2):
+            result = self.get_music_url(songmid, file_type)
+            if not result:
+                return None
+            with trace_span('upstream.stream'):
+                response = get_stream_session().get(result['url'], headers=headers, stream=True, timeout=self.timeout)
+            if response.status_code not in STREAM_EXPIRED_STATUS or attempt:
+                return response
+            response.close()
+            self.url_cache.delete((songmid, file_type, self.cookie_id))
+
+    def get_music_urls(self, songmid, file_types, sizes=None):
+        """
+        一次 CgiGetVkey 请求批量获取多种音质的播放URL
+
+        返回 {file_type: {'url', 'bitrate'}}，VIP/不存在的音质不会出现在结果中
+        缓存中未过期的音质不会再次请求上游；传入 get_music_song 返回的 sizes 时，
+        大小为 0 的音质直接跳过，结果中附带 'size'
+        """
+        sizes = sizes or {}
+        file_types = [file_type for file_type in file_types if sizes.get(file_type) != 0]
+        self.warmer.track(songmid, file_types)
+        urls, missing = self._cached_urls(songmid, file_types)
+        if missing:
+            # 并发的相同 (songmid, file_type) 查询只请求一次上游
+            keys = [(songmid, file_type, self.cookie_id) for file_type in missing]
+            fetch = lambda pending: self._fetch_urls(songmid, [key[1] for key in pending])
+            fetched = self.flight.do_many(keys, lambda pending: self._fetch_shared(pending, fetch))
+            urls.update(self._flight_urls(fetched))
+
+        # 按请求顺序返回
+        return self._apply_sizes({file_type: urls[file_type] for file_type in file_types if file_type in urls}, sizes)
+
+    def get_preferred_url(self, songmid, file_types, sizes=None):
+        """
+        按偏好顺序返回第一个可用音质 {file_type: {'url', 'bitrate'}}，都不可用时返回 {}
+        """
+        candidates = self._preferred_candidates(songmid, file_types, sizes)
+        return first_available(self.get_music_urls(songmid, candidates, sizes), candidates)
+
+    def _preferred_candidates(self, songmid, file_types, sizes):
+        """
+        偏好列表截断到第一个已缓存的音质，排在它之后的音质无需请求
+        """
+        sizes = sizes or {}
+        candidates = []
+        for file_type in file_types:
+            if sizes.get(file_type) == 0:
+                continue
+            candidates.append(file_type)
+            if (songmid, file_type, self.cookie_id) in self.url_cache:
+                break
+        return candidates
+
+    def _fetch_urls(self, songmid, file_types):
+        """
+        请求上游 vkey，返回 {(songmid, file_type, cookie 标识): result 或 None}
+        """
+        files = self._files(songmid, file_types)
+        account = self._pick_account(file_types)
+        data = module_data(self._post_json(self.base_url, account=account, op='vkey', json=self._vkey_request(songmid, files)), 'req_1')
+        urls = self._store_urls(songmid, data, files)
+        self._report_urls(account, {file_type: file_type for file_type in file_types}, urls, data)
+        return {(songmid, file_type, self.cookie_id): urls.get(file_type) for file_type in file_types}
+
+    def _fetch_shared(self, keys, fetch):
+        """
+        共享缓存后端下的跨节点防击穿：每个 key 先抢占锁，抢到的由本节点请求上游，
+        其余 key 等待持有锁的节点写入缓存；持有者确认不可用的音质在释放锁前写入 ('empty', ...) 标记，
+        锁释放后既没有结果也没有标记（持有者请求失败）或等待超时的 key 由本节点自行请求
+        """
+        if not self.url_cache.shared:
+            return fetch(keys)
+
+        mine = self._claim(keys)
+        results = {}
+        if mine:
+            fetched = None
+            try:
+                fetched = fetch(mine)
+            finally:
+                self._release(mine, fetched)
+            results.update(fetched)
+        results.update(self._wait_shared([key for key in keys if key not in mine], fetch))
+        return results
+
+    def _claim(self, keys):
+        """
+        抢占 keys 的跨节点锁，返回抢到的 key
+        """
+        return [key for key in keys if self.url_cache.add(('lock',) + tuple(key), 1, CACHE_LOCK_TTL)]
+
+    def _release(self, mine, fetched=None):
+        """
+        释放 mine 的锁；fetched 为请求到的 {key: result 或 None}，其中不可用的音质先写入 ('empty', ...) 标记，
+        请求失败时 fetched 为 None，等待的节点看到锁释放后自行请求
+        """
+        try:
+            markers = {('empty',) + tuple(key): True for key, result in (fetched or {}).items() if result is None}
+            if markers:
+                self.url_cache.set_many(markers, CACHE_LOCK_TTL)
+        finally:
+            self.url_cache.delete(*[('lock',) + tuple(key) for key in mine])
+
+    def _poll_shared(self, others):
+        """
+        查询一次其他节点持有锁的 key，返回 (已有结果的 {key: result 或 None}, 锁已释放却没有结果的 key)
+        """
+        locks = {key: ('lock',) + tuple(key) for key in others}
+        empty = {key: ('empty',) + tuple(key) for key in others}
+        found = self.url_cache.get_many(others + list(locks.values()) + list(empty.values()))
+        results = {}
+        retry = []
+        for key in others:
+            if key in found:
+                results[key] = found[key]
+            elif empty[key] in found:
+                results[key] = None
+            elif locks[key] not in found:
+                retry.append(key)
+        return results, retry
+
+    def _wait_shared(self, others, fetch):
+        """
+        等待其他节点写入 others 的结果，持有者请求失败或等待超时的 key 由 fetch 自行请求
+        """
+        results = {}
+        retry = []
+        deadline = time.monotonic() + CACHE_LOCK_WAIT
+        while others and time.monotonic() < deadline:
+            time.sleep(CACHE_LOCK_POLL)
+            found, failed = self._poll_shared(others)
+            results.update(found)
+            retry += failed
+            others = [key for key in others if key not in found and key not in failed]
+        retry += others
+        if retry:
+            results.update(fetch(retry))
+        return results
+
+    def _flight_urls(self, fetched):
+        """
+        将 SingleFlight 共享的结果转换为 {file_type: result}，结果可能被多个调用方共享，返回副本
+        """
+        return {key[1]: dict(result) for key, result in fetched.items() if result is not None}
+
+    def _cached_urls(self, songmid, file_types):
+        """
+        从缓存中取出已解析的音质，返回 (已缓存结果, 需要请求的音质列表)
+        """
+        urls, missing = self._cached_urls_many({songmid: file_types})
+        return urls[songmid], [file_type for _, file_type, _ in missing]
+
+    def _cached_urls_many(self, plans):
+        """
+        一次批量查询多首歌曲的缓存，plans 为 {songmid: [file_type]}，
+        返回 ({songmid: {file_type: result}}, 需要请求的 [(songmid, file_type, cookie 标识)])
+        """
+        keys = [(songmid, file_type, self.cookie_id) for songmid, file_types in plans.items() for file_type in file_types]
+        found = self.url_cache.get_many(keys)
+        urls = {songmid: {} for songmid in plans}
+        missing = []
+        for key in keys:
+            if key in found:
+                urls[key[0]][key[1]] = dict(found[key])
+            elif not negative_cache.get(('url',) + key):
+                missing.append(key)
+        return urls, missing
+
+    def _store_urls(self, songmid, data, files):
+        """
+        解析单首歌曲的 vkey 模块返回并写入缓存，返回 {file_type: result}
+        """
+        pairs = {filename: (songmid, file_type) for filename, file_type in files.items()}
+        return {file_type: result for (_, file_type), result in self._store_vkey(data, pairs).items()}
+
+    def _store_vkey(self, data, pairs):
+        """
+        解析 vkey 模块返回并写入缓存，pairs 为 {filename: (songmid, file_type)}
+        TTL 比上游给出的 vkey 有效期短
+        """
+        urls = self._parse_vkey(data, list(pairs.values()), list(pairs))
+        for key in pairs.values():
+            labels = (('file_type', key[1]),)
+            metrics.inc('qqmusic_vkey_files_total', labels)
+            if key not in urls:
+                metrics.inc('qqmusic_vkey_empty_total', labels)
+        ttl = URL_CACHE_TTL
+        if data.get('expiration'):
+            ttl = min(ttl, data['expiration'] * URL_CACHE_TTL_RATIO)
+        self.url_cache.set_many({(songmid, file_type, self.cookie_id): dict(result) for (songmid, file_type), result in urls.items()}, ttl)
+        # 上游正常返回但 purl 为空的音质（VIP 限制/不存在）记入负缓存
+        if data.get('midurlinfo'):
+            for songmid, file_type in pairs.values():
+                if (songmid, file_type) not in urls:
+                    negative_cache.set(('url', songmid, file_type, self.cookie_id), True)
+        return urls
+
+    def get_music_urls_bulk(self, songmids, file_types, sizes=None, prefer=False):
+        """
+        批量获取多首歌曲的播放URL，所有歌曲的 filename/songmid 合并后按
+        BULK_VKEY_CHUNK_SIZE 分批请求 CgiGetVkey
+
+        sizes 为 {songmid: get_music_song 返回的 sizes}，返回 {songmid: {file_type: result}}
+        """
+        sizes = sizes or {}
+        plans = {}
+        for songmid in dict.fromkeys(songmids):
+            song_sizes = sizes.get(songmid) or {}
+            if prefer:
+                types = self._preferred_candidates(songmid, file_types, song_sizes)
+            else:
+                types = [file_type for file_type in file_types if song_sizes.get(file_type) != 0]
+            plans[songmid] = types
+            self.warmer.track(songmid, types)
+        urls, keys = self._cached_urls_many(plans)
+
+        if keys:
+            fetched = self.flight.do_many(keys, lambda pending: self._fetch_shared(pending, self._fetch_url_pairs))
+            for (songmid, file_type, _), result in fetched.items():
+                if result is not None:
+                    urls[songmid][file_type] = dict(result)
+
+        results = {}
+        for songmid, types in plans.items():
+            song_urls = {file_type: urls[songmid][file_type] for file_type in types if file_type in urls[songmid]}
+            if prefer:
+                song_urls = first_available(song_urls, types)
+            results[songmid] = self._apply_sizes(song_urls, sizes.get(songmid) or {})
+        return results
+
+    def _vkey_request(self, songmid, files):
+        """
+        构造单独请求 vkey 时的 musicu.fcg 请求体
+        """
+        return {
+            'req_1': self._vkey_module(list(files), [songmid] * len(files)),
+            'loginUin': self.uin,
+            'comm': self._comm(),
+        }
+
+    def _files(self, songmid, file_types):
+        """
+        生成 {filename: file_type}，filename 格式为 前缀 + songmid + songmid + 后缀
+        """
+        files = {}
+        for file_type in file_types:
+            if file_type not in self.file_config:
+                raise ValueError(f"Invalid file_type: {file_type}")
+            file_info = self.file_config[file_type]
+            files[f"{file_info['s']}{songmid}{songmid}{file_info['e']}"] = file_type
+        return files
+
+    def _comm(self):
+        """
+        musicu.fcg 公共参数
+        """
+        return {
+            'uin': self.uin,
+            'format': 'json',
+            'ct': 24,
+            'cv': 0,
+        }
+
+    def _vkey_module(self, filenames, songmids):
+        """
+        构造 vkey.GetVkeyServer 模块请求体，filename 与 songmid 一一对应
+        """
+        return {
+            'module': 'vkey.GetVkeyServer',
+            'method': 'CgiGetVkey',
+            'param': {
+                'filename': filenames,
+                'guid': self.guid,
+                'songmid': songmids,
+                'songtype': [0] * len(songmids),
+                'uin': self.uin,
+                'loginflag': 1,
+                'platform': '20',
+            },
+        }
+
+    def _parse_vkey(self, data, keys, filenames):
+        """
+        将 midurlinfo 映射回请求时的 key，purl 为空（VIP/不存在）的条目被丢弃
+        """
+        by_filename = dict(zip(filenames, keys))
+        sip = data.get('sip') or ['']
+        host = sip[1] if len(sip) > 1 else sip[0]
+        results = {}
+        for index, info in enumerate(data.get('midurlinfo', [])):
+            # 优先按 filename 对应，缺失时按顺序对应
+            key = by_filename.get(info.get('filename'))
+            if key is None and index < len(keys):
+                key = keys[index]
+            purl = info.get('purl', '')
+            if key is None or purl == '':
+                continue
+
+            url = host + purl
+            prefix = purl[:4]
+            bitrate = next((conf['bitrate'] for conf in self.file_config.values() if conf['s'] == prefix), '')
+            results[key] = {'url': url.replace("http://", "https://"), 'bitrate': bitrate}
+        return results
+
+    def get_music_song(self, mid, sid):
+        """
+        获取歌曲信息
+        """
+        info = self._stored_song(mid, sid)
+        if info:
+            return info
+        if negative_cache.get(('song', mid, sid, self.cookie_id)):
+            return {'msg': '信息获取错误/歌曲不存在'}
+
+        return dict(self.flight.do(('song', mid, sid, self.cookie_id), lambda: self._fetch_song(mid, sid)))
+
+    def _fetch_song(self, mid, sid):
+        # 发送请求并解析返回的 JSON 数据
+        return self._parse_song(self._post_json(self.song_url, op='detail', data=self._song_request(mid, sid)), mid, sid)
+
+    def _song_request(self, mid, sid):
+        """
+        构造 fcg_play_single_song 请求参数
+        """
+        if sid != 0:
+            # 如果有 songid（sid），使用 songid 进行请求
+            return {
+                'songid': sid,
+                'platform': 'yqq',
+                'format': 'json',
+            }
+        # 如果没有 songid，使用 songmid 进行请求
+        return {
+            'songmid': mid,
+            'platform': 'yqq',
+            'format': 'json',
+        }
+
+    def _parse_song(self, data, mid, sid):
+        """
+        解析 fcg_play_single_song 返回的数据
+        """
+        # 确保数据结构存在，避免索引错误
+        if 'data' in data and len(data['data']) > 0:
+            return self._remember_song(self._normalize_song(data['data'][0], mid, sid))
+        # 只有上游明确返回成功（code 为 0）且没有数据时才是歌曲不存在，其他情况不能记入负缓存
+        if data.get('code') != 0:
+            raise UpstreamError('upstream detail returned no data')
+        negative_cache.set(('song', mid, sid, self.cookie_id), True)
+        return {'msg': '信息获取错误/歌曲不存在'}
+
+    def _normalize_song(self, song_info, mid, sid):
+        """
+        将 fcg_play_single_song / 详情模块返回的歌曲数据整理为统一格式
+        """
+        album_info = song_info.get('album', {})
+        singers = song_info.get('singer', [])
+        singer_names = ', '.join([singer.get('name', 'Unknown') for singer in singers])
+
+        # 获取专辑封面图片 URL
+        album_mid = album_info.get('mid')
+        img_url = f'https://y.qq.com/music/photo_new/T002R800x800M000{album_mid}.jpg?max_age=2592000' if album_mid else 'https://axidiqolol53.objectstorage.ap-seoul-1.oci.customer-oci.com/n/axidiqolol53/b/lusic/o/resources/cover.jpg'
+
+        # 返回处理后的歌曲信息
+        return {
+            'name': song_info.get('name', 'Unknown'),
+            'album': album_info.get('name', 'Unknown'),
+            'singer': singer_names,
+            'pic': img_url,
+            'mid': song_info.get('mid', mid),
+            'id': song_info.get('id', sid),
+            'sizes': self._file_sizes(song_info.get('file') or {}),
+        }
+
+    def _stored_song(self, mid, sid):
+        """
+        依次从本地存储和共享缓存读取歌曲信息，共享缓存命中时回填本地存储
+        """
+        info = self.store and self.store.get_song(mid, sid)
+        if self.store:
+            metrics.inc('qqmusic_cache_requests_total', (('cache', 'metadata'), ('result', 'hit' if info else 'miss')))
+        if info or not self.url_cache.shared:
+            return info
+        info = self.url_cache.get(('song', sid or mid))
+        if info and self.store:
+            self.store.put_song(info)
+        return info
+
+    def _stored_lyric(self, mid='', sid=0):
+        lyric = self.store and self.store.get_lyric(mid, sid)
+        if self.store:
+            metrics.inc('qqmusic_cache_requests_total', (('cache', 'lyric'), ('result', 'hit' if lyric else 'miss')))
+        if lyric or not self.url_cache.shared or not sid:
+            return lyric
+        lyric = self.url_cache.get(('lyric', sid))
+        if lyric and self.store:
+            self.store.put_lyric(sid, lyric)
+        return lyric
+
+    def _remember_song(self, info):
+        """
+        将上游返回的歌曲信息写入本地存储和共享缓存
+        """
+        if self.store:
+            self.store.put_song(info)
+        if self.url_cache.shared and info.get('mid') and info.get('id'):
+            self.url_cache.set_many({('song', info['id']): info, ('song', info['mid']): info}, METADATA_MAX_AGE)
+        return info
+
+    def _remember_songs(self, infos):
+        """
+        批量写入歌曲信息，本地存储使用一个事务，共享缓存使用一次批量写入
+        """
+        if self.store:
+            self.store.put_songs(infos)
+        if self.url_cache.shared:
+            mapping = {}
+            for info in infos:
+                if info.get('mid') and info.get('id'):
+                    mapping[('song', info['id'])] = info
+                    mapping[('song', info['mid'])] = info
+            if mapping:
+                self.url_cache.set_many(mapping, METADATA_MAX_AGE)
+        return infos
+
+    def _remember_lyric(self, songid, lyric):
+        if self.store:
+            self.store.put_lyric(songid, lyric)
+        if self.url_cache.shared and songid and 'error' not in lyric:
+            self.url_cache.set(('lyric', songid), lyric, METADATA_MAX_AGE)
+        return lyric
+
+    def _file_sizes(self, file_info):
+        """
+        从详情的 file 字段整理出 {file_type: 文件大小}，0 表示该音质不存在
+        """
+        sizes = {}
+        for file_type, key in FILE_SIZE_KEYS.items():
+            if isinstance(key, tuple):
+                values = file_info.get(key[0]) or []
+                size = values[key[1]] if key[1] < len(values) else None
+            else:
+                size = file_info.get(key)
+            if size is not None:
+                sizes[file_type] = int(size)
+        return sizes
+
+    def _apply_sizes(self, urls, sizes):
+        """
+        为已解析的播放 URL 附上文件大小
+        """
+        for file_type, result in urls.items():
+            if sizes.get(file_type):
+                result['size'] = sizes[file_type]
+        return urls
+
+    def get_music_lyric(self, mid):
+        """
+        获取歌曲歌词 - 旧版歌词接口
+        """
+        # 构造请求 URL
+        url = 'https://c.y.qq.com/lyric/fcgi-bin/fcg_query_lyric_new.fcg'
+        params = {
+            '_': str(int(time.time())),  # 当前时间戳
+            'format': 'json',
+            'loginUin': ''.join(random.sample('1234567890', 10)),  # 随机生成的登录 UIN
+            'songmid': mid  # 歌曲 MID
+        }
+
+        try:
+            # 发送 GET 请求获取歌词数据
+            response = self._request('get', url, op='lyric', headers=self._headers, params=params)
+            response.raise_for_status()  # 检查请求是否成功
+            data = response.json()
+            # 从返回的 JSON 数据中获取歌词
+            lyric = data.get('lyric', '')
+            if lyric:
+                # 解码并返回歌词
+                return base64.b64decode(lyric).decode('utf-8')
+            else:
+                return "未找到歌词"
+
+        except requests.RequestException as e:
+            return f"请求错误: {e}"
+        except Exception as e:
+            return f"解码错误: {e}"
+
+    def get_music_lyric_new(self, songid):
+        """从QQ音乐电脑客户端接口获取歌词
+
+        参数:
+            songID (str): 音乐id
+
+        返回值:
+            dict: 通过['lyric']和['trans']来获取base64后的歌词内容
+
+            其中 lyric为原文歌词 trans为翻译歌词
+        """
+        lyric = self._stored_lyric(sid=songid)
+        if lyric:
+            return lyric
+        return self.flight.do(('lyric', songid, self.cookie_id), lambda: self._fetch_lyric(songid))
+
+    def _fetch_lyric(self, songid):
+        # 发送请求获取歌词
+        try:
+            d = self._post_json(self.base_url, op='lyric', json=self._lyric_payload(songid))
+            
+            # 提取歌词数据
+            lyric = self._parse_lyric(d["music.musichallSong.PlayLyricInfo.GetPlayLyricInfo"]["data"])
+            return self._remember_lyric(songid, lyric)
+
+        except Exception as e:
+            logger.warning("Error fetching lyrics: %s", e)
+            return {'error': '无法获取歌词'}
+
+    def _lyric_payload(self, songid):
+        """
+        构造单独请求歌词时的 musicu.fcg 请求体
+        """
+        return {
+            "music.musichallSong.PlayLyricInfo.GetPlayLyricInfo": self._lyric_module(songid),
+            "comm": {
+                "wid": "",
+                "tmeAppID": "qqmusic",
+                "authst": "",
+                "uid": "",
+                "gray": "0",
+                "OpenUDID": "",
+                "ct": "6",
+                "patch": "2",
+                "psrf_qqopenid": "",
+                "sid": "",
+                "psrf_access_token_expiresAt": "",
+                "cv": "80600",
+                "gzip": "0",
+                "qq": "",
+                "nettype": "2",
+                "psrf_qqunionid": "",
+                "psrf_qqaccess_token": "",
+                "tmeLoginType": "2",
+            },
+        }
+
+    def _lyric_module(self, songid):
+        """
+        构造 PlayLyricInfo 歌词模块请求体
+        """
+        return {
+            "module": "music.musichallSong.PlayLyricInfo",
+            "method": "GetPlayLyricInfo",
+            "param": {
+                "trans_t": 0,
+                "roma_t": 0,
+                "crypt": 0,  # 1 define to encrypt
+                "lrc_t": 0,
+                "interval": 208,
+                "trans": 1,
+                "ct": 6,
+                "singerName": "",
+                "type": 0,
+                "qrc_t": 0,
+                "cv": 80600,
+                "roma": 1,
+                "songID": songid,
+                "qrc": 0,  # 1 define base64 or compress Hex
+                "albumName": "",
+                "songName": "",
+            },
         }
-        self._headers = {
-            'Accept': '*/*',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Referer': 'https://y.qq.com/',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36'
+
+    def _parse_lyric(self, lyric_data):
+        """
+        解码歌词模块返回的 base64 原文/翻译歌词
+        """
+        # 处理歌词内容
+        if 'lyric' in lyric_data and lyric_data['lyric']:
+            # 解码歌词
+            lyric = base64.b64decode(lyric_data['lyric']).decode('utf-8')
+            tylyric = base64.b64decode(lyric_data.get('trans', '')).decode('utf-8')
+        else:
+            lyric = ''  # 没有歌词的情况下返回空字符串
+            tylyric = ''  # 没有歌词的情况下返回空字符串
+        return {'lyric': lyric,'tylyric': tylyric}  # 返回包含歌词的字典
+
+    def _detail_module(self, mid, sid):
+        """
+        构造 pf_song_detail_svr 歌曲详情模块请求体
+        """
+        param = {'song_id': int(sid), 'song_type': 0} if sid else {'song_mid': mid, 'song_type': 0}
+        return {
+            'module': 'music.pf_song_detail_svr',
+            'method': 'get_song_detail_yqq',
+            'param': param,
         }
-        self.mac_headers = {
-            "accept-language": "zh-CN,zh;q=0.9,en;q=0.8",
-            "referer": "https://i.y.qq.com",
-            "user-agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 13_2_3 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.0.3 Mobile/15E148 Safari/604.1",
-            "content-type": "application/json",
-            "accept": "application/json",
-            "Host": "u.y.qq.com",
-            "Connection": "Keep-Alive"
+
+    def _fetch_url_pairs(self, keys):
+        """
+        按 BULK_VKEY_CHUNK_SIZE 分批请求多首歌曲的 vkey，keys 为 [(songmid, file_type, cookie 标识)]
+        """
+        pairs = {}
+        for songmid, file_type, _ in keys:
+            for filename in self._files(songmid, [file_type]):
+                pairs[filename] = (songmid, file_type)
+
+        # 会员音质与普通音质分开请求，普通音质不占用会员账号
+        groups = [
+            [filename for filename, pair in pairs.items() if pair[1] in VIP_FILE_TYPES],
+            [filename for filename, pair in pairs.items() if pair[1] not in VIP_FILE_TYPES],
+        ]
+        fetched = {}
+        for group in groups:
+            for chunk in chunked(group, BULK_VKEY_CHUNK_SIZE):
+                req_data = {
+                    'req_1': self._vkey_module(chunk, [pairs[filename][0] for filename in chunk]),
+                    'loginUin': self.uin,
+                    'comm': self._comm(),
+                }
+                chunk_types = [pairs[filename][1] for filename in chunk]
+                account = self._pick_account(chunk_types)
+                data = module_data(self._post_json(self.base_url, account=account, op='vkey', json=req_data), 'req_1')
+                urls = self._store_vkey(data, {filename: pairs[filename] for filename in chunk})
+                fetched.update(urls)
+                self._report_urls(account, {pairs[filename]: pairs[filename][1] for filename in chunk}, urls, data)
+        return {key: fetched.get(key[:2]) for key in keys}
+
+    def get_music_songs(self, keys):
+        """
+        批量获取歌曲信息，keys 为 [(mid, sid)]，每 BULK_DETAIL_CHUNK_SIZE 首歌曲的
+        详情模块合并为一次 musicu.fcg 请求，返回 {(mid, sid): info}
+        """
+        results = {}
+        pending = []
+        keys = list(dict.fromkeys(keys))
+        shared = {}
+        if self.url_cache.shared:
+            shared = self.url_cache.get_many([('song', sid or mid) for mid, sid in keys])
+        for mid, sid in keys:
+            info = (self.store and self.store.get_song(mid, sid)) or shared.get(('song', sid or mid))
+            if info:
+                results[(mid, sid)] = info
+            elif negative_cache.get(('song', mid, sid, self.cookie_id)):
+                results[(mid, sid)] = {'msg': '信息获取错误/歌曲不存在'}
+            else:
+                pending.append(('song', mid, sid, self.cookie_id))
+
+        if pending:
+            for key, info in self.flight.do_many(pending, self._fetch_songs).items():
+                results[key[1:3]] = dict(info)
+        return results
+
+    def _fetch_songs(self, keys):
+        """
+        按 BULK_DETAIL_CHUNK_SIZE 分批请求歌曲详情，keys 为 [('song', mid, sid, cookie 标识)]
+        """
+        results = {}
+        for chunk in chunked(keys, BULK_DETAIL_CHUNK_SIZE):
+            req_data = {f'detail_{index}': self._detail_module(key[1], key[2]) for index, key in enumerate(chunk)}
+            req_data['comm'] = self._comm()
+            data = self._post_json(self.base_url, op='detail', json=req_data)
+            for index, key in enumerate(chunk):
+                results[key] = self._parse_detail(data, f'detail_{index}', key[1], key[2])
+        return results
+
+    def _parse_detail(self, data, key, mid, sid):
+        """
+        解析 musicu.fcg 返回中 key 对应的 pf_song_detail_svr 模块，歌曲不存在时记入负缓存
+
+        模块缺失或 code 非 0（限流、出错）时抛出 UpstreamError，不记入负缓存
+        """
+        track_info = module_data(data, key).get('track_info') or {}
+        if track_info.get('mid') or track_info.get('id'):
+            return self._remember_song(self._normalize_song(track_info, mid, sid))
+        if data[key].get('code') != 0:
+            raise UpstreamError(f'upstream {key} returned no data')
+        negative_cache.set(('song', mid, sid, self.cookie_id), True)
+        return {'msg': '信息获取错误/歌曲不存在'}
+
+    def collection(self, url):
+        """
+        解析专辑或歌单链接（支持分享短链接），返回 (类型, ID)，不是专辑或歌单时返回 None
+        """
+        location = self._resolve_short_link(url)
+        return parse_collection_url(location) if location else None
+
+    def get_collection(self, kind, cid):
+        """
+        获取专辑或歌单的信息与全部曲目，返回 {'type', 'id', 'name', 'total', 'songs': [歌曲信息]}
+
+        曲目列表中已包含歌曲详情（含各音质大小），直接写入歌曲信息存储，之后无需再请求详情；
+        第一页得到总数后，其余各页合并为一次 musicu.fcg 请求，最多 COLLECTION_MAX_TRACKS 首；
+        任一页的模块 code 非 0（限流等）时抛出 UpstreamError，不返回不完整的曲目列表
+        """
+        data = self._post_json(self.base_url, op='collection', json={
+            'page_0': self._collection_module(kind, cid, 0), 'comm': self._comm(),
+        })
+        name, total, tracks = self._parse_collection(kind, module_data(data, 'page_0'))
+        if name is None:
+            return {'msg': '专辑/歌单不存在'}
+        total = min(total, COLLECTION_MAX_TRACKS)
+        begins = range(COLLECTION_PAGE_SIZE, total, COLLECTION_PAGE_SIZE) if len(tracks) < total else ()
+        if begins:
+            req_data = {f'page_{index}': self._collection_module(kind, cid, begin) for index, begin in enumerate(begins, 1)}
+            req_data['comm'] = self._comm()
+            data = self._post_json(self.base_url, op='collection', json=req_data)
+            for index in range(1, len(begins) + 1):
+                tracks.extend(self._parse_collection(kind, module_data(data, f'page_{index}'))[2])
+
+        songs = {}
+        for track in tracks[:total]:
+            if track.get('mid') and track['mid'] not in songs:
+                songs[track['mid']] = self._normalize_song(track, track['mid'], track.get('id', 0))
+        return {'type': kind, 'id': cid, 'name': name, 'total': total, 'songs': self._remember_songs(list(songs.values()))}
+
+    def _collection_module(self, kind, cid, begin):
+        """
+        构造专辑曲目（AlbumSongList）或歌单（uniform_get_Dissinfo）的分页模块请求体
+        """
+        if kind == 'album':
+            param = {'albumId': int(cid)} if cid.isdigit() else {'albumMid': cid}
+            param.update({'begin': begin, 'num': COLLECTION_PAGE_SIZE, 'order': 2})
+            return {'module': 'music.musichallAlbum.AlbumSongList', 'method': 'GetAlbumSongList', 'param': param}
+        return {
+            'module': 'music.srfDissInfo.aiDissInfo',
+            'method': 'uniform_get_Dissinfo',
+            'param': {
+                'disstid': int(cid),
+                'song_begin': begin,
+                'song_num': COLLECTION_PAGE_SIZE,
+                'onlysonglist': 0,
+                'tag': 0,
+                'userinfo': 0,
+                'enc_host_uin': '',
+            },
         }
-        self.file_config = {
-            '128': {'s': 'M500', 'e': '.mp3', 'bitrate': '128kbps'},
-            '320': {'s': 'M800', 'e': '.mp3', 'bitrate': '320kbps'},
-            'flac': {'s': 'F000', 'e': '.flac', 'bitrate': 'FLAC'},
-            'master': {'s': 'AI00', 'e': '.flac', 'bitrate': 'Master'},
-            'atmos_2': {'s': 'Q000', 'e': '.flac', 'bitrate': 'Atmos 2'},
-            'atmos_51': {'s': 'Q001', 'e': '.flac', 'bitrate': 'Atmos 5.1'},
-            'ogg_640': {'s': 'O801', 'e': '.ogg', 'bitrate': '640kbps'},
-            'ogg_320': {'s': 'O800', 'e': '.ogg', 'bitrate': '320kbps'},
-            'ogg_192': {'s': 'O600', 'e': '.ogg', 'bitrate': '192kbps'},
-            'ogg_96': {'s': 'O400', 'e': '.ogg', 'bitrate': '96kbps'},
-            'aac_192': {'s': 'C600', 'e': '.m4a', 'bitrate': '192kbps'},
-            'aac_96': {'s': 'C400', 'e': '.m4a', 'bitrate': '96kbps'},
-            'aac_48': {'s': 'C200', 'e': '.m4a', 'bitrate': '48kbps'}
+
+    def _parse_collection(self, kind, data):
+        """
+        解析曲目列表模块的 data，返回 (名称, 曲目总数, [track_info])，不存在时名称为 None
+        """
+        if kind == 'album':
+            tracks = [item.get('songInfo') or {} for item in data.get('songList') or []]
+            if not tracks and not data.get('totalNum'):
+                return None, 0, []
+            return data.get('albumName') or (tracks[0].get('album') or {}).get('name', ''), data.get('totalNum', len(tracks)), tracks
+        info = data.get('dirinfo') or {}
+        tracks = data.get('songlist') or []
+        if not info and not tracks:
+            return None, 0, []
+        return info.get('title', ''), data.get('total_song_num') or info.get('songnum') or len(tracks), tracks
+
+    def get_song_bundle(self, mid, sid, file_types, lyric=True, prefer=False):
+        """
+        已知 mid 和 id 时，将歌曲详情、vkey 和歌词合并为一次 musicu.fcg 请求
+
+        返回与 /song 相同结构的 {'song', 'lyric', 'music_urls'}，lyric=False 时不请求歌词，
+        prefer=True 时 music_urls 只保留按 file_types 顺序第一个可用的音质
+        """
+        output = self._stored_bundle(mid, sid, lyric)
+        if output:
+            # 详情与歌词都已在本地存储中，只需请求 vkey
+            sizes = output['song'].get('sizes')
+            get_urls = self.get_preferred_url if prefer else self.get_music_urls
+            output['music_urls'] = get_urls(mid, file_types, sizes)
+            return output
+        if negative_cache.get(('song', mid, sid, self.cookie_id)):
+            return {'song': {'msg': '信息获取错误/歌曲不存在'}, 'music_urls': {}}
+
+        key = ('bundle', mid, sid, tuple(file_types), lyric, prefer, self.cookie_id)
+        return dict(self.flight.do(key, lambda: self._fetch_bundle(mid, sid, file_types, lyric, prefer)))
+
+    def _stored_bundle(self, mid, sid, lyric):
+        """
+        从本地存储读取 {'song', 'lyric'}，缺少任一所需部分时返回 None
+        """
+        song = self._stored_song(mid, sid)
+        if not song:
+            return None
+        output = {'song': song}
+        if lyric:
+            output['lyric'] = self._stored_lyric(song['mid'], song['id'])
+            if output['lyric'] is None:
+                return None
+        return output
+
+    def _fetch_bundle(self, mid, sid, file_types, lyric, prefer):
+        if prefer:
+            file_types = self._preferred_candidates(mid, file_types, None)
+        self.warmer.track(mid, file_types)
+        urls, missing = self._cached_urls(mid, file_types)
+        # 共享缓存后端下合并请求只带本节点抢到锁的音质，其余音质等待持有锁的节点
+        keys = [(mid, file_type, self.cookie_id) for file_type in missing]
+        mine = self._claim(keys) if self.url_cache.shared else keys
+        missing = [key[1] for key in mine]
+        files = self._files(mid, missing)
+        account = self._pick_account(missing)
+        fetched = None
+        try:
+            data = self._post_json(self.base_url, account=account, op='bundle', json=self._bundle_request(mid, sid, files, lyric))
+            output = self._parse_bundle(data, mid, sid, file_types, files, urls)
+            fetched = {key: urls.get(key[1]) for key in mine}
+        finally:
+            if self.url_cache.shared and mine:
+                self._release(mine, fetched)
+        self._report_urls(account, {file_type: file_type for file_type in missing}, output['music_urls'], data.get('req_1', {}).get('data', {}))
+        others = [key for key in keys if key not in mine]
+        if others and 'msg' not in output['song']:
+            fetch = lambda pending: self._fetch_urls(mid, [key[1] for key in pending])
+            urls.update(self._flight_urls(self._wait_shared(others, fetch)))
+            output['music_urls'] = self._bundle_urls(output['song'], file_types, urls)
+        if prefer:
+            output['music_urls'] = first_available(output['music_urls'], file_types)
+        return output
+
+    def _bundle_urls(self, song, file_types, urls):
+        return self._apply_sizes({file_type: urls[file_type] for file_type in file_types if file_type in urls}, song.get('sizes', {}))
+
+    def _bundle_request(self, mid, sid, files, lyric=True):
+        """
+        构造详情、歌词、vkey 三个模块合并后的请求体
+        """
+        req_data = {
+            'detail': self._detail_module(mid, sid),
+            'loginUin': self.uin,
+            'comm': self._comm(),
         }
-        self.song_url = 'https://c.y.qq.com/v8/fcg-bin/fcg_play_single_song.fcg'
-        self.lyric_url = 'https://c.y.qq.com/lyric/fcgi-bin/fcg_query_lyric_new.fcg'
+        if lyric:
+            req_data['lyric'] = self._lyric_module(sid)
+        if files:
+            req_data['req_1'] = self._vkey_module(list(files), [mid] * len(files))
+        return req_data
 
-    def set_cookies(self, cookie_str):
-        cookies = {}
-        for cookie in cookie_str.split('; '):
-            key, value = cookie.split('=', 1)
-            cookies[key] = value
-        self.cookies = cookies
+    def _parse_bundle(self, data, mid, sid, file_types, files, urls):
+        """
+        将合并请求的返回拆分为 /song 的 song、lyric、music_urls 结构，urls 为已缓存的音质
+        """
+        song = self._parse_detail(data, 'detail', mid, sid)
+        output = {'song': song}
+        if 'lyric' in data:
+            try:
+                output['lyric'] = self._remember_lyric(sid, self._parse_lyric(data['lyric']['data']))
+            except Exception as e:
+                logger.warning("Error fetching lyrics: %s", e)
+                output['lyric'] = {'error': '无法获取歌词'}
 
-    def ids(self, url):
+        if files:
+            urls.update(self._store_urls(mid, module_data(data, 'req_1'), files))
+
+        output['music_urls'] = self._bundle_urls(song, file_types, urls)
+        return output
+
+class AsyncQQMusic(QQMusic):
+    """
+    QQMusic 的异步版本，请求体构造与解析逻辑与同步版共用，上游请求使用 aiohttp
+    """
+
+    def __init__(self, session=None):
+        if aiohttp is None:
+            raise RuntimeError('AsyncQQMusic requires aiohttp: pip install aiohttp')
+        super().__init__(session=session or get_async_session())
+        self.flight = async_flight
+
+    async def _offload(self, func, *args, **kwargs):
         """
-        从不同类型的 URL 中提取歌曲 ID，支持重定向和 /songDetail/ URL 形式
+        在线程池中执行会读写缓存后端或本地存储的同步方法：RedisCache/SQLite 的调用是阻塞的，
+        直接在事件循环中调用时，后端变慢或不可用会卡住本进程中所有进行中的请求；
+        复制当前上下文，使其中记录的 span 仍挂在本次请求的追踪下
         """
-        # 如果URL中包含 'c6.y.qq.com'，则发送请求获取重定向后的URL
-        if 'c6.y.qq.com' in url:
-            response = requests.get(url, allow_redirects=False)
-            url = response.headers.get('Location')  # 获取重定向的URL
-
-        # 检查重定向后的URL中是否包含 'y.qq.com'，并根据情况提取 id
-        if 'y.qq.com' in url:
-            # 处理 /songDetail/ 形式的 URL
-            if '/songDetail/' in url:
-                index = url.find('/songDetail/') + len('/songDetail/')
-                song_id = url[index:].split('/')[0]  # 提取 '/songDetail/' 后面的部分
-                return song_id
-            
-            # 如果是带 id= 参数的 URL，提取 id 参数
-            if 'id=' in url:
-                index = url.find('id=') + 3
-                song_id = url[index:].split('&')[0]  # 提取 'id' 的值
-                return song_id
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(None, partial(context.run, func, *args, **kwargs))
 
-        # 如果都不匹配，返回 None
-        return None
+    async def _post_json(self, url, account=None, op='other', **kwargs):
+        host = urlparse(url).hostname
+        if account is None:
+            account = self._pick_account()
+        cookies = self.cookies if account is None else account.cookies
+        start = time.perf_counter()
+        await self.limiter.acquire_async(host)
+        started = time.perf_counter()
+        metrics.inc('qqmusic_upstream_wait_seconds_total', (('host', host),), started - start)
+        labels = (('op', op),)
+        metrics.inc('qqmusic_upstream_in_flight', labels)
+        try:
+            with trace_span(f'upstream.{op}'):
+                async with self.session.post(url, cookies=cookies, headers=self.headers, **kwargs) as response:
+                    # 上游返回的 Content-Type 不一定是 application/json
+                    data = await response.json(content_type=None) if response.status < 400 else None
+                    ok = response.status not in THROTTLE_STATUS and not upstream_code(data)
+                    metrics.inc('qqmusic_upstream_requests_total', labels + (('result', 'ok' if ok else 'throttled'),))
+                    self.limiter.report(host, ok)
+                    self._report_account(account, not ok)
+                    response.raise_for_status()
+                    return upstream_json(data, op)
+        except (aiohttp.ClientConnectionError, ValueError) as e:
+            # ValueError 只会来自 response.json()：返回体不是 JSON，与同步版一样按上游错误（502）处理
+            metrics.inc('qqmusic_upstream_requests_total', labels + (('result', 'error'),))
+            self.limiter.report(host, False)
+            self._report_account(account, True)
+            if isinstance(e, ValueError):
+                raise UpstreamError(f'upstream {op} returned invalid JSON: {e}') from e
+            raise
+        finally:
+            metrics.inc('qqmusic_upstream_in_flight', labels, -1)
+            metrics.observe('qqmusic_upstream_duration_seconds', labels, time.perf_counter() - started)
 
-    def get_music_url(self, songmid, file_type='flac'):
+    async def ids(self, url):
+        """
+        从不同类型的 URL 中提取歌曲 ID，支持重定向和 /songDetail/ URL 形式
+        """
+        if is_short_link(url):
+            location = short_link_cache.get(url)
+            if location is None:
+                await self.limiter.acquire_async(urlparse(url).hostname)
+                started = time.perf_counter()
+                with trace_span('upstream.redirect'):
+                    async with self.session.get(url, allow_redirects=False) as response:
+                        location = response.headers.get('Location')
+                metrics.inc('qqmusic_upstream_requests_total', (('op', 'redirect'), ('result', 'ok')))
+                metrics.observe('qqmusic_upstream_duration_seconds', (('op', 'redirect'),), time.perf_counter() - started)
+                if location:
+                    await self._offload(short_link_cache.set, url, location)
+            url = location
+        return self._parse_song_id(url)
+
+    async def get_music_url(self, songmid, file_type='flac'):
         """
         获取音乐播放URL
         """
         if file_type not in self.file_config:
             raise ValueError("Invalid file_type. Choose from 'm4a', '128', '320', 'flac', 'ape', 'dts")
 
-        file_info = self.file_config[file_type]
-        file = f"{file_info['s']}{songmid}{songmid}{file_info['e']}"
+        return (await self.get_music_urls(songmid, [file_type])).get(file_type)
 
-        req_data = {
-            'req_1': {
-                'module': 'vkey.GetVkeyServer',
-                'method': 'CgiGetVkey',
-                'param': {
-                    'filename': [file],
-                    'guid': self.guid,
-                    'songmid': [songmid],
-                    'songtype': [0],
-                    'uin': self.uin,
-                    'loginflag': 1,
-                    'platform': '20',
-                },
-            },
-            'loginUin': self.uin,
-            'comm': {
-                'uin': self.uin,
-                'format': 'json',
-                'ct': 24,
-                'cv': 0,
-            },
-        }
+    async def get_music_urls(self, songmid, file_types, sizes=None):
+        """
+        一次 CgiGetVkey 请求批量获取多种音质的播放URL
+        """
+        sizes = sizes or {}
+        file_types = [file_type for file_type in file_types if sizes.get(file_type) != 0]
+        self.warmer.track(songmid, file_types)
+        urls, missing = await self._offload(self._cached_urls, songmid, file_types)
+        if missing:
+            keys = [(songmid, file_type, self.cookie_id) for file_type in missing]
+            fetch = lambda pending: self._fetch_urls(songmid, [key[1] for key in pending])
+            fetched = await self.flight.do_many(keys, lambda pending: self._fetch_shared(pending, fetch))
+            urls.update(self._flight_urls(fetched))
+        return self._apply_sizes({file_type: urls[file_type] for file_type in file_types if file_type in urls}, sizes)
 
-        response = requests.post(self.base_url, json=req_data, cookies=self.cookies, headers=self.headers)
-        data = response.json()
-        purl = data['req_1']['data']['midurlinfo'][0]['purl']
-        if purl == '':
-            # VIP
-            return None
+    async def _fetch_urls(self, songmid, file_types):
+        files = self._files(songmid, file_types)
+        account = self._pick_account(file_types)
+        data = module_data(await self._post_json(self.base_url, account=account, op='vkey', json=self._vkey_request(songmid, files)), 'req_1')
+        urls = await self._offload(self._store_urls, songmid, data, files)
+        self._report_urls(account, {file_type: file_type for file_type in file_types}, urls, data)
+        return {(songmid, file_type, self.cookie_id): urls.get(file_type) for file_type in file_types}
+
+    async def _fetch_shared(self, keys, fetch):
+        """
+        QQMusic._fetch_shared 的异步版本，锁与标记的读写在线程池中执行
+        """
+        if not self.url_cache.shared:
+            return await fetch(keys)
 
-        url = data['req_1']['data']['sip'][1] + purl
-        prefix = purl[:4]
-        bitrate = next((info['bitrate'] for key, info in self.file_config.items() if info['s'] == prefix), '')
+        mine = await self._offload(self._claim, keys)
+        results = {}
+        if mine:
+            fetched = None
+            try:
+                fetched = await fetch(mine)
+            finally:
+                await self._offload(self._release, mine, fetched)
+            results.update(fetched)
+        results.update(await self._wait_shared([key for key in keys if key not in mine], fetch))
+        return results
 
-        return {'url': url.replace("http://", "https://"), 'bitrate': bitrate}
+    async def _wait_shared(self, others, fetch):
+        results = {}
+        retry = []
+        deadline = time.monotonic() + CACHE_LOCK_WAIT
+        while others and time.monotonic() < deadline:
+            await asyncio.sleep(CACHE_LOCK_POLL)
+            found, failed = await self._offload(self._poll_shared, others)
+            results.update(found)
+            retry += failed
+            others = [key for key in others if key not in found and key not in failed]
+        retry += others
+        if retry:
+            results.update(await fetch(retry))
+        return results
 
-    def get_music_song(self, mid, sid):
+    async def get_music_song(self, mid, sid):
         """
         获取歌曲信息
         """
-        if sid != 0:
-            # 如果有 songid（sid），使用 songid 进行请求
-            req_data = {
-                'songid': sid,
-                'platform': 'yqq',
-                'format': 'json',
-            }
-        else:
-            # 如果没有 songid，使用 songmid 进行请求
-            req_data = {
-                'songmid': mid,
-                'platform': 'yqq',
-                'format': 'json',
-            }
+        info = await self._offload(self._stored_song, mid, sid)
+        if info:
+            return info
+        if negative_cache.get(('song', mid, sid, self.cookie_id)):
+            return {'msg': '信息获取错误/歌曲不存在'}
 
-        # 发送请求并解析返回的 JSON 数据
-        response = requests.post(self.song_url, data=req_data, cookies=self.cookies, headers=self.headers)
-        data = response.json()
-        #return data
-        # 确保数据结构存在，避免索引错误
-        if 'data' in data and len(data['data']) > 0:
-            song_info = data['data'][0]
-            album_info = song_info.get('album', {})
-            singers = song_info.get('singer', [])
-            singer_names = ', '.join([singer.get('name', 'Unknown') for singer in singers])
+        return dict(await self.flight.do(('song', mid, sid, self.cookie_id), lambda: self._fetch_song(mid, sid)))
 
-            # 获取专辑封面图片 URL
-            album_mid = album_info.get('mid')
-            img_url = f'https://y.qq.com/music/photo_new/T002R800x800M000{album_mid}.jpg?max_age=2592000' if album_mid else 'https://axidiqolol53.objectstorage.ap-seoul-1.oci.customer-oci.com/n/axidiqolol53/b/lusic/o/resources/cover.jpg'
+    async def _fetch_song(self, mid, sid):
+        data = await self._post_json(self.song_url, op='detail', data=self._song_request(mid, sid))
+        return await self._offload(self._parse_song, data, mid, sid)
 
-            # 返回处理后的歌曲信息
-            return {
-                'name': song_info.get('name', 'Unknown'),
-                'album': album_info.get('name', 'Unknown'),
-                'singer': singer_names,
-                'pic': img_url,
-                'mid': song_info.get('mid', mid),
-                'id': song_info.get('id', sid)
-            }
-        else:
-            return {'msg': '信息获取错误/歌曲不存在'}
+    async def get_music_lyric_new(self, songid):
+        """
+        从QQ音乐电脑客户端接口获取歌词
+        """
+        lyric = await self._offload(self._stored_lyric, sid=songid)
+        if lyric:
+            return lyric
+        return await self.flight.do(('lyric', songid, self.cookie_id), lambda: self._fetch_lyric(songid))
 
-    def get_music_lyric(self, mid):
+    async def _fetch_lyric(self, songid):
+        try:
+            d = await self._post_json(self.base_url, op='lyric', json=self._lyric_payload(songid))
+            lyric = self._parse_lyric(d["music.musichallSong.PlayLyricInfo.GetPlayLyricInfo"]["data"])
+            return await self._offload(self._remember_lyric, songid, lyric)
+        except Exception as e:
+            logger.warning("Error fetching lyrics: %s", e)
+            return {'error': '无法获取歌词'}
+
+    async def get_preferred_url(self, songmid, file_types, sizes=None):
         """
-        获取歌曲歌词 - 旧版歌词接口
+        按偏好顺序返回第一个可用音质
         """
-        # 构造请求 URL
-        url = 'https://c.y.qq.com/lyric/fcgi-bin/fcg_query_lyric_new.fcg'
-        params = {
-            '_': str(int(time.time())),  # 当前时间戳
-            'format': 'json',
-            'loginUin': ''.join(random.sample('1234567890', 10)),  # 随机生成的登录 UIN
-            'songmid': mid  # 歌曲 MID
-        }
+        candidates = await self._offload(self._preferred_candidates, songmid, file_types, sizes)
+        return first_available(await self.get_music_urls(songmid, candidates, sizes), candidates)
 
+    async def get_song_bundle(self, mid, sid, file_types, lyric=True, prefer=False):
+        """
+        已知 mid 和 id 时，将歌曲详情、vkey 和歌词合并为一次 musicu.fcg 请求
+        """
+        output = await self._offload(self._stored_bundle, mid, sid, lyric)
+        if output:
+            sizes = output['song'].get('sizes')
+            get_urls = self.get_preferred_url if prefer else self.get_music_urls
+            output['music_urls'] = await get_urls(mid, file_types, sizes)
+            return output
+        if negative_cache.get(('song', mid, sid, self.cookie_id)):
+            return {'song': {'msg': '信息获取错误/歌曲不存在'}, 'music_urls': {}}
+
+        key = ('bundle', mid, sid, tuple(file_types), lyric, prefer, self.cookie_id)
+        return dict(await self.flight.do(key, lambda: self._fetch_bundle(mid, sid, file_types, lyric, prefer)))
+
+    async def _fetch_bundle(self, mid, sid, file_types, lyric, prefer):
+        if prefer:
+            file_types = await self._offload(self._preferred_candidates, mid, file_types, None)
+        self.warmer.track(mid, file_types)
+        urls, missing = await self._offload(self._cached_urls, mid, file_types)
+        keys = [(mid, file_type, self.cookie_id) for file_type in missing]
+        mine = await self._offload(self._claim, keys) if self.url_cache.shared else keys
+        missing = [key[1] for key in mine]
+        files = self._files(mid, missing)
+        account = self._pick_account(missing)
+        fetched = None
         try:
-            # 发送 GET 请求获取歌词数据
-            response = requests.get(url, headers=self._headers, cookies=self.cookies, params=params)
-            response.raise_for_status()  # 检查请求是否成功
-            data = response.json()
-            print(data)
-            # 从返回的 JSON 数据中获取歌词
-            lyric = data.get('lyric', '')
-            if lyric:
-                # 解码并返回歌词
-                return base64.b64decode(lyric).decode('utf-8')
+            data = await self._post_json(self.base_url, account=account, op='bundle', json=self._bundle_request(mid, sid, files, lyric))
+            output = await self._offload(self._parse_bundle, data, mid, sid, file_types, files, urls)
+            fetched = {key: urls.get(key[1]) for key in mine}
+        finally:
+            if self.url_cache.shared and mine:
+                await self._offload(self._release, mine, fetched)
+        self._report_urls(account, {file_type: file_type for file_type in missing}, output['music_urls'], data.get('req_1', {}).get('data', {}))
+        others = [key for key in keys if key not in mine]
+        if others and 'msg' not in output['song']:
+            fetch = lambda pending: self._fetch_urls(mid, [key[1] for key in pending])
+            urls.update(self._flight_urls(await self._wait_shared(others, fetch)))
+            output['music_urls'] = self._bundle_urls(output['song'], file_types, urls)
+        if prefer:
+            output['music_urls'] = first_available(output['music_urls'], file_types)
+        return output
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _endpoint_labels():
+    # 未匹配路由的请求归为一类，避免任意路径产生大量标签
+    return (('endpoint', request.url_rule.rule if request.url_rule else 'unmatched'),)
+
+
+@app.before_request
+def _start_request_metrics():
+    g.request_start = time.perf_counter()
+    metrics.inc('qqmusic_http_in_flight', _endpoint_labels())
+
+
+@app.after_request
+def _record_request_metrics(response):
+    labels = _endpoint_labels()
+    metrics.inc('qqmusic_http_requests_total', labels + (('status', response.status_code),))
+    metrics.observe('qqmusic_http_request_duration_seconds', labels, time.perf_counter() - g.request_start)
+    return response
+
+
+@app.teardown_request
+def _end_request_metrics(exc):
+    metrics.inc('qqmusic_http_in_flight', _endpoint_labels(), -1)
+
+
+@app.before_request
+def _start_request_trace():
+    g.trace, g.trace_token = start_trace()
+
+
+@app.after_request
+def _add_server_timing(response):
+    # 流式响应的头部先于后续各段发送，只包含此前已结束的 span
+    response.headers['Server-Timing'] = server_timing(g.trace)
+    return response
+
+
+@app.teardown_request
+def _end_request_trace(exc):
+    if 'trace' in g:
+        end_trace(g.trace, g.trace_token)
+        log_slow_request(g.trace, request.full_path)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus 抓取接口
+    """
+    return Response(metrics.render(collect_gauges()), content_type=METRICS_CONTENT_TYPE)
+
+
+class SongError(Exception):
+    """
+    /song 解析失败，status 为返回的 HTTP 状态码
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def iter_song(qqmusic, song_url, options, resolved=None):
+    """
+    逐段解析 /song 的结果，按 song、music_urls、lyric 的顺序 yield (段名, 内容)
+
+    传入 resolved 时写入解析出的 resolved['mid']；
+    span 只包住各段的计算，不跨越 yield，否则调用方的耗时也会记到该 span 下
+    """
+    resolved = {} if resolved is None else resolved
+    file_types = options['file_types']
+
+    # URL 同时带有 songmid 和 songid 时，详情、vkey、歌词合并为一次请求
+    with trace_span('parse'):
+        both = qqmusic.song_ids(song_url)
+        # 否则从传入的 URL 中提取 songmid 或 songid，短链接在这一步跳转
+        songmid = None if both else qqmusic.ids(song_url)
+    if both and (options['detail'] or options['lyric']):
+        with trace_span('bundle'):
+            output = qqmusic.get_song_bundle(both[0], both[1], file_types, lyric=options['lyric'], prefer=options['prefer'])
+        if 'msg' in output['song']:
+            raise SongError(output['song']['msg'], 404)
+        resolved['mid'] = both[0]
+        if options['detail']:
+            yield 'song', output['song']
+        if file_types:
+            yield 'music_urls', output['music_urls']
+        if 'lyric' in output:
+            yield 'lyric', output['lyric']
+        return
+
+    if both:
+        mid, sid = both
+    else:
+        if not songmid:
+            raise SongError('unsupported url')
+        mid, sid = split_song_id(songmid)
+
+    # 只有需要返回详情、缺少 mid，或需要歌词但缺少 id 时才请求歌曲信息
+    info = {'mid': mid, 'id': sid}
+    if options['detail'] or not mid or (options['lyric'] and not sid):
+        with trace_span('detail'):
+            info = qqmusic.get_music_song(mid, sid)
+        if 'msg' in info:
+            raise SongError(info['msg'], 404)
+    resolved['mid'] = info['mid']
+    if options['detail']:
+        yield 'song', info
+
+    if file_types:
+        # 一次请求获取所有文件类型对应的音乐 URL
+        with trace_span('urls'):
+            if options['prefer']:
+                urls = qqmusic.get_preferred_url(info['mid'], file_types, info.get('sizes'))
             else:
-                return "未找到歌词"
+                urls = qqmusic.get_music_urls(info['mid'], file_types, info.get('sizes'))
+        yield 'music_urls', urls
+    if options['lyric']:
+        with trace_span('lyric'):
+            lyric = qqmusic.get_music_lyric_new(info['id'])
+        yield 'lyric', lyric
 
-        except requests.RequestException as e:
-            return f"请求错误: {e}"
-        except Exception as e:
-            return f"解码错误: {e}"
 
-    def get_music_lyric_new(self, songid):
-        """从QQ音乐电脑客户端接口获取歌词
+@app.route('/stream', methods=['GET'])
+def get_stream():
+    """
+    音频代理：按 mid（或 url）与 type 解析播放链接，分块转发音频，支持 Range 拖动
 
-        参数:
-            songID (str): 音乐id
+    启用本地音频缓存时，已缓存的文件直接从磁盘发送，未缓存的文件在转发的同时于后台下载到缓存；
+    设置 AUDIO_ACCEL_REDIRECT 后缓存命中交给前置的 nginx 发送
+    """
+    file_type = request.args.get('type', 'flac')
+    if file_type not in FILE_CONFIG:
+        return jsonify({"error": f"unsupported type: {file_type}"}), 400
+    qqmusic = QQMusic()
+    mid = request.args.get('mid')
+    try:
+        if not mid and request.args.get('url'):
+            songmid = qqmusic.ids(request.args['url'])
+            if songmid:
+                mid, sid = split_song_id(songmid)
+                if not mid:
+                    # 只有 songid 时需要从歌曲详情中取 mid，歌曲不存在时返回详情中的提示
+                    info = qqmusic.get_music_song(0, sid)
+                    if not info.get('mid'):
+                        return jsonify({"error": info.get('msg', '信息获取错误/歌曲不存在')}), 404
+                    mid = info['mid']
+        if not mid:
+            return jsonify({"error": "mid or url parameter is required"}), 400
+        if not SONGMID_RE.fullmatch(mid):
+            return jsonify({"error": f"invalid mid: {mid}"}), 400
+        audio_cache = get_audio_cache()
+        if audio_cache is not None:
+            path = audio_cache.get(mid, file_type)
+            if path is not None and AUDIO_ACCEL_REDIRECT:
+                mimetype = AUDIO_MIME_TYPES[FILE_CONFIG[file_type]['e']]
+                return Response(mimetype=mimetype, headers={
+                    'X-Accel-Redirect': AUDIO_ACCEL_REDIRECT + os.path.basename(path)})
+            if path is not None:
+                # conditional=True 时由 send_file 处理 Range 与 If-Modified-Since
+                return send_file(path, mimetype=AUDIO_MIME_TYPES[FILE_CONFIG[file_type]['e']], conditional=True)
+        upstream = qqmusic.open_stream(mid, file_type, request.headers.get('Range'))
+    except requests.RequestException as e:
+        return jsonify({"error": str(e)}), 502
+    if upstream is None:
+        return jsonify({"error": f"{file_type} is not available"}), 404
+    if upstream.status_code >= 400 and upstream.status_code != 416:
+        upstream.close()
+        return jsonify({"error": f"upstream returned {upstream.status_code}"}), 502
+    if audio_cache is not None:
+        audio_cache.prefetch(qqmusic, mid, file_type)
 
-        返回值:
-            dict: 通过['lyric']和['trans']来获取base64后的歌词内容
+    def generate():
+        # 每次只持有一个块，内存占用与文件大小无关
+        for chunk in upstream.iter_content(STREAM_CHUNK_SIZE):
+            yield chunk
 
-            其中 lyric为原文歌词 trans为翻译歌词
-        """
-        #url = "https://u.y.qq.com/cgi-bin/musicu.fcg"
-        payload = {
-            "music.musichallSong.PlayLyricInfo.GetPlayLyricInfo": {
-                "module": "music.musichallSong.PlayLyricInfo",
-                "method": "GetPlayLyricInfo",
-                "param": {
-                    "trans_t": 0,
-                    "roma_t": 0,
-                    "crypt": 0,  # 1 define to encrypt
-                    "lrc_t": 0,
-                    "interval": 208,
-                    "trans": 1,
-                    "ct": 6,
-                    "singerName": "",
-                    "type": 0,
-                    "qrc_t": 0,
-                    "cv": 80600,
-                    "roma": 1,
-                    "songID": songid,
-                    "qrc": 0,  # 1 define base64 or compress Hex
-                    "albumName": "",
-                    "songName": "",
-                },
-            },
-            "comm": {
-                "wid": "",
-                "tmeAppID": "qqmusic",
-                "authst": "",
-                "uid": "",
-                "gray": "0",
-                "OpenUDID": "",
-                "ct": "6",
-                "patch": "2",
-                "psrf_qqopenid": "",
-                "sid": "",
-                "psrf_access_token_expiresAt": "",
-                "cv": "80600",
-                "gzip": "0",
-                "qq": "",
-                "nettype": "2",
-                "psrf_qqunionid": "",
-                "psrf_qqaccess_token": "",
-                "tmeLoginType": "2",
-            },
-        }
+    headers = {name: upstream.headers[name] for name in STREAM_FORWARD_HEADERS if name in upstream.headers}
+    response = Response(generate(), status=upstream.status_code, headers=headers, direct_passthrough=True)
+    response.call_on_close(upstream.close)
+    return response
 
-        # 发送请求获取歌词
-        try:
-            res = requests.post(self.base_url, json=payload, cookies=self.cookies, headers=self.headers)  # 确保使用 POST 请求
-            res.raise_for_status()  # 检查请求是否成功
-            d = res.json()  # 解析返回的 JSON 数据
-            
-            # 提取歌词数据
-            lyric_data = d["music.musichallSong.PlayLyricInfo.GetPlayLyricInfo"]["data"]
-            # 处理歌词内容
-            if 'lyric' in lyric_data and lyric_data['lyric']:
-                # 解码歌词
-                lyric = base64.b64decode(lyric_data['lyric']).decode('utf-8')
-                tylyric = base64.b64decode(lyric_data['trans']).decode('utf-8')
+
+def ndjson_response(records):
+    """
+    以换行分隔的 JSON 流式返回，每条记录就绪后立即发送
+    """
+    def generate():
+        for record in records:
+            yield json.dumps(record) + '\n'
+    return Response(generate(), content_type='application/x-ndjson')
+
+
+def _song_records(first, parts):
+    """
+    将 iter_song 的结果转换为流式记录，每个音质单独一条
+    """
+    try:
+        for section, value in itertools.chain([first], parts):
+            if section == 'music_urls':
+                for file_type, result in value.items():
+                    yield {'type': 'music_url', 'file_type': file_type, 'data': result}
             else:
-                lyric = ''  # 没有歌词的情况下返回空字符串
-                tylyric = ''  # 没有歌词的情况下返回空字符串
-            return {'lyric': lyric,'tylyric': tylyric}  # 返回包含歌词的字典
+                yield {'type': section, 'data': value}
+    except (SongError, requests.RequestException) as e:
+        # 响应已经开始发送，错误作为最后一条记录返回
+        yield {'type': 'error', 'error': str(e)}
+
+
+def dump_json(value):
+    """
+    序列化为 UTF-8 编码的 JSON bytes，安装了 orjson 时使用 orjson
+    """
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+
+def song_response_key(song_url, options, cookie_id):
+    return (song_url, tuple(options['file_types']), options['prefer'], options['lyric'], options['detail'], cookie_id)
+
+
+def render_song(qqmusic, key, output, mid):
+    """
+    序列化 /song 的输出并写入响应缓存，返回缓存条目 {'body', 'etag', 'expires', 'mid', 'types'}
+
+    有效期取 music_urls 中各播放链接在 url_cache 中的最短剩余时间，剩余不足 1 秒时不缓存；
+    任一部分获取失败（如歌词返回 error）时有效期为 0，避免一次临时错误被缓存到链接过期
+    """
+    with trace_span('serialize'):
+        body = dump_json(output)
+    urls = output.get('music_urls') or {}
+    ttl = SONG_RESPONSE_TTL
+    if any(isinstance(section, dict) and 'error' in section for section in output.values()):
+        ttl = 0
+    elif urls:
+        keys = [(mid, file_type, qqmusic.cookie_id) for file_type in urls]
+        remaining = qqmusic.url_cache.remaining_many(keys)
+        ttl = min(remaining.get(key, 0) for key in keys)
+    entry = {'body': body, 'etag': hashlib.sha1(body).hexdigest(), 'expires': time.monotonic() + ttl,
+             'mid': mid, 'types': list(urls)}
+    if ttl >= 1:
+        song_response_cache.set(key, entry, ttl)
+    return entry
+
+
+def cached_song(qqmusic, key):
+    """
+    取出缓存的 /song 响应，命中时仍计入预热器的请求频率
+    """
+    entry = song_response_cache.get(key)
+    if entry is not None and entry['types']:
+        qqmusic.warmer.track(entry['mid'], entry['types'])
+    return entry
+
+
+def song_headers(entry):
+    max_age = int(entry['expires'] - time.monotonic())
+    # 未写入响应缓存的结果（部分失败或链接即将过期）也不允许客户端与 CDN 缓存
+    cache_control = f'public, max-age={max_age}' if max_age >= 1 else 'no-store'
+    return {'ETag': quote_etag(entry['etag']), 'Cache-Control': cache_control}
+
+
+def etag_matches(if_none_match, etag):
+    """
+    If-None-Match 使用弱比较，* 匹配任意 ETag
+    """
+    return bool(if_none_match) and parse_etags(if_none_match).contains_weak(etag)
 
-        except Exception as e:
-            print(f"Error fetching lyrics: {e}")
-            return {'error': '无法获取歌词'}
 
 @app.route('/song', methods=['GET'])
 def get_song():
     song_url = request.args.get('url')
     if not song_url:
         return jsonify({"error": "url parameter is required"}), 400
+    try:
+        options = parse_song_options(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     qqmusic = QQMusic()
-    qqmusic.set_cookies(cookie_str)
 
-    # 从传入的 URL 中提取 songmid 或 songid
-    songmid = qqmusic.ids(song_url)
+    if _flag(request.args.get('stream'), default=False):
+        parts = iter_song(qqmusic, song_url, options)
+        # 先解析出第一段，URL 无效或歌曲不存在时仍返回对应的状态码
+        try:
+            first = next(parts, None)
+        except SongError as e:
+            return jsonify({"error": str(e)}), e.status
+        except requests.RequestException as e:
+            return jsonify({"error": f"请求错误: {e}"}), 502
+        if first is None:
+            return ndjson_response([])
+        return ndjson_response(_song_records(first, parts))
+
+    # debug 需要本次请求的 trace，不使用响应缓存
+    debug = _flag(request.args.get('debug'), default=False)
+    key = song_response_key(song_url, options, qqmusic.cookie_id)
+    entry = None if debug else cached_song(qqmusic, key)
+    if entry is None:
+        resolved = {}
+        try:
+            sections = dict(iter_song(qqmusic, song_url, options, resolved))
+        except SongError as e:
+            return jsonify({"error": str(e)}), e.status
+        except requests.RequestException as e:
+            return jsonify({"error": f"请求错误: {e}"}), 502
+
+        # 构造 JSON 输出
+        output = {section: sections[section] for section in ('song', 'lyric', 'music_urls') if section in sections}
+        if debug:
+            output['trace'] = trace_tree(g.trace)
+            with trace_span('serialize'):
+                return Response(dump_json(output), content_type='application/json')
+        entry = render_song(qqmusic, key, output, resolved.get('mid'))
+
+    if etag_matches(request.headers.get('If-None-Match'), entry['etag']):
+        return Response(status=304, headers=song_headers(entry))
+    return Response(entry['body'], content_type='application/json', headers=song_headers(entry))
+
+def _bulk_options(body):
+    """
+    解析 /songs 请求体中的 types / prefer，支持逗号分隔的字符串或列表
+    """
+    args = {}
+    for key in ('types', 'prefer'):
+        value = body.get(key)
+        if value is not None:
+            args[key] = value if isinstance(value, str) else ','.join(value)
+    return parse_song_options(args)
+
+
+def _bulk_request():
+    """
+    解析批量请求的请求体，返回 (body, options)，格式错误时抛出 ValueError
+    """
+    body = request.get_json(silent=True)
+    if isinstance(body, list):
+        body = {'urls': body}
+    if not isinstance(body, dict) or not isinstance(body.get('urls'), list):
+        raise ValueError("urls list is required")
+    if not all(isinstance(item, str) for item in body['urls']):
+        raise ValueError("urls must be strings")
+    if len(body['urls']) > BULK_MAX_ITEMS:
+        raise ValueError(f"at most {BULK_MAX_ITEMS} items per request")
+    return body, _bulk_options(body)
+
+
+def resolve_bulk(qqmusic, items, file_types, prefer=False):
+    """
+    批量解析歌曲，按 BULK_DETAIL_CHUNK_SIZE 分组，逐组 yield (输入, 结果)
 
-    # 文件类型处理
-    file_types = ['aac_48','aac_96','aac_192','ogg_96','ogg_192','ogg_320','ogg_640','atmos_51','atmos_2','master','flac','320','128']
-    results = {}
+    每组歌曲的详情合并为一次请求，vkey 合并为按 BULK_VKEY_CHUNK_SIZE 分批的请求
+    """
+    keys = {}
+    for item in dict.fromkeys(items):
+        if not item.strip():
+            yield item, {'error': 'invalid item'}
+            continue
+        value = item.strip()
+        try:
+            # 非 URL 的输入直接视为 songmid / songid
+            songmid = qqmusic.ids(value) if '/' in value else value
+        except requests.RequestException as e:
+            yield item, {'error': f'请求错误: {e}'}
+            continue
+        if not songmid:
+            yield item, {'error': 'unsupported url'}
+            continue
+        keys[item] = split_song_id(songmid)
+
+    for chunk in chunked(list(keys.items()), BULK_DETAIL_CHUNK_SIZE):
+        try:
+            infos = qqmusic.get_music_songs([key for _, key in chunk])
+            found = {key: info for key, info in infos.items() if 'msg' not in info}
+            urls = {}
+            if file_types and found:
+                sizes = {info['mid']: info.get('sizes') for info in found.values()}
+                urls = qqmusic.get_music_urls_bulk(list(sizes), file_types, sizes, prefer=prefer)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            for item, _ in chunk:
+                yield item, {'error': f'请求错误: {e}'}
+            continue
 
+        for item, key in chunk:
+            info = infos[key]
+            if 'msg' in info:
+                yield item, {'error': info['msg']}
+            else:
+                yield item, {'song': info, 'music_urls': urls.get(info['mid'], {})}
+
+
+@app.route('/songs', methods=['POST'])
+def get_songs():
+    """
+    批量解析：请求体为 {"urls": [...], "types": ..., "prefer": ..., "stream": ...} 或 URL/mid 列表
+    返回以输入为键的结果，单条失败时对应结果为 {"error": ...}；stream 时逐条返回 NDJSON
+    """
     try:
-        # 如果 songmid 是数字，视为 songid (sid)
-        sid = int(songmid)
-        mid = 0
-    except ValueError:
-        # 否则视为 songmid (mid)
-        sid = 0
-        mid = songmid
-    # 获取歌曲信息
-    info = qqmusic.get_music_song(mid, sid)
-    # 对于每种文件类型，获取对应的音乐 URL
-    for file_type in file_types:
-        result = qqmusic.get_music_url(info['mid'], file_type)
-        if result:
-            results[file_type] = result
-        time.sleep(0.1)
-    lyric =  qqmusic.get_music_lyric_new(info['id'])
-
-    # 构造 JSON 输出
-    output = {
-        'song': info,
-        'lyric': lyric,
-        'music_urls': results,
-    }
-    json_data = json.dumps(output)
+        body, options = _bulk_request()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    qqmusic = QQMusic()
+
+    results = resolve_bulk(qqmusic, body['urls'], options['file_types'], options['prefer'])
+    if body.get('stream') or _flag(request.args.get('stream'), default=False):
+        # 每首歌曲就绪后立即输出一条记录
+        return ndjson_response({'input': item, 'result': result} for item, result in results)
+
+    output = dict(results)
+    return Response(json.dumps(output), content_type='application/json')
+
+
+def resolve_tracks(qqmusic, songs, file_types, prefer=False, chunk_size=COLLECTION_CHUNK_SIZE):
+    """
+    按 chunk_size 逐组解析已知歌曲信息的播放链接，每组完成后逐首 yield {'song', 'music_urls'}
+
+    每组的 vkey 合并为按 BULK_VKEY_CHUNK_SIZE 分批的请求，失败的组返回 {'song', 'error'}
+    """
+    for chunk in chunked(songs, chunk_size):
+        urls = {}
+        if file_types:
+            sizes = {info['mid']: info.get('sizes') for info in chunk}
+            try:
+                with trace_span('urls'):
+                    urls = qqmusic.get_music_urls_bulk(list(sizes), file_types, sizes, prefer=prefer)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                for info in chunk:
+                    yield {'song': info, 'error': f'请求错误: {e}'}
+                continue
+        for info in chunk:
+            yield {'song': info, 'music_urls': urls.get(info['mid'], {})}
+
+
+@app.route('/collection', methods=['GET'])
+def get_collection():
+    """
+    专辑/歌单解析：获取全部曲目后按 chunk 逐组批量解析播放链接
+
+    stream=1 时以 NDJSON 先返回专辑/歌单信息，之后每组解析完成即逐首返回
+    """
+    url = request.args.get('url')
+    if not url:
+        return jsonify({"error": "url parameter is required"}), 400
+    try:
+        options = parse_song_options(request.args)
+        chunk_size = max(1, int(request.args.get('chunk', COLLECTION_CHUNK_SIZE)))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    qqmusic = QQMusic()
+    try:
+        with trace_span('parse'):
+            target = qqmusic.collection(url)
+        if target is None:
+            return jsonify({"error": "unsupported url"}), 400
+        with trace_span('tracks'):
+            collection = qqmusic.get_collection(*target)
+    except requests.RequestException as e:
+        return jsonify({"error": f"请求错误: {e}"}), 502
+    if 'msg' in collection:
+        return jsonify({"error": collection['msg']}), 404
+
+    tracks = resolve_tracks(qqmusic, collection.pop('songs'), options['file_types'], options['prefer'], chunk_size)
+    if _flag(request.args.get('stream'), default=False):
+        records = itertools.chain([{'type': 'collection', 'data': collection}], ({'type': 'song', 'data': track} for track in tracks))
+        return ndjson_response(records)
+
+    output = {'collection': collection, 'songs': list(tracks)}
+    with trace_span('serialize'):
+        json_data = json.dumps(output)
     return Response(json_data, content_type='application/json')
 
+
+def _admin_allowed():
+    """
+    校验 X-Admin-Token 请求头；未设置 ADMIN_TOKEN 时管理接口关闭。
+    不按来源地址放行：部署在本机反向代理之后时，所有请求的来源都是 127.0.0.1
+    """
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+
+
+@app.route('/admin/preload', methods=['POST'])
+def preload_songs():
+    """
+    预加载：请求体与 /songs 相同，批量解析后计入预热器热度，之后由后台线程保持缓存有效
+    返回 {"preloaded": 成功数量, "errors": {输入: 错误}}
+    """
+    if not _admin_allowed():
+        return jsonify({"error": "forbidden"}), 403
+    try:
+        body, options = _bulk_request()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    qqmusic = QQMusic()
+    preloaded = 0
+    errors = {}
+    for item, result in resolve_bulk(qqmusic, body['urls'], options['file_types']):
+        if 'error' in result:
+            errors[item] = result['error']
+            continue
+        preloaded += 1
+        qqmusic.warmer.track(result['song']['mid'], options['file_types'], weight=WARMER_PRELOAD_WEIGHT)
+    return jsonify({'preloaded': preloaded, 'errors': errors})
+
+async def async_get_song(request):
+    """
+    /song 的异步版本：歌曲详情返回后，vkey 与歌词并发请求
+    """
+    try:
+        return await _async_song(request)
+    except (aiohttp.ClientError, asyncio.TimeoutError, requests.RequestException) as e:
+        return web.json_response({"error": f"请求错误: {e}"}, status=502)
+
+
+async def _async_song(request):
+    song_url = request.query.get('url')
+    if not song_url:
+        return web.json_response({"error": "url parameter is required"}, status=400)
+    try:
+        options = parse_song_options(request.query)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    qqmusic = AsyncQQMusic()
+    file_types = options['file_types']
+    key = song_response_key(song_url, options, qqmusic.cookie_id)
+    if not _flag(request.query.get('debug'), default=False):
+        entry = cached_song(qqmusic, key)
+        if entry is not None:
+            return _async_cached_song(request, entry)
+
+    with trace_span('parse'):
+        both = qqmusic.song_ids(song_url)
+        songmid = None if both else await qqmusic.ids(song_url)
+    if both and (options['detail'] or options['lyric']):
+        with trace_span('bundle'):
+            output = await qqmusic.get_song_bundle(both[0], both[1], file_types, lyric=options['lyric'], prefer=options['prefer'])
+        if 'msg' in output['song']:
+            return web.json_response({"error": output['song']['msg']}, status=404)
+        if not options['detail']:
+            del output['song']
+        if not file_types:
+            del output['music_urls']
+        return await _async_song_response(request, qqmusic, key, output, both[0])
+
+    if both:
+        mid, sid = both
+    else:
+        if not songmid:
+            return web.json_response({"error": "unsupported url"}, status=400)
+        mid, sid = split_song_id(songmid)
+
+    info = {'mid': mid, 'id': sid}
+    if options['detail'] or not mid or (options['lyric'] and not sid):
+        with trace_span('detail'):
+            info = await qqmusic.get_music_song(mid, sid)
+        if 'msg' in info:
+            return web.json_response({"error": info['msg']}, status=404)
+
+    # vkey 与歌词都只依赖歌曲详情，并发请求
+    tasks = {}
+    if options['lyric']:
+        tasks['lyric'] = _traced('lyric', qqmusic.get_music_lyric_new(info['id']))
+    if file_types:
+        if options['prefer']:
+            tasks['music_urls'] = _traced('urls', qqmusic.get_preferred_url(info['mid'], file_types, info.get('sizes')))
+        else:
+            tasks['music_urls'] = _traced('urls', qqmusic.get_music_urls(info['mid'], file_types, info.get('sizes')))
+    results = await asyncio.gather(*tasks.values())
+
+    output = {'song': info} if options['detail'] else {}
+    output.update(zip(tasks, results))
+    return await _async_song_response(request, qqmusic, key, output, info['mid'])
+
+
+async def _traced(name, coro):
+    # gather 为每个协程创建任务并复制上下文，并发的 span 各自挂在当前 span 下
+    with trace_span(name):
+        return await coro
+
+
+async def _async_song_response(request, qqmusic, key, output, mid):
+    if _flag(request.query.get('debug'), default=False):
+        # 各段 span 都已结束，此时的当前 span 就是中间件开始的根 span
+        output['trace'] = trace_tree(_current_span.get())
+        with trace_span('serialize'):
+            return web.Response(body=dump_json(output), content_type='application/json')
+    # render_song 需要查询播放链接在缓存后端中的剩余有效期
+    return _async_cached_song(request, await qqmusic._offload(render_song, qqmusic, key, output, mid))
+
+
+def _async_cached_song(request, entry):
+    if etag_matches(request.headers.get('If-None-Match'), entry['etag']):
+        return web.Response(status=304, headers=song_headers(entry))
+    return web.Response(body=entry['body'], content_type='application/json', headers=song_headers(entry))
+
+
+async def _async_trace_middleware(request, handler):
+    root, token = start_trace()
+    try:
+        response = await handler(request)
+        response.headers['Server-Timing'] = server_timing(root)
+        return response
+    finally:
+        end_trace(root, token)
+        log_slow_request(root, request.path_qs)
+
+
+async def _async_metrics_middleware(request, handler):
+    resource = request.match_info.route.resource
+    labels = (('endpoint', resource.canonical if resource is not None else 'unmatched'),)
+    start = time.perf_counter()
+    metrics.inc('qqmusic_http_in_flight', labels)
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.inc('qqmusic_http_in_flight', labels, -1)
+        metrics.inc('qqmusic_http_requests_total', labels + (('status', status),))
+        metrics.observe('qqmusic_http_request_duration_seconds', labels, time.perf_counter() - start)
+
+
+async def async_metrics(request):
+    return web.Response(body=metrics.render(collect_gauges()).encode('utf-8'), headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+
+async def _close_async_sessions(application):
+    for session in list(_async_sessions.values()):
+        await session.close()
+    _async_sessions.clear()
+
+
+def create_async_app():
+    """
+    创建异步模式的 aiohttp 应用，单进程即可同时处理大量等待上游的请求
+    """
+    if web is None:
+        raise RuntimeError('async mode requires aiohttp: pip install aiohttp')
+    application = web.Application(middlewares=[
+        web.middleware(_async_metrics_middleware),
+        web.middleware(_async_trace_middleware),
+    ])
+    application.router.add_get('/song', async_get_song)
+    application.router.add_get('/metrics', async_metrics)
+    application.on_cleanup.append(_close_async_sessions)
+    return application
+
+
+def start_background():
+    """
+    启动后台线程（预热器），每个处理请求的进程调用一次
+    """
+    if WARMER_ENABLED:
+        cache_warmer.start()
+
+
+def stop_background():
+    """
+    进程退出前停止后台线程并保存需要持久化的缓存
+    """
+    cache_warmer.stop()
+    short_link_cache.save()
+    if _audio_cache is not None:
+        _audio_cache.close(wait=False)
+
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5122)
+    # 开发用的单进程服务器，生产环境使用 serve.py
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    host = os.environ.get('QQMUSIC_HOST', '0.0.0.0')
+    port = int(os.environ.get('QQMUSIC_PORT', 5122))
+    if '--async' in sys.argv:
+        start_background()
+        web.run_app(create_async_app(), host=host, port=port)
+    else:
+        # debug 模式（QQMUSIC_DEBUG=1）下由重载器启动的子进程处理请求，预热线程只在子进程中运行
+        debug = os.environ.get('QQMUSIC_DEBUG') == '1'
+        if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_background()
+        app.run(debug=debug, host=host, port=port)
@@ -0,0 +1,199 @@
+"""
+Benchmark for the /song request path against the local fake upstream.
+
+Starts the fake QQ Music upstream and the Flask app on local ports, drives
+/song at each concurrency level and reports p50/p95/p99 latency, requests
+per second and upstream calls per request.
+
+    python benchmarks/bench_song.py                  # run and compare with the baseline
+    python benchmarks/bench_song.py --save-baseline  # run and record a new baseline
+
+The run exits with status 1 when any level regresses beyond --threshold
+against the baseline, so it can gate a deploy.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import requests
+from werkzeug.serving import make_server
+
+import app
+from tests.fake_upstream import FakeUpstreamServer, song_mid, upstream_session
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--concurrency', default='1,8,32', help='comma separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=400, help='requests per concurrency level')
+    parser.add_argument('--songs', type=int, default=200, help='distinct songs requests are drawn from')
+    parser.add_argument('--short-links', type=float, default=0.3, help='share of requests using c6.y.qq.com share links')
+    parser.add_argument('--query', default='', help='extra /song query string, e.g. "types=320,flac&lyric=0"')
+    parser.add_argument('--latency', type=float, default=0.02, help='fake upstream latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='extra random upstream latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of upstream calls answering 503')
+    parser.add_argument('--formats', default='', help='comma separated available formats (default: all)')
+    parser.add_argument('--rate-limit', action='store_true', help='keep the production upstream rate limits')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative regression')
+    return parser.parse_args(argv)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(values) - 1, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def reset_app(workdir):
+    """Cold caches and a fresh metadata store, as on a newly started node."""
+    app.music_url_cache.clear()
+    app.negative_cache.clear()
+    app.short_link_cache.clear()
+    app.song_response_cache.clear()
+    app.short_link_cache.path = None
+    app._metadata_store = app.MetadataStore(os.path.join(workdir, f'metadata-{time.monotonic_ns()}.db'))
+    app.cache_warmer = app.CacheWarmer()
+
+
+def song_urls(args):
+    rng = random.Random(args.seed)
+    urls = []
+    for _ in range(args.requests):
+        mid = song_mid(rng.randrange(1, args.songs + 1))
+        if rng.random() < args.short_links:
+            urls.append(f'https://c6.y.qq.com/base/fcgi-bin/u?__={mid}')
+        else:
+            urls.append(f'https://y.qq.com/n/ryqq/songDetail/{mid}')
+    return urls
+
+
+def run_level(base_url, upstream, urls, concurrency, query):
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    extra = dict(parse_qsl(query))
+
+    def call(url):
+        start = time.perf_counter()
+        response = session.get(f'{base_url}/song', params={'url': url, **extra}, timeout=30)
+        return time.perf_counter() - start, response.status_code
+
+    upstream.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, urls))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        'requests': len(results),
+        'errors': sum(status != 200 for _, status in results),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 2),
+        'rps': round(len(results) / elapsed, 1),
+        'upstream_per_request': round(upstream.total_calls() / len(results), 3),
+        'upstream_calls': dict(sorted(upstream.calls.items())),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Returns a list of human readable regressions against the baseline."""
+    regressions = []
+    for level, current in results['levels'].items():
+        base = baseline.get('levels', {}).get(level)
+        if not base:
+            continue
+        # p99 只报告不比较，少量请求时波动太大
+        for key in ('p50_ms', 'p95_ms'):
+            if current[key] > base[key] * (1 + threshold):
+                regressions.append(f'c={level} {key} {base[key]} -> {current[key]}')
+        if current['rps'] < base['rps'] * (1 - threshold):
+            regressions.append(f"c={level} rps {base['rps']} -> {current['rps']}")
+        # 上游调用次数不受机器性能影响，任何增加都视为退化
+        if current['upstream_per_request'] > base['upstream_per_request'] + 0.01:
+            regressions.append(f"c={level} upstream_per_request {base['upstream_per_request']} -> {current['upstream_per_request']}")
+        if current['errors'] > base['errors']:
+            regressions.append(f"c={level} errors {base['errors']} -> {current['errors']}")
+    return regressions
+
+
+def print_table(results, baseline):
+    print(f"{'c':>4} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'rps':>8} {'up/req':>7} {'errors':>6}")
+    for level, row in results['levels'].items():
+        print(f"{level:>4} {row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9} "
+              f"{row['rps']:>8} {row['upstream_per_request']:>7} {row['errors']:>6}")
+        base = (baseline or {}).get('levels', {}).get(level)
+        if base:
+            print(f"{'base':>4} {base['p50_ms']:>9} {base['p95_ms']:>9} {base['p99_ms']:>9} "
+                  f"{base['rps']:>8} {base['upstream_per_request']:>7} {base['errors']:>6}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    levels = [int(level) for level in args.concurrency.split(',')]
+    formats = [value for value in args.formats.split(',') if value] or None
+
+    upstream = FakeUpstreamServer(args.latency, args.jitter, args.error_rate, formats).start()
+    app._session = upstream_session(upstream, pool_maxsize=max(levels) * 2)
+    if not args.rate_limit:
+        # 默认不限速，测量的是请求路径本身而不是限速配置
+        app.upstream_limiter = app.RateLimiter(limits={}, default=(1e9, 1e9))
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    urls = song_urls(args)
+    results = {'config': {key: value for key, value in vars(args).items() if key not in ('baseline', 'save_baseline')},
+               'levels': {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        for level in levels:
+            reset_app(workdir)
+            results['levels'][str(level)] = run_level(base_url, upstream, urls, level, args.query)
+    server.shutdown()
+    upstream.stop()
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f'baseline saved to {args.baseline}')
+        return 0
+    if baseline is None:
+        print('no baseline found, run with --save-baseline to record one')
+        return 0
+    if baseline.get('config') != results['config']:
+        print('warning: baseline was recorded with different options')
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,412 @@
+"""
+生产环境启动入口：主进程监听端口后预先 fork 多个工作进程，工作进程共享监听套接字处理请求
+
+    python serve.py                          # 按环境变量配置
+    python serve.py --config serve.json      # 读取 JSON 配置文件，环境变量与命令行参数优先
+    python serve.py --workers 4 --threads 32
+
+工作进程在 fork 之后才导入 app，连接池、缓存与后台线程都属于各自的进程；上游限速按工作进程数均分。
+信号：TERM/INT 优雅退出（停止接受新连接，等待处理中的请求，最多 graceful_timeout 秒），
+HUP 启动一组新的工作进程并优雅退出旧的工作进程。
+工作进程启动后立即崩溃时按指数退避重启，连续失败 BOOT_FAILURE_LIMIT 次后主进程以状态码 3 退出
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger('serve')
+
+# 服务配置：默认值 < 配置文件 < 环境变量 QQMUSIC_<KEY> < 命令行参数
+DEFAULTS = {
+    'host': '0.0.0.0',
+    'port': 5122,
+    'workers': os.cpu_count() or 1,
+    'threads': 16,  # 同步模式下每个工作进程处理请求的线程数
+    'async': False,  # 工作进程使用 aiohttp 事件循环代替线程池（需要 aiohttp）
+    'backlog': 1024,
+    'timeout': 30,  # 连接空闲或发送阻塞超过该秒数时关闭
+    'graceful_timeout': 30,
+    'max_requests': 0,  # 工作进程处理该数量的请求后由新进程替换，0 表示不替换
+    'max_requests_jitter': 0,  # 各工作进程的替换阈值再随机增加 0~jitter，避免同时重启
+}
+
+# 工作进程启动后 WORKER_BOOT_TIME 秒内异常退出视为启动失败（如 QQMUSIC_CACHE 配置错误）：
+# 重启间隔从 RESPAWN_DELAY 起每次翻倍，最多 RESPAWN_DELAY_MAX 秒；连续 BOOT_FAILURE_LIMIT 次后主进程退出
+WORKER_BOOT_TIME = 5
+RESPAWN_DELAY = 0.1
+RESPAWN_DELAY_MAX = 30
+BOOT_FAILURE_LIMIT = 5
+WORKER_BOOT_ERROR = 3
+
+# 异步模式目前只提供这些接口，其余接口需要使用同步工作进程
+ASYNC_ROUTES = ('/song', '/metrics')
+SYNC_ONLY_ROUTES = ('/songs', '/stream', '/collection', '/admin/preload')
+
+# 交给 app.py 的配置，以环境变量的形式传给工作进程；已设置的环境变量优先
+APP_SETTINGS = {
+    'cookie': 'QQMUSIC_COOKIE',
+    'cookie_pool': 'QQMUSIC_COOKIE_POOL',
+    'cache': 'QQMUSIC_CACHE',
+    'metadata_db': 'QQMUSIC_METADATA_DB',
+    'metadata_max_age': 'QQMUSIC_METADATA_MAX_AGE',
+    'short_link_cache': 'QQMUSIC_SHORT_LINK_CACHE',
+    'audio_cache': 'QQMUSIC_AUDIO_CACHE',
+    'audio_cache_size': 'QQMUSIC_AUDIO_CACHE_SIZE',
+    'audio_accel_redirect': 'QQMUSIC_AUDIO_ACCEL_REDIRECT',
+    'warmer': 'QQMUSIC_WARMER',
+    'admin_token': 'QQMUSIC_ADMIN_TOKEN',
+    'slow_request': 'QQMUSIC_SLOW_REQUEST',
+}
+
+
+def _convert(key, value):
+    default = DEFAULTS[key]
+    if isinstance(default, bool):
+        return value if isinstance(value, bool) else str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(value)
+    return str(value)
+
+
+def load_config(path=None, environ=None, overrides=None):
+    """
+    合并各来源的配置，返回 (服务配置, 需要传给工作进程的环境变量)
+
+    path 未指定时读取环境变量 QQMUSIC_CONFIG 指向的 JSON 文件，配置项错误时抛出 ValueError
+    """
+    environ = os.environ if environ is None else environ
+    path = path or environ.get('QQMUSIC_CONFIG')
+    data = {}
+    if path:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    unknown = set(data) - set(DEFAULTS) - set(APP_SETTINGS)
+    if unknown:
+        raise ValueError(f"unknown config keys: {', '.join(sorted(unknown))}")
+
+    config = dict(DEFAULTS)
+    for key in DEFAULTS:
+        if key in data:
+            config[key] = _convert(key, data[key])
+        if environ.get(f'QQMUSIC_{key.upper()}'):
+            config[key] = _convert(key, environ[f'QQMUSIC_{key.upper()}'])
+        if overrides and overrides.get(key) is not None:
+            config[key] = _convert(key, overrides[key])
+    if config['workers'] < 1 or config['threads'] < 1:
+        raise ValueError('workers and threads must be at least 1')
+
+    app_env = {}
+    for key, name in APP_SETTINGS.items():
+        if key in data and name not in environ:
+            value = data[key]
+            app_env[name] = ('1' if value else '0') if isinstance(value, bool) else str(value)
+    # app 按工作进程数均分上游限速
+    app_env['QQMUSIC_WORKERS'] = str(config['workers'])
+    return config, app_env
+
+
+class WorkerRequestHandler(WSGIRequestHandler):
+    """
+    记录等待下一个请求的 keep-alive 连接，优雅退出时直接关闭，不必等到超时
+    """
+
+    def handle_one_request(self):
+        if self.server.stopping.is_set():
+            self.close_connection = True
+            return
+        with self.server.lock:
+            self.server.idle.add(self.connection)
+        try:
+            super().handle_one_request()
+        finally:
+            with self.server.lock:
+                self.server.idle.discard(self.connection)
+
+    def parse_request(self):
+        with self.server.lock:
+            self.server.idle.discard(self.connection)
+        return super().parse_request()
+
+
+class WorkerServer(ThreadedWSGIServer):
+    """
+    工作进程内的 WSGI 服务器：连接交给固定大小的线程池处理，处理 max_requests 个请求后优雅退出
+    """
+
+    def __init__(self, config, application, fd):
+        super().__init__(config['host'], config['port'], application, handler=WorkerRequestHandler, fd=fd)
+        WorkerRequestHandler.timeout = config['timeout']
+        self.pool = ThreadPoolExecutor(max_workers=config['threads'], thread_name_prefix='worker')
+        limit = config['max_requests']
+        self.max_requests = limit + random.randint(0, config['max_requests_jitter']) if limit else 0
+        self.handled = 0
+        self.idle = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.app = self._counted(self.app)
+
+    def _counted(self, application):
+        def counted(environ, start_response):
+            with self.lock:
+                self.handled += 1
+                recycle = self.handled == self.max_requests
+            if recycle:
+                logger.info("worker %d recycling after %d requests", os.getpid(), self.handled)
+                self.stop()
+            return application(environ, start_response)
+        return counted
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def stop(self):
+        """
+        停止接受新连接；serve_forever 所在线程（包括信号处理函数）不能直接调用 shutdown
+        """
+        if not self.stopping.is_set():
+            self.stopping.set()
+            threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def drain(self):
+        """
+        关闭空闲的 keep-alive 连接，等待处理中的请求完成
+        """
+        with self.lock:
+            idle = list(self.idle)
+        for connection in idle:
+            try:
+                connection.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+        self.pool.shutdown(wait=True)
+
+
+def run_sync_worker(sock, config):
+    import app  # fork 之后导入，进程内的状态不与其他工作进程共享
+
+    server = WorkerServer(config, app.app, sock.fileno())
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    app.start_background()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.drain()
+        app.stop_background()
+
+
+def run_async_worker(sock, config):
+    import app  # fork 之后导入，进程内的状态不与其他工作进程共享
+    from aiohttp import web
+
+    application = app.create_async_app()
+    if config['max_requests']:
+        limit = config['max_requests'] + random.randint(0, config['max_requests_jitter'])
+        handled = itertools.count()
+
+        async def recycle(request, response):
+            if next(handled) + 1 == limit:
+                logger.info("worker %d recycling after %d requests", os.getpid(), limit)
+                os.kill(os.getpid(), signal.SIGTERM)
+        application.on_response_prepare.append(recycle)
+    app.start_background()
+    try:
+        # run_app 收到 TERM/INT 后停止接受连接，最多等待 shutdown_timeout 秒
+        web.run_app(application, sock=sock, shutdown_timeout=config['graceful_timeout'],
+                    keepalive_timeout=config['timeout'], print=None)
+    finally:
+        app.stop_background()
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class Master:
+    """
+    主进程：持有监听套接字，保持 workers 个工作进程，退出或崩溃的工作进程由新进程替换
+
+    run 返回主进程的退出状态，工作进程反复启动失败时为 WORKER_BOOT_ERROR
+    """
+
+    def __init__(self, config, worker=None):
+        self.config = config
+        self.worker = worker or (run_async_worker if config['async'] else run_sync_worker)
+        self.sock = None
+        self.workers = {}  # pid -> 启动时间
+        self.exit_code = 0
+        self._stopping = False
+        self._reload = False
+        self._failures = 0  # 连续启动失败的次数
+        self._failed_at = 0.0
+        self._delay = 0.0
+        self._next_spawn = 0.0
+
+    def bind(self):
+        """
+        创建监听套接字并返回实际端口（port 为 0 时由系统分配）
+        """
+        family = socket.AF_INET6 if ':' in self.config['host'] else socket.AF_INET
+        self.sock = socket.create_server((self.config['host'], self.config['port']), family=family,
+                                         backlog=self.config['backlog'])
+        return self.sock.getsockname()[1]
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return pid
+        # 工作进程：信号由各自的服务器处理，INT 只由主进程处理后转为 TERM
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            random.seed()
+            self.worker(self.sock, self.config)
+        except BaseException:
+            logger.exception("worker %d failed", os.getpid())
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.workers.clear()
+                return
+            if pid == 0:
+                return
+            started = self.workers.pop(pid, None)
+            code = _exit_code(status)
+            if code != 0 and not self._stopping:
+                logger.warning("worker %d exited with status %d", pid, code)
+                if started is not None and time.monotonic() - started < WORKER_BOOT_TIME:
+                    self._boot_failed()
+
+    def _boot_failed(self):
+        now = time.monotonic()
+        self._failures += 1
+        self._failed_at = now
+        self._delay = min(max(self._delay * 2, RESPAWN_DELAY), RESPAWN_DELAY_MAX)
+        self._next_spawn = now + self._delay
+        if self._failures >= BOOT_FAILURE_LIMIT:
+            logger.error("workers failed to boot %d times in a row, shutting down", self._failures)
+            self.exit_code = WORKER_BOOT_ERROR
+            self._stopping = True
+
+    def _check_booted(self):
+        """
+        上次启动失败之后启动的工作进程存活超过 WORKER_BOOT_TIME 秒时清零失败计数与重启间隔
+        """
+        now = time.monotonic()
+        if self._failures and any(started > self._failed_at and now - started >= WORKER_BOOT_TIME
+                                  for started in self.workers.values()):
+            self._failures = 0
+            self._delay = 0.0
+
+    def _signal(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def run(self):
+        if self.sock is None:
+            self.bind()
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        host, port = self.sock.getsockname()[:2]
+        logger.info("listening on %s:%d with %d %s workers", host, port, self.config['workers'],
+                    'async' if self.config['async'] else f"{self.config['threads']}-thread")
+        if self.config['async']:
+            logger.warning("async workers only serve %s; %s need sync workers",
+                           ', '.join(ASYNC_ROUTES), ', '.join(SYNC_ONLY_ROUTES))
+        while not self._stopping:
+            self._reap()
+            self._check_booted()
+            if self._reload:
+                # 新的一组工作进程启动后再让旧的工作进程退出
+                self._reload = False
+                old = list(self.workers)
+                for _ in range(self.config['workers']):
+                    self.spawn()
+                self._signal(old, signal.SIGTERM)
+            # 启动失败后等待重启间隔，避免配置错误时不停地 fork
+            while (len(self.workers) < self.config['workers'] and not self._stopping
+                   and time.monotonic() >= self._next_spawn):
+                self.spawn()
+            time.sleep(0.1)
+        self.stop()
+        return self.exit_code
+
+    def stop(self):
+        """
+        通知所有工作进程优雅退出，graceful_timeout 秒后强制结束仍未退出的进程
+        """
+        self._stopping = True
+        self._signal(list(self.workers), signal.SIGTERM)
+        deadline = time.monotonic() + self.config['graceful_timeout']
+        while self.workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.05)
+        if self.workers:
+            logger.warning("killing %d workers after graceful timeout", len(self.workers))
+            self._signal(list(self.workers), signal.SIGKILL)
+            for pid in list(self.workers):
+                os.waitpid(pid, 0)
+            self.workers.clear()
+        self.sock.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='QQ music API server')
+    parser.add_argument('--config', help='JSON config file (default: $QQMUSIC_CONFIG)')
+    for key, default in DEFAULTS.items():
+        flag = '--' + key.replace('_', '-')
+        if isinstance(default, bool):
+            parser.add_argument(flag, action='store_const', const=True, default=None)
+        else:
+            parser.add_argument(flag, type=type(default), default=None)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(process)d %(name)s: %(message)s')
+    try:
+        config, app_env = load_config(args.config, overrides=vars(args))
+    except (OSError, ValueError) as e:
+        logger.error("invalid config: %s", e)
+        return 2
+    os.environ.update(app_env)
+    return Master(config).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
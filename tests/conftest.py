@@ -256,15 +256,47 @@ def network_responses():
     }
 
 
+@pytest.fixture
+def fake_upstream(monkeypatch):
+    """
+    Runs the local fake QQ Music upstream and routes the shared session to it.
+
+    Yields:
+        FakeUpstreamServer: The running server; adjust latency, error_rate
+        or formats on it to shape responses.
+    """
+    import app
+    from tests.fake_upstream import FakeUpstreamServer, upstream_session
+
+    server = FakeUpstreamServer().start()
+    monkeypatch.setattr(app, '_session', upstream_session(server))
+    monkeypatch.setattr(app, '_stream_session', upstream_session(server))
+    yield server
+    server.stop()
+
+
 @pytest.fixture(autouse=True)
-def reset_global_state():
+def reset_global_state(tmp_path):
     """
     Automatically resets any global state between tests.
     
     This fixture runs automatically before each test to ensure
     clean state and prevent test interference.
     """
-    # Reset any global variables or state here if needed
+    import app
+
+    # Process-wide caches must not leak results between tests
+    app.music_url_cache.clear()
+    app.negative_cache.clear()
+    app.upstream_limiter.clear()
+    app.reload_cookie_pool()
+    app.short_link_cache.clear()
+    app.song_response_cache.clear()
+    app.cache_warmer = app.CacheWarmer()
+    app.metrics.clear()
+    app.short_link_cache.path = None
+    app._metadata_store = app.MetadataStore(str(tmp_path / 'metadata.db'))
+    app._audio_cache = None
     yield
     # Cleanup after test if needed
 
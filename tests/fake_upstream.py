@@ -0,0 +1,300 @@
+"""
+A local stand-in for the QQ Music upstream.
+
+FakeUpstreamServer answers the requests QQMusic sends, over real HTTP:
+
+* POST /cgi-bin/musicu.fcg with vkey, lyric, song detail, album track
+  list and playlist modules
+* POST /v8/fcg-bin/fcg_play_single_song.fcg
+* GET /lyric/fcgi-bin/fcg_query_lyric_new.fcg
+* GET /base/fcgi-bin/u?__=<mid> (the c6.y.qq.com share-link redirect)
+* GET /<filename>?vkey=... (audio files on the stream CDN, with Range)
+
+Latency, error rate and which formats are available can be configured.
+upstream_session() returns a requests session that sends every upstream
+URL to the fake server, so it can replace app._session in tests and
+benchmarks.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import app
+
+LYRIC = '[00:00.00]fake lyric\n[00:01.00]line two'
+TRANS = '[00:00.00]假歌词'
+
+
+def song_mid(song_id):
+    """The mid the fake upstream uses for a numeric song id."""
+    return f'fake{song_id:010d}'
+
+
+def song_id(mid):
+    """The numeric id the fake upstream uses for a mid."""
+    if mid.startswith('fake') and mid[4:].isdigit():
+        return int(mid[4:])
+    return zlib.crc32(mid.encode('utf-8')) or 1
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without TCP_NODELAY the
+    # body waits for the client's delayed ACK and adds ~40ms per call.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload=None, headers=None, body=None, content_type='application/json'):
+        if body is None:
+            body = json.dumps(payload or {}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _begin(self, kind):
+        """Record the call and apply latency; returns False when an error is injected."""
+        server = self.server
+        server.record(kind)
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        if server.error_rate and random.random() < server.error_rate:
+            server.record('errors')
+            self._send(503, {'code': 503})
+            return False
+        return True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/base/fcgi-bin/u':
+            if self._begin('redirect'):
+                mid = query.get('__', [''])[0]
+                self._send(302, headers={'Location': f'https://y.qq.com/n/ryqq/songDetail/{mid}'})
+        elif url.path == '/lyric/fcgi-bin/fcg_query_lyric_new.fcg':
+            if self._begin('lyric'):
+                self._send(200, {'lyric': base64.b64encode(LYRIC.encode('utf-8')).decode('ascii')})
+        elif url.path.lstrip('/')[:4] in self.server.audio_prefixes:
+            if self._begin('audio'):
+                self._audio(url.path.lstrip('/'), query.get('vkey', [''])[0])
+        else:
+            self._send(404)
+
+    def _audio(self, filename, vkey):
+        if vkey != 'fake':
+            self._send(403)
+            return
+        data = self.server.audio(filename)
+        headers = {'Accept-Ranges': 'bytes'}
+        byte_range = self.headers.get('Range', '')
+        self.server.ranges.append(byte_range)
+        if not byte_range.startswith('bytes='):
+            self._send(200, headers=headers, body=data, content_type='audio/mpeg')
+            return
+        first, _, last = byte_range[6:].partition('-')
+        start, end = int(first), min(int(last or len(data) - 1), len(data) - 1)
+        if start > end:
+            self._send(416, headers={'Content-Range': f'bytes */{len(data)}'}, body=b'')
+            return
+        headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+        self._send(206, headers=headers, body=data[start:end + 1], content_type='audio/mpeg')
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if url.path == '/v8/fcg-bin/fcg_play_single_song.fcg':
+            if self._begin('detail'):
+                self._detail(body)
+        elif url.path == '/cgi-bin/musicu.fcg':
+            self._musicu(json.loads(body or b'{}'))
+        else:
+            self._send(404)
+
+    def _detail(self, body):
+        if self.server.code:
+            self._send(200, {'code': self.server.code})
+            return
+        form = {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+        mid = form.get('songmid') or song_mid(int(form.get('songid', 0)))
+        self._send(200, {'code': 0, 'data': [self.server.track(mid)]})
+
+    def _musicu(self, request):
+        modules = {key: value for key, value in request.items() if isinstance(value, dict) and 'module' in value}
+        kinds = {self._kind(module) for module in modules.values()}
+        if not self._begin('+'.join(sorted(kinds)) or 'musicu'):
+            return
+        response = {'code': 0}
+        for key, module in modules.items():
+            kind = self._kind(module)
+            if kind == 'vkey':
+                data = self.server.vkey(module['param'])
+            elif kind == 'lyric':
+                data = {'lyric': base64.b64encode(LYRIC.encode('utf-8')).decode('ascii'),
+                        'trans': base64.b64encode(TRANS.encode('utf-8')).decode('ascii')}
+            elif kind == 'detail':
+                param = module['param']
+                mid = param.get('song_mid') or song_mid(int(param.get('song_id', 0)))
+                data = {'track_info': self.server.track(mid)}
+            elif kind in ('album', 'playlist'):
+                data = self.server.collection(kind, module['param'])
+            else:
+                data = {}
+            if self.server.code:
+                # musicu.fcg reports throttling per module, with HTTP 200
+                response[key] = {'code': self.server.code, 'data': {}}
+            else:
+                response[key] = {'code': 0, 'data': data}
+        self._send(200, response)
+
+    @staticmethod
+    def _kind(module):
+        return {
+            'vkey.GetVkeyServer': 'vkey',
+            'music.musichallSong.PlayLyricInfo': 'lyric',
+            'music.pf_song_detail_svr': 'detail',
+            'music.musichallAlbum.AlbumSongList': 'album',
+            'music.srfDissInfo.aiDissInfo': 'playlist',
+        }.get(module.get('module'), 'unknown')
+
+
+class FakeUpstreamServer(ThreadingHTTPServer):
+    """
+    Fake QQ Music upstream.
+
+    latency/jitter are in seconds; error_rate is the share of calls that
+    answer 503; code, when nonzero, is returned in every JSON reply with
+    HTTP 200, the way the real upstream reports throttling; formats is the
+    set of file types that resolve to a purl;
+    audio_size is the length of every audio file; collection_size is the
+    number of tracks on every album and playlist except playlist 0, which
+    does not exist.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, formats=None):
+        super().__init__(('127.0.0.1', 0), FakeUpstreamHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.code = 0
+        self.formats = set(app.FILE_CONFIG if formats is None else formats)
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._prefixes = {(conf['s'], conf['e']): file_type for file_type, conf in app.FILE_CONFIG.items()}
+        self.audio_prefixes = {conf['s'] for conf in app.FILE_CONFIG.values()}
+        self.audio_size = 256 * 1024
+        self.ranges = []
+        self.collection_size = 30
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def record(self, kind):
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def total_calls(self):
+        with self._lock:
+            return sum(count for kind, count in self.calls.items() if kind != 'errors')
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def track(self, mid):
+        """Song detail in the shape of both fcg_play_single_song and pf_song_detail_svr."""
+        sizes = {}
+        for file_type, key in app.FILE_SIZE_KEYS.items():
+            size = 1000 + len(file_type) if file_type in self.formats else 0
+            if isinstance(key, tuple):
+                values = sizes.setdefault(key[0], [0, 0, 0])
+                values[key[1]] = size
+            else:
+                sizes[key] = size
+        return {
+            'mid': mid,
+            'id': song_id(mid),
+            'name': f'Song {mid}',
+            'album': {'mid': 'fakealbum', 'name': 'Fake Album'},
+            'singer': [{'name': 'Fake Singer'}],
+            'file': sizes,
+        }
+
+    def vkey(self, param):
+        infos = []
+        for filename, mid in zip(param.get('filename', []), param.get('songmid', [])):
+            file_type = self._prefixes.get((filename[:4], os.path.splitext(filename)[1]))
+            purl = f'{filename}?vkey=fake&guid={param.get("guid", "")}' if file_type in self.formats else ''
+            infos.append({'filename': filename, 'songmid': mid, 'purl': purl})
+        return {'sip': ['http://ws.stream.qqmusic.qq.com/', 'http://fake.stream/'], 'midurlinfo': infos, 'expiration': 80400}
+
+
+    def collection(self, kind, param):
+        """One page of an album or playlist, holding the tracks fake0000000001 onwards."""
+        if kind == 'playlist' and not param.get('disstid'):
+            return {}
+        begin = param.get('begin', param.get('song_begin', 0))
+        num = param.get('num', param.get('song_num', 0))
+        tracks = [self.track(song_mid(index + 1)) for index in range(begin, min(begin + num, self.collection_size))]
+        if kind == 'album':
+            name = param.get('albumMid') or param.get('albumId')
+            return {'albumName': f'Album {name}', 'totalNum': self.collection_size,
+                    'songList': [{'songInfo': track} for track in tracks]}
+        return {'dirinfo': {'title': f"Playlist {param['disstid']}", 'songnum': self.collection_size},
+                'total_song_num': self.collection_size, 'songlist': tracks}
+
+    def audio(self, filename):
+        """Deterministic content of an audio file, derived from its name."""
+        seed = hashlib.sha256(filename.encode('utf-8')).digest()
+        return (seed * (self.audio_size // len(seed) + 1))[:self.audio_size]
+
+
+class RewriteAdapter(HTTPAdapter):
+    """Sends every request to base_url, keeping the path and query."""
+
+    def __init__(self, base_url, **kwargs):
+        self.base = urlsplit(base_url)
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = urlunsplit((self.base.scheme, self.base.netloc, url.path, url.query, ''))
+        return super().send(request, **kwargs)
+
+
+def upstream_session(server, pool_maxsize=app.POOL_MAXSIZE):
+    """A requests session whose upstream calls all reach the fake server."""
+    session = requests.Session()
+    adapter = RewriteAdapter(server.url, pool_connections=app.POOL_CONNECTIONS, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
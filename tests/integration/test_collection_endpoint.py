@@ -0,0 +1,84 @@
+"""
+Integration tests for album and playlist expansion on /collection.
+
+Track lists, song details and vkeys all come from the fake upstream, so
+the upstream call counts below are the ones a real deployment would see.
+"""
+
+import json
+import pytest
+
+import app
+
+
+@pytest.fixture
+def client():
+    app.app.config['TESTING'] = True
+    return app.app.test_client()
+
+
+@pytest.mark.integration
+class TestCollectionEndpoint:
+    """Tests for GET /collection."""
+
+    def test_large_playlist_takes_a_handful_of_calls(self, client, fake_upstream):
+        """Pages are merged into one call, details come with the track list and vkeys are batched."""
+        fake_upstream.collection_size = 500
+        response = client.get('/collection', query_string={
+            'url': 'https://y.qq.com/n/ryqq/playlist/7256912512', 'types': 'flac,320'})
+        body = json.loads(response.data)
+
+        assert response.status_code == 200
+        assert body['collection'] == {'type': 'playlist', 'id': '7256912512', 'name': 'Playlist 7256912512', 'total': 500}
+        assert len(body['songs']) == 500
+        assert body['songs'][499]['song']['mid'] == 'fake0000000500'
+        assert list(body['songs'][0]['music_urls']) == ['flac', '320']
+        assert fake_upstream.calls == {'playlist': 2, 'vkey': 10}
+
+    def test_stream_album_in_chunks(self, client, fake_upstream):
+        fake_upstream.collection_size = 12
+        response = client.get('/collection', query_string={
+            'url': 'https://y.qq.com/n/ryqq/albumDetail/002fRO0N4FftzY', 'types': '128', 'chunk': '5', 'stream': '1'})
+        records = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+
+        assert records[0] == {'type': 'collection', 'data': {
+            'type': 'album', 'id': '002fRO0N4FftzY', 'name': 'Album 002fRO0N4FftzY', 'total': 12}}
+        assert [record['data']['song']['id'] for record in records[1:]] == list(range(1, 13))
+        assert fake_upstream.calls == {'album': 1, 'vkey': 3}
+
+    def test_tracks_are_stored_for_song_lookups(self, client, fake_upstream):
+        """Details from a track list serve later /song calls without a detail request."""
+        client.get('/collection', query_string={'url': 'https://i.y.qq.com/n2/m/share/details/taoge.html?id=1', 'types': ''})
+        fake_upstream.reset()
+        response = client.get('/song', query_string={
+            'url': 'https://y.qq.com/n/ryqq/songDetail/fake0000000003', 'types': '320', 'lyric': '0'})
+
+        assert json.loads(response.data)['song']['name'] == 'Song fake0000000003'
+        assert fake_upstream.calls == {'vkey': 1}
+
+    def test_errors(self, client, fake_upstream):
+        assert client.get('/collection').status_code == 400
+        assert client.get('/collection', query_string={'url': 'https://y.qq.com/n/ryqq/songDetail/001abc'}).status_code == 400
+        assert client.get('/collection', query_string={'url': 'https://y.qq.com/n/ryqq/playlist/0'}).status_code == 404
+
+    def test_throttled_pages_are_bad_gateway(self, client, fake_upstream, monkeypatch):
+        """A module error is not a missing collection, and no page is silently dropped."""
+        url = 'https://y.qq.com/n/ryqq/playlist/7256912513'
+        fake_upstream.code = 2001
+        first_page = client.get('/collection', query_string={'url': url, 'types': ''})
+
+        fake_upstream.code = 0
+        fake_upstream.collection_size = 250
+        post_json = app.QQMusic._post_json
+
+        def throttle_later_pages(self, url, **kwargs):
+            data = post_json(self, url, **kwargs)
+            if 'page_2' in data:
+                data['page_2'] = {'code': 2001, 'data': {}}
+            return data
+        monkeypatch.setattr(app.QQMusic, '_post_json', throttle_later_pages)
+        later_page = client.get('/collection', query_string={'url': url, 'types': ''})
+
+        for response in (first_page, later_page):
+            assert response.status_code == 502
+            assert 'page_' in response.get_json()['error']
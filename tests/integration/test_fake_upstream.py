@@ -0,0 +1,201 @@
+"""
+End-to-end tests against the local fake upstream.
+
+Unlike the mocked tests, these run the real pooled session, rate limiter
+and HTTP parsing, so they also check that the fake upstream used by the
+benchmarks stays compatible with the client.
+"""
+
+import json
+import logging
+from unittest.mock import Mock
+
+import pytest
+
+import app
+from tests.fake_upstream import song_id
+
+
+@pytest.fixture
+def client():
+    app.app.config['TESTING'] = True
+    return app.app.test_client()
+
+
+@pytest.mark.integration
+class TestFakeUpstream:
+    """Tests for /song over HTTP to the fake upstream."""
+
+    def test_short_link_full_response(self, client, fake_upstream):
+        """A share link resolves through the redirect, detail, vkey and lyric calls."""
+        response = client.get('/song', query_string={'url': 'https://c6.y.qq.com/base/fcgi-bin/u?__=fake0000000007'})
+        body = json.loads(response.data)
+
+        assert response.status_code == 200
+        assert body['song']['id'] == song_id('fake0000000007') == 7
+        assert body['music_urls']['320']['url'].startswith('https://fake.stream/M800fake0000000007')
+        assert body['lyric']['lyric'].startswith('[00:00.00]fake lyric')
+        assert fake_upstream.calls['redirect'] == 1
+
+    def test_format_availability(self, client, fake_upstream):
+        """Formats the fake upstream withholds are dropped without a vkey request."""
+        fake_upstream.formats = {'128', '320'}
+        response = client.get('/song', query_string={
+            'url': 'https://y.qq.com/n/ryqq/songDetail/fake0000000008',
+            'types': 'flac,320,128',
+            'lyric': '0',
+        })
+        body = json.loads(response.data)
+
+        assert list(body['music_urls']) == ['320', '128']
+        assert body['song']['sizes']['flac'] == 0
+
+    def test_latency_and_call_counts(self, client, fake_upstream):
+        """Configured latency applies per upstream call and repeats are served from cache."""
+        fake_upstream.latency = 0.02
+        url = 'https://y.qq.com/n/ryqq/songDetail/fake0000000009'
+        client.get('/song', query_string={'url': url})
+        calls = fake_upstream.total_calls()
+        client.get('/song', query_string={'url': url})
+
+        assert calls == 3
+        assert fake_upstream.total_calls() == calls
+
+    def test_metrics_cover_each_upstream_operation(self, client, fake_upstream):
+        """/metrics breaks a /song call down by upstream operation and format."""
+        fake_upstream.formats = {'320'}
+        client.get('/song', query_string={
+            'url': 'https://c6.y.qq.com/base/fcgi-bin/u?__=fake0000000010',
+            'types': '320,128,ogg_640',
+        })
+        text = client.get('/metrics').data.decode('utf-8')
+
+        for op in ('redirect', 'detail', 'vkey', 'lyric'):
+            assert f'qqmusic_upstream_requests_total{{op="{op}",result="ok"}} 1' in text
+            assert f'qqmusic_upstream_duration_seconds_count{{op="{op}"}} 1' in text
+        assert 'qqmusic_vkey_files_total{file_type="320"} 1' in text
+        assert 'qqmusic_vkey_empty_total{file_type="320"}' not in text
+        assert 'qqmusic_vkey_empty_total{file_type="ogg_640"} 1' in text
+        assert 'qqmusic_http_requests_total{endpoint="/song",status="200"} 1' in text
+        assert 'qqmusic_http_in_flight{endpoint="/song"} 0' in text
+        assert 'qqmusic_cache_requests_total{cache="metadata",result="miss"}' in text
+
+    def test_server_timing_and_debug_trace(self, client, fake_upstream):
+        """Every step of a share-link lookup shows up in Server-Timing and the debug trace."""
+        response = client.get('/song', query_string={
+            'url': 'https://c6.y.qq.com/base/fcgi-bin/u?__=fake0000000011',
+            'debug': '1',
+        })
+        names = [entry.split(';')[0] for entry in response.headers['Server-Timing'].split(', ')]
+        trace = json.loads(response.data)['trace']
+
+        assert names == ['parse', 'upstream.redirect', 'detail', 'upstream.detail',
+                         'urls', 'upstream.vkey', 'lyric', 'upstream.lyric', 'serialize', 'total']
+        assert [span['name'] for span in trace['children']] == ['parse', 'detail', 'urls', 'lyric']
+        assert trace['children'][2]['children'][0]['name'] == 'upstream.vkey'
+        assert trace['dur_ms'] >= trace['children'][-1]['start_ms']
+
+    def test_slow_request_log(self, client, fake_upstream, monkeypatch, caplog):
+        """Requests over the threshold log their full span tree."""
+        monkeypatch.setattr(app, 'SLOW_REQUEST_SECONDS', 0.001)
+        fake_upstream.latency = 0.01
+        with caplog.at_level(logging.WARNING, logger='app.slow'):
+            client.get('/song', query_string={'url': 'https://y.qq.com/n/ryqq/songDetail/fake0000000012'})
+
+        [record] = caplog.records
+        assert record.getMessage().startswith('slow request /song?url=')
+        assert '"name": "upstream.vkey"' in record.getMessage()
+        assert 'trace' not in client.get('/song', query_string={
+            'url': 'https://y.qq.com/n/ryqq/songDetail/fake0000000012'}).get_json()
+
+    def test_conditional_requests_and_cached_body(self, client, fake_upstream):
+        """Repeats reuse the serialized body, and a matching If-None-Match gets a 304."""
+        query = {'url': 'https://y.qq.com/n/ryqq/songDetail/fake0000000013'}
+        first = client.get('/song', query_string=query)
+        calls = fake_upstream.total_calls()
+        hits = app.song_response_cache.stats()['hits']
+        etag = first.headers['ETag']
+        not_modified = client.get('/song', query_string=query, headers={'If-None-Match': etag})
+        repeat = client.get('/song', query_string=query, headers={'If-None-Match': '"other"'})
+
+        assert first.headers['Cache-Control'].startswith('public, max-age=')
+        assert 0 < int(first.headers['Cache-Control'].split('=')[1]) <= app.URL_CACHE_TTL
+        assert not_modified.status_code == 304
+        assert not_modified.data == b''
+        assert not_modified.headers['ETag'] == etag
+        assert repeat.status_code == 200
+        assert repeat.data == first.data
+        assert fake_upstream.total_calls() == calls
+        assert app.song_response_cache.stats()['hits'] == hits + 2
+        # cache hits still count towards the warmer's popularity ranking
+        assert app.cache_warmer.stats()['tracked'] == 1
+
+    def test_max_age_follows_the_earliest_vkey_expiry(self, client, fake_upstream):
+        mid = 'fake0000000014'
+        qqmusic = app.QQMusic()
+        app.music_url_cache.set((mid, '128', qqmusic.cookie_id), {
+            'url': f'https://fake.stream/M500{mid}{mid}.mp3?vkey=fake', 'bitrate': '128kbps'}, 60)
+
+        response = client.get('/song', query_string={
+            'url': f'https://y.qq.com/n/ryqq/songDetail/{mid}', 'types': '320,128', 'lyric': '0'})
+
+        assert list(response.get_json()['music_urls']) == ['320', '128']
+        assert 55 <= int(response.headers['Cache-Control'].split('=')[1]) <= 60
+        assert 'ETag' not in client.get('/song', query_string={
+            'url': f'https://y.qq.com/n/ryqq/songDetail/{mid}', 'debug': '1'}).headers
+
+    def test_partial_failures_are_not_cached(self, client, fake_upstream, monkeypatch):
+        """A body with a failed lyric is neither kept nor cacheable downstream."""
+        query = {'url': 'https://y.qq.com/n/ryqq/songDetail/fake0000000018'}
+        parse_lyric = app.QQMusic._parse_lyric
+        monkeypatch.setattr(app.QQMusic, '_parse_lyric', Mock(side_effect=[ValueError('bad lyric')]))
+        failed = client.get('/song', query_string=query)
+        monkeypatch.setattr(app.QQMusic, '_parse_lyric', parse_lyric)
+        recovered = client.get('/song', query_string=query)
+
+        assert failed.get_json()['lyric'] == {'error': '无法获取歌词'}
+        assert failed.headers['Cache-Control'] == 'no-store'
+        assert 'error' not in recovered.get_json()['lyric']
+        assert recovered.headers['ETag'] != failed.headers['ETag']
+        assert recovered.headers['Cache-Control'].startswith('public, max-age=')
+
+    def test_upstream_failures_are_bad_gateway(self, client, fake_upstream, monkeypatch):
+        """Upstream 5xx replies and read timeouts map to 502, in both response modes."""
+        query = {'url': 'https://y.qq.com/n/ryqq/songDetail/fake0000000015'}
+        fake_upstream.error_rate = 1
+        failed = client.get('/song', query_string=query)
+        streamed = client.get('/song', query_string=dict(query, stream='1'))
+
+        fake_upstream.error_rate = 0
+        fake_upstream.latency = 0.2
+        monkeypatch.setattr(app, 'READ_TIMEOUT', 0.05)
+        timed_out = client.get('/song', query_string=query)
+
+        for response in (failed, streamed, timed_out):
+            assert response.status_code == 502
+            assert response.get_json()['error'].startswith('请求错误')
+
+    def test_outage_is_not_remembered_as_missing(self, client, fake_upstream):
+        """Errors and throttled replies are not cached as missing songs, so lookups recover."""
+        query = {'url': 'https://y.qq.com/n/ryqq/songDetail/fake0000000016'}
+        bundle = {'url': 'https://y.qq.com/n/ryqq/songDetail/fake0000000017?songid=17'}
+        bulk = {'urls': ['fake0000000018', 'fake0000000019'], 'types': ['320']}
+
+        fake_upstream.error_rate = 1
+        down = [client.get('/song', query_string=query), client.get('/song', query_string=bundle)]
+        down_bulk = client.post('/songs', json=bulk).get_json()
+        fake_upstream.error_rate = 0
+        fake_upstream.code = 2001
+        throttled = [client.get('/song', query_string=query), client.get('/song', query_string=bundle)]
+        throttled_bulk = client.post('/songs', json=bulk).get_json()
+        assert len(app.negative_cache) == 0
+
+        fake_upstream.code = 0
+        up = [client.get('/song', query_string=query), client.get('/song', query_string=bundle)]
+        up_bulk = client.post('/songs', json=bulk).get_json()
+
+        assert [response.status_code for response in down + throttled + up] == [502] * 4 + [200] * 2
+        for result in list(down_bulk.values()) + list(throttled_bulk.values()):
+            assert result['error'].startswith('请求错误')
+        assert [result['song']['id'] for result in up_bulk.values()] == [18, 19]
+        assert '320' in up[1].get_json()['music_urls']
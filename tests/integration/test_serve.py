@@ -0,0 +1,81 @@
+"""
+Integration test for the prefork server: runs serve.py in a subprocess.
+"""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url, process, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        assert process.poll() is None, process.stdout.read()
+        try:
+            return requests.get(url, timeout=5)
+        except (requests.ConnectionError, requests.Timeout):
+            time.sleep(0.1)
+    raise AssertionError('server did not start')
+
+
+@pytest.mark.integration
+@pytest.mark.slow
+def test_workers_recycle_and_shut_down_gracefully(tmp_path):
+    port = free_port()
+    env = dict(os.environ, QQMUSIC_WARMER='0', QQMUSIC_METADATA_DB=str(tmp_path / 'metadata.db'),
+               QQMUSIC_SHORT_LINK_CACHE=str(tmp_path / 'short_links.json'))
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'serve.py'), '--host', '127.0.0.1', '--port', str(port),
+         '--workers', '2', '--threads', '2', '--max-requests', '3'],
+        cwd=str(tmp_path), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        url = f'http://127.0.0.1:{port}/metrics'
+        statuses = [wait_until_ready(url, process).status_code]
+        statuses += [requests.get(url, timeout=5).status_code for _ in range(11)]
+        process.send_signal(signal.SIGTERM)
+        output = process.communicate(timeout=15)[0]
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    assert statuses == [200] * 12
+    assert process.returncode == 0
+    assert 'with 2 2-thread workers' in output
+    assert 'recycling after 3 requests' in output
+
+
+@pytest.mark.integration
+@pytest.mark.slow
+def test_exits_when_workers_cannot_boot(tmp_path):
+    """A bad cache URL crashes every worker on import, so the master gives up."""
+    env = dict(os.environ, QQMUSIC_WARMER='0', QQMUSIC_CACHE='bogus://cache')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'serve.py'), '--host', '127.0.0.1', '--port', str(free_port()),
+         '--workers', '2', '--async'],
+        cwd=str(tmp_path), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        output = process.communicate(timeout=30)[0]
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    assert process.returncode == 3
+    assert 'Unsupported cache backend' in output
+    assert 'failed to boot 5 times in a row' in output
+    assert 'async workers only serve /song, /metrics' in output
@@ -0,0 +1,224 @@
+"""
+Integration tests for the Flask /song endpoint.
+
+The shared upstream session is replaced with a fake that answers each
+upstream request kind, so the full request path runs without network.
+"""
+
+import json
+import pytest
+from unittest.mock import Mock
+
+import app
+
+
+class FakeUpstream:
+    """Answers detail, vkey and lyric requests and records what was asked."""
+
+    def __init__(self, sample_lyric_response):
+        self.calls = []
+        self.lyric = sample_lyric_response
+
+    def _response(self, payload):
+        response = Mock()
+        response.status_code = 200
+        response.json.return_value = payload
+        response.raise_for_status.return_value = None
+        response.headers = {}
+        return response
+
+    def post(self, url, json=None, data=None, **kwargs):
+        if data is not None:
+            self.calls.append('detail')
+            return self._response({'data': [{
+                'mid': '001abc', 'id': 42, 'name': 'Song', 'album': {'mid': 'alb', 'name': 'Album'},
+                'singer': [{'name': 'A'}], 'file': {'size_flac': 0, 'size_320mp3': 250, 'size_128mp3': 100},
+            }]})
+        if 'req_1' in json:
+            self.calls.append('vkey')
+            param = json['req_1']['param']
+            infos = [{'filename': name, 'purl': f'{name}?vkey=1'} for name in param['filename']]
+            return self._response({'req_1': {'data': {'sip': ['', 'https://cdn/'], 'midurlinfo': infos}}})
+        self.calls.append('lyric')
+        return self._response(self.lyric)
+
+    def get(self, url, **kwargs):
+        self.calls.append('redirect')
+        response = self._response({})
+        response.headers = {'Location': 'https://y.qq.com/n/ryqq/songDetail/001abc'}
+        return response
+
+
+@pytest.fixture
+def upstream(monkeypatch, sample_lyric_response):
+    fake = FakeUpstream(sample_lyric_response)
+    monkeypatch.setattr(app, '_session', fake)
+    return fake
+
+
+@pytest.fixture
+def client():
+    app.app.config['TESTING'] = True
+    return app.app.test_client()
+
+
+@pytest.mark.integration
+class TestSongEndpoint:
+    """Tests for GET /song."""
+
+    def test_requires_url(self, client):
+        assert client.get('/song').status_code == 400
+
+    def test_full_response(self, client, upstream):
+        """Default call returns song, lyric and all available qualities."""
+        response = client.get('/song', query_string={'url': 'https://y.qq.com/n/ryqq/songDetail/001abc'})
+        body = json.loads(response.data)
+
+        assert response.status_code == 200
+        assert list(body) == ['song', 'lyric', 'music_urls']
+        assert 'flac' not in body['music_urls']
+        assert body['music_urls']['320']['size'] == 250
+        assert sorted(upstream.calls) == ['detail', 'lyric', 'vkey']
+
+    def test_prefer_returns_first_available(self, client, upstream):
+        """prefer picks the first available quality and skips known-missing ones."""
+        response = client.get('/song', query_string={
+            'url': 'https://y.qq.com/n/ryqq/songDetail/001abc',
+            'prefer': 'flac,320,128',
+            'lyric': '0',
+        })
+        body = json.loads(response.data)
+
+        assert list(body) == ['song', 'music_urls']
+        assert list(body['music_urls']) == ['320']
+        assert upstream.calls == ['detail', 'vkey']
+
+    def test_minimal_call_skips_detail_and_lyric(self, client, upstream):
+        """With a mid in the link, detail=0&lyric=0 costs a single vkey call."""
+        response = client.get('/song', query_string={
+            'url': 'https://y.qq.com/n/ryqq/songDetail/001abc',
+            'types': '320',
+            'detail': '0',
+            'lyric': 'false',
+        })
+        body = json.loads(response.data)
+
+        assert body == {'music_urls': {'320': {'url': 'https://cdn/M800001abc001abc.mp3?vkey=1', 'bitrate': '320kbps'}}}
+        assert upstream.calls == ['vkey']
+
+    def test_restart_serves_metadata_from_store(self, client, upstream):
+        """After in-memory caches are lost, only the vkey is fetched again."""
+        url = 'https://y.qq.com/n/ryqq/songDetail/001abc'
+        first = json.loads(client.get('/song', query_string={'url': url}).data)
+        app.music_url_cache.clear()
+        app.negative_cache.clear()
+        app.song_response_cache.clear()
+        upstream.calls.clear()
+
+        second = json.loads(client.get('/song', query_string={'url': url}).data)
+        assert second == first
+        assert upstream.calls == ['vkey']
+
+    def test_invalid_type(self, client, upstream):
+        response = client.get('/song', query_string={'url': 'https://y.qq.com/n/ryqq/songDetail/001abc', 'types': 'wav'})
+        assert response.status_code == 400
+        assert upstream.calls == []
+
+
+@pytest.mark.integration
+class TestSongsEndpoint:
+    """Tests for POST /songs."""
+
+    def test_results_keyed_by_input(self, client, upstream):
+        """Duplicates collapse and each input gets its own result or error."""
+        def post(url, json=None, data=None, **kwargs):
+            if 'req_1' not in json:
+                upstream.calls.append('details')
+                return upstream._response({
+                    'detail_0': {'data': {'track_info': {'mid': '001abc', 'id': 42, 'file': {'size_320mp3': 9}}}},
+                    'detail_1': {'code': 0, 'data': {}},
+                })
+            return FakeUpstream.post(upstream, url, json=json, **kwargs)
+
+        upstream.post = post
+        response = client.post('/songs', json={
+            'urls': ['https://y.qq.com/n/ryqq/songDetail/001abc', '001abc', '999', 'https://example.com/x'],
+            'types': ['320'],
+        })
+        body = json.loads(response.data)
+
+        assert response.status_code == 200
+        assert body['https://y.qq.com/n/ryqq/songDetail/001abc']['music_urls']['320']['size'] == 9
+        assert body['001abc']['song']['id'] == 42
+        assert body['999'] == {'error': '信息获取错误/歌曲不存在'}
+        assert body['https://example.com/x'] == {'error': 'unsupported url'}
+        assert upstream.calls == ['details', 'vkey']
+
+    def test_rejects_bad_body(self, client):
+        assert client.post('/songs', json={'urls': 'x'}).status_code == 400
+        assert client.post('/songs', json=[1, 2]).status_code == 400
+
+
+@pytest.mark.integration
+class TestPreloadEndpoint:
+    """Tests for POST /admin/preload."""
+
+    def test_preload_warms_and_tracks(self, client, upstream, monkeypatch):
+        """Preloaded songs are resolved once and rank as hot for the warmer."""
+        monkeypatch.setattr(app, 'ADMIN_TOKEN', 'secret')
+        def post(url, json=None, data=None, **kwargs):
+            if 'req_1' not in json:
+                return upstream._response({'detail_0': {'data': {'track_info': {'mid': '001abc', 'id': 42}}}})
+            return FakeUpstream.post(upstream, url, json=json, **kwargs)
+
+        upstream.post = post
+        response = client.post('/admin/preload', json={'urls': ['https://y.qq.com/n/ryqq/songDetail/001abc'], 'types': '320'},
+                               headers={'X-Admin-Token': 'secret'})
+
+        assert json.loads(response.data) == {'preloaded': 1, 'errors': {}}
+        assert ('001abc', '320', app.get_cookie_pool().id) in app.music_url_cache
+        assert app.cache_warmer.hot() == [('001abc', ['320'])]
+        assert app.cache_warmer.scores['001abc'] > app.WARMER_PRELOAD_WEIGHT
+
+    def test_requires_admin_token_when_configured(self, client, upstream, monkeypatch):
+        monkeypatch.setattr(app, 'ADMIN_TOKEN', 'secret')
+        assert client.post('/admin/preload', json=['001abc']).status_code == 403
+        response = client.post('/admin/preload', json=['001abc'], headers={'X-Admin-Token': 'secret'})
+        assert response.status_code == 200
+
+    def test_disabled_without_a_token(self, client, upstream):
+        """Without QQMUSIC_ADMIN_TOKEN even loopback clients, e.g. behind a local proxy, are refused."""
+        response = client.post('/admin/preload', json=['001abc'], environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        assert response.status_code == 403
+        assert upstream.calls == []
+
+
+@pytest.mark.integration
+class TestStreaming:
+    """Tests for the NDJSON streaming mode."""
+
+    def test_song_stream_order(self, client, upstream):
+        """Song info comes first, then one record per quality, then lyrics."""
+        response = client.get('/song', query_string={
+            'url': 'https://y.qq.com/n/ryqq/songDetail/001abc',
+            'types': '320,128',
+            'stream': '1',
+        })
+        records = [json.loads(line) for line in response.data.decode().splitlines()]
+
+        assert response.content_type == 'application/x-ndjson'
+        assert [record['type'] for record in records] == ['song', 'music_url', 'music_url', 'lyric']
+        assert [record.get('file_type') for record in records[1:3]] == ['320', '128']
+
+    def test_song_stream_keeps_error_status(self, client, upstream):
+        """Errors before the first record still map to an HTTP status."""
+        response = client.get('/song', query_string={'url': 'https://example.com/x', 'stream': '1'})
+        assert response.status_code == 400
+
+    def test_bulk_stream_one_record_per_song(self, client, upstream):
+        """Bulk streaming emits a record for each input."""
+        response = client.post('/songs', json={'urls': ['https://example.com/x', ''], 'stream': True})
+        records = [json.loads(line) for line in response.data.decode().splitlines()]
+
+        assert [record['input'] for record in records] == ['https://example.com/x', '']
+        assert all('error' in record['result'] for record in records)
@@ -0,0 +1,203 @@
+"""
+Integration tests for the /stream audio proxy.
+
+The fake upstream serves both the vkey API and the audio CDN, so these
+cover URL resolution, Range forwarding and chunked proxying end to end.
+"""
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def client():
+    app.app.config['TESTING'] = True
+    return app.app.test_client()
+
+
+def audio_name(mid, file_type):
+    conf = app.FILE_CONFIG[file_type]
+    return f"{conf['s']}{mid}{mid}{conf['e']}"
+
+
+@pytest.mark.integration
+class TestStreamEndpoint:
+    """Tests for GET /stream."""
+
+    def test_full_file_and_range(self, client, fake_upstream):
+        """Ranges are forwarded and the resolved vkey is reused for seeking."""
+        data = fake_upstream.audio(audio_name('fake0000000001', '320'))
+        query = {'mid': 'fake0000000001', 'type': '320'}
+
+        full = client.get('/stream', query_string=query)
+        seek = client.get('/stream', query_string=query, headers={'Range': 'bytes=1000-1999'})
+
+        assert full.status_code == 200
+        assert full.data == data
+        assert full.headers['Accept-Ranges'] == 'bytes'
+        assert full.headers['Content-Length'] == str(len(data))
+        assert seek.status_code == 206
+        assert seek.data == data[1000:2000]
+        assert seek.headers['Content-Range'] == f'bytes 1000-1999/{len(data)}'
+        assert fake_upstream.calls == {'vkey': 1, 'audio': 2}
+
+    def test_body_is_proxied_in_chunks(self, client, fake_upstream):
+        """The response is a stream of bounded chunks, never one buffered body."""
+        fake_upstream.audio_size = app.STREAM_CHUNK_SIZE * 4 + 10
+        response = client.get('/stream', query_string={'mid': 'fake0000000002', 'type': 'flac'}, buffered=False)
+        chunks = list(response.response)
+        response.close()
+
+        assert len(chunks) >= 5
+        assert max(len(chunk) for chunk in chunks) <= app.STREAM_CHUNK_SIZE
+        assert sum(len(chunk) for chunk in chunks) == fake_upstream.audio_size
+
+    def test_share_link(self, client, fake_upstream):
+        response = client.get('/stream', query_string={
+            'url': 'https://c6.y.qq.com/base/fcgi-bin/u?__=fake0000000003', 'type': '128'})
+
+        assert response.data == fake_upstream.audio(audio_name('fake0000000003', '128'))
+        assert fake_upstream.calls['redirect'] == 1
+
+    def test_missing_song_id_is_not_found(self, client, fake_upstream, monkeypatch):
+        monkeypatch.setattr(app.QQMusic, 'get_music_song', lambda self, mid, sid: {'msg': '信息获取错误/歌曲不存在'})
+        response = client.get('/stream', query_string={'url': 'https://y.qq.com/portal/player.html#songid=404'})
+
+        assert response.status_code == 404
+        assert response.get_json() == {'error': '信息获取错误/歌曲不存在'}
+        assert fake_upstream.calls == {}
+
+    def test_expired_vkey_is_resolved_again(self, client, fake_upstream):
+        """A cached URL the CDN rejects is dropped and resolved once more."""
+        mid = 'fake0000000004'
+        qqmusic = app.QQMusic()
+        app.music_url_cache.set((mid, 'flac', qqmusic.cookie_id), {
+            'url': f"https://fake.stream/{audio_name(mid, 'flac')}?vkey=expired", 'bitrate': 'FLAC'})
+
+        response = client.get('/stream', query_string={'mid': mid, 'type': 'flac'})
+
+        assert response.status_code == 200
+        assert fake_upstream.calls == {'audio': 2, 'vkey': 1}
+        assert 'vkey=fake' in app.music_url_cache.get((mid, 'flac', qqmusic.cookie_id))['url']
+
+    def test_errors(self, client, fake_upstream):
+        fake_upstream.formats = {'128'}
+
+        assert client.get('/stream', query_string={'mid': 'fake0000000005', 'type': 'flac'}).status_code == 404
+        assert client.get('/stream', query_string={'mid': 'fake0000000005', 'type': 'wav'}).status_code == 400
+        assert client.get('/stream', query_string={'type': '128'}).status_code == 400
+
+
+@pytest.fixture
+def audio_cache(tmp_path):
+    cache = app.AudioCache(str(tmp_path / 'audio'))
+    app._audio_cache = cache
+    yield cache
+    cache.close()
+
+
+@pytest.mark.integration
+class TestAudioCache:
+    """Tests for the disk cache behind /stream."""
+
+    def test_second_listener_is_served_from_disk(self, client, fake_upstream, audio_cache):
+        data = fake_upstream.audio(audio_name('fake0000000006', 'flac'))
+        query = {'mid': 'fake0000000006', 'type': 'flac'}
+
+        first = client.get('/stream', query_string=query)
+        audio_cache.close()
+        calls = dict(fake_upstream.calls)
+        second = client.get('/stream', query_string=query)
+        seek = client.get('/stream', query_string=query, headers={'Range': 'bytes=10-19'})
+
+        assert first.data == second.data == data
+        assert calls == {'vkey': 1, 'audio': 2}
+        assert fake_upstream.calls == calls
+        assert second.headers['Content-Type'] == 'audio/flac'
+        assert seek.status_code == 206
+        assert seek.data == data[10:20]
+        assert audio_cache.stats()['hits'] == 2
+
+    def test_mid_cannot_escape_the_cache_directory(self, client, fake_upstream, audio_cache):
+        for mid in ('../../etc/passwd', '..', 'fake0000000011/../x', 'fake0000000011.flac'):
+            response = client.get('/stream', query_string={'mid': mid, 'type': 'flac'})
+            assert response.status_code == 400, mid
+        assert fake_upstream.calls == {}
+        assert audio_cache.stats()['misses'] == 0
+        with pytest.raises(ValueError):
+            audio_cache.get('../fake0000000011', 'flac')
+
+    def test_hits_are_handed_to_the_proxy(self, client, fake_upstream, audio_cache, monkeypatch):
+        """With X-Accel-Redirect configured the body is left to the fronting proxy."""
+        monkeypatch.setattr(app, 'AUDIO_ACCEL_REDIRECT', '/_audio/')
+        fake_upstream.audio(audio_name('fake0000000012', 'flac'))
+        audio_cache.download(app.QQMusic(), 'fake0000000012', 'flac')
+
+        response = client.get('/stream', query_string={'mid': 'fake0000000012', 'type': 'flac'})
+
+        assert response.status_code == 200
+        assert response.data == b''
+        assert response.headers['X-Accel-Redirect'] == '/_audio/fake0000000012.flac.flac'
+        assert response.headers['Content-Type'] == 'audio/flac'
+
+    def test_partial_download_is_resumed(self, fake_upstream, audio_cache):
+        data = fake_upstream.audio(audio_name('fake0000000007', '320'))
+        name = app.AudioCache.filename('fake0000000007', '320')
+        with open(f'{audio_cache.path}/{name}.part', 'wb') as f:
+            f.write(data[:1000])
+
+        path = audio_cache.download(app.QQMusic(), 'fake0000000007', '320')
+
+        assert fake_upstream.ranges == ['bytes=1000-']
+        with open(path, 'rb') as f:
+            assert f.read() == data
+        assert audio_cache.stats()['bytes'] == len(data)
+
+    def test_stale_part_is_downloaded_again(self, fake_upstream, audio_cache):
+        """A .part longer than the upstream file gets a 416 and is replaced, not kept forever."""
+        data = fake_upstream.audio(audio_name('fake0000000013', '320'))
+        name = app.AudioCache.filename('fake0000000013', '320')
+        with open(f'{audio_cache.path}/{name}.part', 'wb') as f:
+            f.write(b'x' * (len(data) + 10))
+
+        path = audio_cache.download(app.QQMusic(), 'fake0000000013', '320')
+
+        assert fake_upstream.ranges[0] == f'bytes={len(data) + 10}-'
+        with open(path, 'rb') as f:
+            assert f.read() == data
+        assert audio_cache.stats()['part_bytes'] == 0
+
+    def test_leftover_parts_count_towards_the_budget(self, tmp_path, fake_upstream):
+        """Parts of failed downloads are counted and evicted before complete files."""
+        fake_upstream.audio_size = 1000
+        path = tmp_path / 'audio'
+        path.mkdir()
+        (path / 'orphan.flac.flac.part').write_bytes(b'x' * 800)
+        cache = app.AudioCache(str(path), max_bytes=2500)
+        assert cache.stats()['part_bytes'] == 800
+
+        qqmusic = app.QQMusic()
+        cache.download(qqmusic, 'fake0000000014', '128')
+        cache.download(qqmusic, 'fake0000000015', '128')
+
+        assert not (path / 'orphan.flac.flac.part').exists()
+        assert cache.stats()['part_bytes'] == 0
+        assert cache.stats()['files'] == 2
+        assert cache.stats()['evictions'] == 1
+
+    def test_least_recently_used_files_are_evicted(self, tmp_path, fake_upstream):
+        fake_upstream.audio_size = 1000
+        cache = app.AudioCache(str(tmp_path / 'audio'), max_bytes=2500)
+        qqmusic = app.QQMusic()
+        cache.download(qqmusic, 'fake0000000008', '128')
+        cache.download(qqmusic, 'fake0000000009', '128')
+        assert cache.get('fake0000000008', '128')
+        cache.download(qqmusic, 'fake0000000010', '128')
+
+        assert cache.get('fake0000000009', '128') is None
+        assert cache.get('fake0000000008', '128') and cache.get('fake0000000010', '128')
+        assert cache.stats()['evictions'] == 1
+        # a restarted process picks the cached files back up
+        assert app.AudioCache(cache.path, max_bytes=2500).stats()['files'] == 2
+        cache.close()
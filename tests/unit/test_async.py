@@ -0,0 +1,326 @@
+"""
+Unit tests for the asyncio client and the async /song endpoint.
+"""
+
+import asyncio
+import json
+import threading
+import time
+import pytest
+from unittest.mock import AsyncMock, Mock, patch
+
+import app
+
+pytest.importorskip('aiohttp')
+from aiohttp.test_utils import TestClient, TestServer
+
+
+class FakeResponse:
+    """Minimal stand-in for an aiohttp response context manager."""
+
+    def __init__(self, payload, headers=None):
+        self.payload = payload
+        self.headers = headers or {}
+        self.status = 200
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        return None
+
+    async def json(self, content_type='application/json'):
+        return self.payload
+
+
+class FakeSession:
+    """Records calls and replies with canned payloads keyed by request kind."""
+
+    def __init__(self, payloads):
+        self.payloads = payloads
+        self.calls = []
+
+    def post(self, url, **kwargs):
+        self.calls.append(('post', url, kwargs))
+        body = kwargs.get('json') or {}
+        if 'req_1' in body:
+            return FakeResponse(self.payloads['vkey'])
+        if 'data' in kwargs:
+            return FakeResponse(self.payloads['song'])
+        return FakeResponse(self.payloads['lyric'])
+
+    def get(self, url, **kwargs):
+        self.calls.append(('get', url, kwargs))
+        return FakeResponse({}, headers={'Location': 'https://y.qq.com/n/ryqq/songDetail/001abc'})
+
+
+@pytest.fixture
+def payloads(sample_lyric_response):
+    return {
+        'song': {'data': [{'mid': '001abc', 'id': 42, 'name': 'Song', 'album': {}, 'singer': []}]},
+        'vkey': {'req_1': {'data': {
+            'sip': ['', 'https://cdn/'],
+            'midurlinfo': [{'filename': 'M800001abc001abc.mp3', 'purl': 'M800001abc001abc.mp3?vkey=1'}],
+        }}},
+        'lyric': sample_lyric_response,
+    }
+
+
+@pytest.mark.unit
+class TestAsyncQQMusic:
+    """Tests for AsyncQQMusic."""
+
+    def test_methods_mirror_sync_client(self, payloads):
+        """The async client builds the same requests and parses the same shapes."""
+        session = FakeSession(payloads)
+        qqmusic = app.AsyncQQMusic(session=session)
+
+        async def run():
+            mid = await qqmusic.ids('https://c6.y.qq.com/base/fcgi-bin/u?__=abc')
+            info = await qqmusic.get_music_song(mid, 0)
+            url = await qqmusic.get_music_url(info['mid'], '320')
+            lyric = await qqmusic.get_music_lyric_new(info['id'])
+            return mid, info, url, lyric
+
+        mid, info, url, lyric = asyncio.run(run())
+        assert mid == '001abc'
+        assert info['id'] == 42
+        assert url == {'url': 'https://cdn/M800001abc001abc.mp3?vkey=1', 'bitrate': '320kbps'}
+        assert lyric['lyric'].startswith('[00:00.00]')
+        assert session.calls[1][2]['data'] == {'songmid': '001abc', 'platform': 'yqq', 'format': 'json'}
+
+    def test_cache_backend_calls_stay_off_the_event_loop(self, payloads):
+        """Shared backends block on sockets, so the async client calls them from worker threads."""
+        threads = []
+
+        class RecordingCache(app.TTLCache):
+            shared = True
+
+            def get_many(self, keys):
+                threads.append(threading.get_ident())
+                return super().get_many(keys)
+
+            def set_many(self, mapping, ttl=None):
+                threads.append(threading.get_ident())
+                super().set_many(mapping, ttl)
+
+        qqmusic = app.AsyncQQMusic(session=FakeSession(payloads))
+        qqmusic.url_cache = RecordingCache()
+
+        async def run():
+            info = await qqmusic.get_music_song('001abc', 0)
+            await qqmusic.get_music_urls(info['mid'], ['320'])
+            await qqmusic.get_music_lyric_new(info['id'])
+            return threading.get_ident()
+
+        loop_thread = asyncio.run(run())
+        assert threads and loop_thread not in threads
+
+    def test_shared_backend_lock_is_honoured(self, temp_dir, monkeypatch):
+        """With a shared backend the async client waits for the node holding the vkey lock."""
+        monkeypatch.setattr(app, 'CACHE_LOCK_POLL', 0.01)
+        cache = app.create_cache(f"sqlite:{temp_dir / 'cache.db'}")
+        detail = {'code': 0, 'detail': {'code': 0, 'data': {'track_info': {
+            'mid': '001abc', 'id': 42, 'name': 'Song', 'album': {}, 'singer': [], 'file': {}}}}}
+        session = FakeSession({'lyric': detail})
+        qqmusic = app.AsyncQQMusic(session=session)
+        qqmusic.url_cache = cache
+        qqmusic.store = None
+        key = ('001abc', '320', qqmusic.cookie_id)
+        cache.add(('lock',) + key, 1, 5)
+
+        def holder():
+            time.sleep(0.05)
+            cache.set(key, {'url': 'https://cdn/shared', 'bitrate': '320kbps'})
+            cache.delete(('lock',) + key)
+
+        async def run():
+            return await asyncio.gather(qqmusic.get_music_urls('001abc', ['320']),
+                                        qqmusic.get_song_bundle('001abc', 42, ['320'], lyric=False))
+
+        thread = threading.Thread(target=holder)
+        thread.start()
+        urls, bundle = asyncio.run(run())
+        thread.join()
+
+        assert urls == {'320': {'url': 'https://cdn/shared', 'bitrate': '320kbps'}}
+        assert bundle['music_urls'] == urls
+        # the bundle still fetches the details, but leaves the locked vkey to its holder
+        [(_, _, kwargs)] = session.calls
+        assert 'req_1' not in kwargs['json']
+
+    def test_error_codes_count_as_throttling(self, payloads):
+        """A throttled module code backs off the limiter just like an HTTP 429."""
+        payloads['vkey'] = {'code': 0, 'req_1': {'code': 2001}}
+        qqmusic = app.AsyncQQMusic(session=FakeSession(payloads))
+        qqmusic.limiter = Mock(acquire_async=AsyncMock())
+
+        with pytest.raises(app.UpstreamError):
+            asyncio.run(qqmusic.get_music_urls('001abc', ['320']))
+        qqmusic.limiter.report.assert_called_once_with('u.y.qq.com', False)
+
+
+    def test_invalid_json_is_an_upstream_error(self, payloads):
+        """An undecodable body is reported like a failed request and raised as UpstreamError."""
+        class BrokenResponse(FakeResponse):
+            async def json(self, content_type='application/json'):
+                return json.loads('<html>busy</html>')
+
+        session = FakeSession(payloads)
+        session.post = lambda url, **kwargs: BrokenResponse(None)
+        qqmusic = app.AsyncQQMusic(session=session)
+        qqmusic.limiter = Mock(acquire_async=AsyncMock())
+
+        with pytest.raises(app.UpstreamError, match='invalid JSON'):
+            asyncio.run(qqmusic.get_music_urls('001abc', ['320']))
+        qqmusic.limiter.report.assert_called_once_with('u.y.qq.com', False)
+
+
+@pytest.mark.unit
+class TestAsyncSongEndpoint:
+    """Tests for the aiohttp /song handler."""
+
+    def test_vkey_and_lyric_run_concurrently(self, payloads):
+        """After the detail lookup, vkey and lyric requests overlap."""
+        active = {'now': 0, 'peak': 0}
+
+        async def tracked(result):
+            active['now'] += 1
+            active['peak'] = max(active['peak'], active['now'])
+            await asyncio.sleep(0.01)
+            active['now'] -= 1
+            return result
+
+        async def get_music_urls(self, mid, file_types, sizes=None):
+            return await tracked({'320': {'url': 'u', 'bitrate': '320kbps'}})
+
+        async def get_music_lyric_new(self, songid):
+            return await tracked({'lyric': 'l', 'tylyric': ''})
+
+        async def get_music_song(self, mid, sid):
+            return {'mid': '001abc', 'id': 42}
+
+        async def ids(self, url):
+            return '001abc'
+
+        async def run():
+            client = TestClient(TestServer(app.create_async_app()))
+            await client.start_server()
+            try:
+                missing = await client.get('/song')
+                response = await client.get('/song', params={'url': 'https://y.qq.com/n/ryqq/songDetail/001abc', 'debug': '1'})
+                return missing.status, response.headers['Server-Timing'], await response.json()
+            finally:
+                await client.close()
+
+        with patch.object(app.AsyncQQMusic, 'ids', ids), \
+                patch.object(app.AsyncQQMusic, 'get_music_song', get_music_song), \
+                patch.object(app.AsyncQQMusic, 'get_music_urls', get_music_urls), \
+                patch.object(app.AsyncQQMusic, 'get_music_lyric_new', get_music_lyric_new):
+            status, timing, body = asyncio.run(run())
+
+        assert status == 400
+        assert body['music_urls']['320']['url'] == 'u'
+        assert body['lyric']['lyric'] == 'l'
+        assert active['peak'] == 2
+        # the concurrent spans both hang off the request and overlap in time
+        lyric, urls = body['trace']['children'][-2:]
+        assert (lyric['name'], urls['name']) == ('lyric', 'urls')
+        assert urls['start_ms'] < lyric['start_ms'] + lyric['dur_ms']
+        assert timing.startswith('parse;dur=') and 'serialize;dur=' in timing
+
+    def test_conditional_requests(self):
+        """The async handler shares the response cache and answers If-None-Match with a 304."""
+        calls = []
+
+        async def get_music_urls(self, mid, file_types, sizes=None):
+            calls.append(mid)
+            return {'320': {'url': 'u', 'bitrate': '320kbps'}}
+
+        async def ids(self, url):
+            return '001abc'
+
+        async def run():
+            client = TestClient(TestServer(app.create_async_app()))
+            await client.start_server()
+            try:
+                params = {'url': 'https://y.qq.com/n/ryqq/songDetail/001abc', 'types': '320', 'lyric': '0', 'detail': '0'}
+                first = await client.get('/song', params=params)
+                body = await first.read()
+                second = await client.get('/song', params=params, headers={'If-None-Match': first.headers['ETag']})
+                return first.headers, body, second.status, second.headers
+            finally:
+                await client.close()
+
+        app.music_url_cache.set(('001abc', '320', app.QQMusic().cookie_id), {'url': 'u', 'bitrate': '320kbps'}, 100)
+        with patch.object(app.AsyncQQMusic, 'ids', ids), \
+                patch.object(app.AsyncQQMusic, 'get_music_urls', get_music_urls):
+            headers, body, status, repeat = asyncio.run(run())
+
+        assert json.loads(body) == {'music_urls': {'320': {'url': 'u', 'bitrate': '320kbps'}}}
+        assert 95 <= int(headers['Cache-Control'].split('=')[1]) <= 100
+        assert status == 304
+        assert repeat['ETag'] == headers['ETag']
+        assert calls == ['001abc']
+
+    def test_upstream_timeout_is_bad_gateway(self):
+        async def get_music_song(self, mid, sid):
+            raise asyncio.TimeoutError()
+
+        async def run():
+            client = TestClient(TestServer(app.create_async_app()))
+            await client.start_server()
+            try:
+                response = await client.get('/song', params={'url': 'https://y.qq.com/n/ryqq/songDetail/001abc'})
+                return response.status, await response.json()
+            finally:
+                await client.close()
+
+        with patch.object(app.AsyncQQMusic, 'get_music_song', get_music_song):
+            status, body = asyncio.run(run())
+
+        assert status == 502
+        assert body['error'].startswith('请求错误')
+
+    def test_invalid_json_is_bad_gateway(self, payloads):
+        """Async /song answers 502 for a non-JSON upstream body, like the sync endpoint."""
+        class BrokenResponse(FakeResponse):
+            async def json(self, content_type='application/json'):
+                return json.loads('<html>busy</html>')
+
+        async def run():
+            client = TestClient(TestServer(app.create_async_app()))
+            await client.start_server()
+            try:
+                response = await client.get('/song', params={'url': 'https://y.qq.com/n/ryqq/songDetail/001abc'})
+                return response.status, await response.json()
+            finally:
+                await client.close()
+
+        session = FakeSession(payloads)
+        session.post = lambda url, **kwargs: BrokenResponse(None)
+        with patch.object(app, 'get_async_session', return_value=session):
+            status, body = asyncio.run(run())
+
+        assert status == 502
+        assert 'invalid JSON' in body['error']
+
+    def test_metrics_endpoint(self):
+        """Async requests are counted per route and exposed on /metrics."""
+        async def run():
+            client = TestClient(TestServer(app.create_async_app()))
+            await client.start_server()
+            try:
+                await client.get('/song')
+                response = await client.get('/metrics')
+                return response.headers['Content-Type'], await response.text()
+            finally:
+                await client.close()
+
+        content_type, text = asyncio.run(run())
+        assert content_type.startswith('text/plain; version=0.0.4')
+        assert 'qqmusic_http_requests_total{endpoint="/song",status="400"} 1' in text
+        assert 'qqmusic_http_request_duration_seconds_count{endpoint="/song"} 1' in text
@@ -0,0 +1,266 @@
+"""
+Unit tests for the query cache backends.
+
+The Redis backend is exercised against a small in-process server that
+speaks enough of the RESP protocol for the commands the client sends.
+"""
+
+import socketserver
+import threading
+import time
+
+import pytest
+from unittest.mock import Mock
+
+import app
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Handles one client connection, one RESP command at a time."""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def write_bulk(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def handle(self):
+        server = self.server
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            name = args[0].upper()
+            server.commands.append(name.decode())
+            with server.lock:
+                now = time.monotonic()
+                for key in [key for key, (_, expires) in server.data.items() if expires <= now]:
+                    del server.data[key]
+                if name == b'MGET':
+                    reply = b'*%d\r\n' % (len(args) - 1)
+                    reply += b''.join(self.write_bulk(server.data.get(key, (None,))[0]) for key in args[1:])
+                elif name == b'SET':
+                    key, value, options = args[1], args[2], [arg.upper() for arg in args[3:]]
+                    expires = now + int(options[options.index(b'PX') + 1]) / 1000 if b'PX' in options else float('inf')
+                    if b'NX' in options and key in server.data:
+                        reply = b'$-1\r\n'
+                    else:
+                        server.data[key] = (value, expires)
+                        reply = b'+OK\r\n'
+                elif name == b'DEL':
+                    reply = b':%d\r\n' % sum(server.data.pop(key, None) is not None for key in args[1:])
+                elif name == b'EXISTS':
+                    reply = b':%d\r\n' % sum(key in server.data for key in args[1:])
+                elif name == b'SCAN':
+                    keys = list(server.data)
+                    reply = b'*2\r\n$1\r\n0\r\n*%d\r\n' % len(keys) + b''.join(self.write_bulk(key) for key in keys)
+                else:
+                    reply = b'-ERR unknown command\r\n'
+            self.wfile.write(reply)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeRedisHandler)
+        self.data = {}
+        self.commands = []
+        self.lock = threading.Lock()
+
+
+@pytest.fixture
+def redis_server():
+    server = FakeRedisServer()
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def backend(request, temp_dir):
+    if request.param == 'memory':
+        return app.create_cache('memory', ttl=60)
+    if request.param == 'sqlite':
+        return app.create_cache(f"sqlite:{temp_dir / 'cache.db'}", ttl=60)
+    server = request.getfixturevalue('redis_server')
+    return app.create_cache(f'redis://127.0.0.1:{server.server_address[1]}/0', ttl=60)
+
+
+@pytest.mark.unit
+class TestCacheBackends:
+    """Every backend implements the same contract."""
+
+    def test_batched_get_and_set(self, backend):
+        backend.set_many({('001abc', '320', 'c'): {'url': 'u1'}, ('001abc', 'flac', 'c'): {'url': 'u2'}})
+        found = backend.get_many([('001abc', '320', 'c'), ('001abc', 'flac', 'c'), ('001abc', 'm4a', 'c')])
+        assert found == {('001abc', '320', 'c'): {'url': 'u1'}, ('001abc', 'flac', 'c'): {'url': 'u2'}}
+        assert ('001abc', '320', 'c') in backend
+        assert backend.get(('001abc', 'm4a', 'c')) is None
+
+    def test_entries_expire(self, backend):
+        backend.set(('song', 42), {'mid': '001abc'}, ttl=0.01)
+        time.sleep(0.05)
+        assert backend.get(('song', 42)) is None
+
+    def test_add_only_sets_missing_keys(self, backend):
+        assert backend.add(('lock', 'a'), 1, ttl=5)
+        assert not backend.add(('lock', 'a'), 1, ttl=5)
+        backend.delete(('lock', 'a'))
+        assert backend.add(('lock', 'a'), 1, ttl=5)
+
+    def test_clear(self, backend):
+        backend.set(('song', 42), {'mid': '001abc'})
+        backend.clear()
+        assert backend.get_many([('song', 42)]) == {}
+
+
+@pytest.mark.unit
+class TestRedisCache:
+    """Tests specific to the networked backend."""
+
+    def test_batches_use_one_round_trip(self, redis_server):
+        cache = app.RedisCache('127.0.0.1', redis_server.server_address[1])
+        cache.set_many({('a',): 1, ('b',): 2})
+        cache.get_many([('a',), ('b',), ('c',)])
+        assert redis_server.commands == ['SET', 'SET', 'MGET']
+        assert redis_server.data[b'qqmusic:a'][0] == b'1'
+
+    def test_unreachable_server_degrades_to_misses(self, redis_server):
+        port = redis_server.server_address[1]
+        redis_server.shutdown()
+        redis_server.server_close()
+        cache = app.RedisCache('127.0.0.1', port, timeout=0.2)
+
+        cache.set(('a',), 1)
+        assert cache.get(('a',)) is None
+        assert cache.add(('lock', 'a'), 1)
+        assert cache.stats()['errors'] == 3
+
+
+@pytest.mark.unit
+class TestSharedCache:
+    """Tests for QQMusic lookups through a shared backend."""
+
+    def make_client(self, cache, payload):
+        session = Mock()
+        response = Mock()
+        response.status_code = 200
+        response.json.return_value = payload
+        session.post.return_value = response
+        qqmusic = app.QQMusic(session=session, url_cache=cache)
+        qqmusic.store = None
+        return qqmusic, session
+
+    def test_nodes_share_urls_and_details(self, temp_dir):
+        """A second node reuses the vkey and song info fetched by the first."""
+        path = f"sqlite:{temp_dir / 'cache.db'}"
+        vkey = {'req_1': {'data': {
+            'sip': ['', 'https://cdn/'],
+            'midurlinfo': [{'filename': 'M800001abc001abc.mp3', 'purl': 'M800001abc001abc.mp3?vkey=1'}],
+        }}}
+        first, _ = self.make_client(app.create_cache(path), vkey)
+        first.get_music_urls('001abc', ['320'])
+        first.session.post.return_value.json.return_value = {'data': [{'mid': '001abc', 'id': 42, 'name': 'Song'}]}
+        first.get_music_song('001abc', 0)
+
+        second, session = self.make_client(app.create_cache(path), {})
+        assert second.get_music_urls('001abc', ['320'])['320']['url'] == 'https://cdn/M800001abc001abc.mp3?vkey=1'
+        assert second.get_music_song('', 42)['name'] == 'Song'
+        assert second.get_music_songs([('001abc', 0)])[('001abc', 0)]['id'] == 42
+        session.post.assert_not_called()
+
+    def test_waits_for_node_holding_the_lock(self, temp_dir, monkeypatch):
+        """Only the lock holder fetches; the waiting node picks up its result."""
+        monkeypatch.setattr(app, 'CACHE_LOCK_POLL', 0.01)
+        cache = app.create_cache(f"sqlite:{temp_dir / 'cache.db'}")
+        qqmusic, session = self.make_client(cache, {})
+        key = ('001abc', '320', qqmusic.cookie_id)
+        cache.add(('lock',) + key, 1, 5)
+
+        def holder():
+            time.sleep(0.05)
+            cache.set(key, {'url': 'https://cdn/shared', 'bitrate': '320kbps'})
+            cache.delete(('lock',) + key)
+
+        thread = threading.Thread(target=holder)
+        thread.start()
+        urls = qqmusic.get_music_urls('001abc', ['320'])
+        thread.join()
+
+        assert urls == {'320': {'url': 'https://cdn/shared', 'bitrate': '320kbps'}}
+        session.post.assert_not_called()
+
+    def test_bundle_leaves_locked_qualities_to_the_holder(self, temp_dir, monkeypatch):
+        """The merged request carries only the vkeys this node holds the lock for."""
+        monkeypatch.setattr(app, 'CACHE_LOCK_POLL', 0.01)
+        cache = app.create_cache(f"sqlite:{temp_dir / 'cache.db'}")
+        detail = {'code': 0, 'detail': {'code': 0, 'data': {'track_info': {
+            'mid': '001abc', 'id': 42, 'name': 'Song', 'album': {}, 'singer': [], 'file': {}}}}}
+        qqmusic, session = self.make_client(cache, detail)
+        key = ('001abc', '320', qqmusic.cookie_id)
+        cache.add(('lock',) + key, 1, 5)
+
+        def holder():
+            time.sleep(0.05)
+            cache.set(key, {'url': 'https://cdn/shared', 'bitrate': '320kbps'})
+            cache.delete(('lock',) + key)
+
+        thread = threading.Thread(target=holder)
+        thread.start()
+        bundle = qqmusic.get_song_bundle('001abc', 42, ['320'], lyric=False)
+        thread.join()
+
+        assert bundle['music_urls'] == {'320': {'url': 'https://cdn/shared', 'bitrate': '320kbps'}}
+        assert 'req_1' not in session.post.call_args.kwargs['json']
+        assert ('lock',) + key not in cache
+
+    def test_waiter_fetches_itself_when_the_holder_fails(self, temp_dir, monkeypatch):
+        """A lock released without a result or an empty marker means the holder failed."""
+        monkeypatch.setattr(app, 'CACHE_LOCK_POLL', 0.01)
+        cache = app.create_cache(f"sqlite:{temp_dir / 'cache.db'}")
+        vkey = {'req_1': {'data': {
+            'sip': ['', 'https://cdn/'],
+            'midurlinfo': [{'filename': 'M800001abc001abc.mp3', 'purl': 'M800001abc001abc.mp3?vkey=1'}],
+        }}}
+        qqmusic, session = self.make_client(cache, vkey)
+        key = ('001abc', '320', qqmusic.cookie_id)
+        cache.add(('lock',) + key, 1, 5)
+        thread = threading.Timer(0.05, cache.delete, [('lock',) + key])
+        thread.start()
+        urls = qqmusic.get_music_urls('001abc', ['320'])
+        thread.join()
+
+        assert urls['320']['url'] == 'https://cdn/M800001abc001abc.mp3?vkey=1'
+        assert session.post.call_count == 1
+
+    def test_unavailable_quality_is_shared_with_waiters(self, temp_dir, monkeypatch):
+        """The holder marks qualities with an empty purl, so waiters do not fetch them again."""
+        monkeypatch.setattr(app, 'CACHE_LOCK_POLL', 0.01)
+        cache = app.create_cache(f"sqlite:{temp_dir / 'cache.db'}")
+        qqmusic, session = self.make_client(cache, {})
+        key = ('001abc', 'flac', qqmusic.cookie_id)
+        assert qqmusic._fetch_shared([key], lambda keys: {key: None for key in keys}) == {key: None}
+        assert ('empty',) + key in cache
+
+        cache.add(('lock',) + key, 1, 5)
+        thread = threading.Timer(0.05, cache.delete, [('lock',) + key])
+        thread.start()
+        urls = qqmusic.get_music_urls('001abc', ['flac'])
+        thread.join()
+
+        assert urls == {}
+        session.post.assert_not_called()
@@ -0,0 +1,724 @@
+"""
+Unit tests for the QQMusic client in app.py.
+
+Upstream HTTP calls go through a mock session so these tests never touch
+the network.
+"""
+
+import json
+import threading
+import time
+
+import pytest
+import requests
+from unittest.mock import Mock
+
+import app
+
+
+def make_response(payload):
+    """Build a mock requests response returning the given JSON payload."""
+    response = Mock()
+    response.status_code = 200
+    response.json.return_value = payload
+    response.raise_for_status.return_value = None
+    return response
+
+
+def make_client(payload=None):
+    """Build a QQMusic bound to a mock session whose calls return payload."""
+    session = Mock()
+    session.get.return_value = make_response(payload or {})
+    session.post.return_value = make_response(payload or {})
+    return app.QQMusic(session=session), session
+
+
+@pytest.mark.unit
+class TestBatchedVkey:
+    """Tests for QQMusic.get_music_urls."""
+
+    def test_single_request_for_all_file_types(self):
+        """All requested qualities are resolved with one CgiGetVkey call."""
+        payload = {
+            'req_1': {
+                'data': {
+                    'sip': ['http://a/', 'http://ws.stream.qqmusic.qq.com/'],
+                    'midurlinfo': [
+                        {'filename': 'M500abcabc.mp3', 'purl': 'M500abcabc.mp3?vkey=1'},
+                        {'filename': 'F000abcabc.flac', 'purl': ''},
+                        {'filename': 'M800abcabc.mp3', 'purl': 'M800abcabc.mp3?vkey=2'},
+                    ],
+                }
+            }
+        }
+        qqmusic, session = make_client(payload)
+        urls = qqmusic.get_music_urls('abc', ['128', 'flac', '320'])
+        post = session.post
+
+        assert post.call_count == 1
+        param = post.call_args.kwargs['json']['req_1']['param']
+        assert param['filename'] == ['M500abcabc.mp3', 'F000abcabc.flac', 'M800abcabc.mp3']
+        assert param['songmid'] == ['abc', 'abc', 'abc']
+        assert param['songtype'] == [0, 0, 0]
+
+        assert list(urls) == ['128', '320']
+        assert urls['320'] == {
+            'url': 'https://ws.stream.qqmusic.qq.com/M800abcabc.mp3?vkey=2',
+            'bitrate': '320kbps',
+        }
+
+    def test_falls_back_to_response_order(self):
+        """Entries without a filename are matched by position."""
+        payload = {
+            'req_1': {
+                'data': {
+                    'sip': ['', 'https://cdn/'],
+                    'midurlinfo': [{'purl': 'F000abcabc.flac?vkey=3'}],
+                }
+            }
+        }
+        qqmusic, _ = make_client(payload)
+        result = qqmusic.get_music_url('abc', 'flac')
+
+        assert result == {'url': 'https://cdn/F000abcabc.flac?vkey=3', 'bitrate': 'FLAC'}
+
+    def test_invalid_file_type(self):
+        """Unknown qualities are rejected before any request is sent."""
+        qqmusic, session = make_client()
+        with pytest.raises(ValueError):
+            qqmusic.get_music_urls('abc', ['flac', 'wav'])
+        session.post.assert_not_called()
+
+
+@pytest.mark.unit
+class TestSongBundle:
+    """Tests for the composite detail + vkey + lyric request."""
+
+    def test_song_ids_requires_both_ids(self):
+        """Only links carrying both songmid and songid are eligible."""
+        qqmusic, _ = make_client()
+        url = 'https://i.y.qq.com/v8/playsong.html?songid=102065756&songmid=001abc'
+        assert qqmusic.song_ids(url) == ('001abc', 102065756)
+        assert qqmusic.song_ids('https://y.qq.com/n/ryqq/songDetail/001abc') is None
+
+    def test_one_request_split_into_sections(self, sample_lyric_response):
+        """The composite response is split into song, lyric and music_urls."""
+        payload = {
+            'detail': {'data': {'track_info': {
+                'mid': '001abc', 'id': 42, 'name': 'Song',
+                'album': {'mid': 'alb', 'name': 'Album'},
+                'singer': [{'name': 'A'}, {'name': 'B'}],
+            }}},
+            'lyric': sample_lyric_response['music.musichallSong.PlayLyricInfo.GetPlayLyricInfo'],
+            'req_1': {'data': {
+                'sip': ['', 'https://cdn/'],
+                'midurlinfo': [{'filename': 'F000001abc001abc.flac', 'purl': 'F000001abc001abc.flac?vkey=1'}],
+            }},
+        }
+        qqmusic, session = make_client(payload)
+        output = qqmusic.get_song_bundle('001abc', 42, ['flac'])
+        post = session.post
+
+        assert post.call_count == 1
+        body = post.call_args.kwargs['json']
+        assert body['detail']['param'] == {'song_id': 42, 'song_type': 0}
+        assert body['lyric']['param']['songID'] == 42
+        assert output['song']['singer'] == 'A, B'
+        assert output['song']['pic'].endswith('M000alb.jpg?max_age=2592000')
+        assert output['lyric']['lyric'].startswith('[00:00.00]')
+        assert output['music_urls'] == {'flac': {'url': 'https://cdn/F000001abc001abc.flac?vkey=1', 'bitrate': 'FLAC'}}
+
+    def test_missing_song(self):
+        """An empty detail module maps to the existing not-found message."""
+        qqmusic, _ = make_client({'detail': {'code': 0, 'data': {}}})
+        output = qqmusic.get_song_bundle('001abc', 42, [])
+        assert output['song'] == {'msg': '信息获取错误/歌曲不存在'}
+        assert output['music_urls'] == {}
+
+
+@pytest.mark.unit
+class TestPooledSession:
+    """Tests for the shared HTTP client."""
+
+    def test_instances_share_one_session(self):
+        """Every QQMusic instance reuses the process-wide session."""
+        assert app.QQMusic().session is app.QQMusic().session is app.get_session()
+
+    def test_session_pool_and_timeouts(self):
+        """The shared session pools per host and every call carries a timeout."""
+        adapter = app.get_session().get_adapter('https://u.y.qq.com/')
+        assert adapter._pool_maxsize == app.POOL_MAXSIZE
+
+        qqmusic, session = make_client({'req_1': {'data': {}}})
+        qqmusic.get_music_urls('abc', ['128'])
+        assert session.post.call_args.kwargs['timeout'] == (app.CONNECT_TIMEOUT, app.READ_TIMEOUT)
+
+    def test_parse_cookies(self):
+        """Cookies are parsed once per string and empty strings are allowed."""
+        assert app.parse_cookies('') == {}
+        assert app.parse_cookies('uin=123; qm_keyst=a=b') == {'uin': '123', 'qm_keyst': 'a=b'}
+        assert app.parse_cookies('uin=123') is app.parse_cookies('uin=123')
+
+
+@pytest.mark.unit
+class TestUrlCache:
+    """Tests for the TTL cache of resolved play URLs."""
+
+    def test_ttl_expiry_and_lru_eviction(self):
+        """Entries expire after their TTL and the oldest entry is evicted first."""
+        cache = app.TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=-1)
+        assert cache.get('b') is None
+        cache.set('c', 3)
+        cache.get('a')
+        cache.set('d', 4)
+        assert cache.get('c') is None
+        assert cache.get('a') == 1
+        assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 2}
+
+    def test_cached_urls_skip_vkey_call(self):
+        """A second lookup is served from cache and only missing qualities are fetched."""
+        payload = {'req_1': {'data': {
+            'sip': ['', 'https://cdn/'],
+            'expiration': 80400,
+            'midurlinfo': [{'filename': 'M800abcabc.mp3', 'purl': 'M800abcabc.mp3?vkey=1'}],
+        }}}
+        qqmusic, session = make_client(payload)
+        first = qqmusic.get_music_urls('abc', ['320'])
+        second = qqmusic.get_music_urls('abc', ['320'])
+        assert first == second
+        assert session.post.call_count == 1
+
+        qqmusic.get_music_urls('abc', ['320', 'flac'])
+        assert session.post.call_args.kwargs['json']['req_1']['param']['filename'] == ['F000abcabc.flac']
+
+    def test_cache_is_keyed_by_cookie(self):
+        """Different accounts never share cached URLs."""
+        payload = {'req_1': {'data': {
+            'sip': ['', 'https://cdn/'],
+            'midurlinfo': [{'filename': 'M800abcabc.mp3', 'purl': 'M800abcabc.mp3?vkey=1'}],
+        }}}
+        qqmusic, session = make_client(payload)
+        qqmusic.get_music_urls('abc', ['320'])
+        qqmusic.set_cookies('uin=1')
+        qqmusic.get_music_urls('abc', ['320'])
+        assert session.post.call_count == 2
+
+
+@pytest.mark.unit
+class TestSongResponse:
+    """Tests for serializing and caching /song bodies."""
+
+    def test_song_body_encoders_agree(self, monkeypatch):
+        """The orjson and standard library encoders produce the same document."""
+        output = {'song': {'name': '歌曲', 'id': 1}, 'music_urls': {'320': {'url': 'u', 'size': 1000}}}
+        fast = app.dump_json(output)
+        monkeypatch.setattr(app, 'orjson', None)
+        assert json.loads(app.dump_json(output)) == json.loads(fast) == output
+
+    def test_bodies_with_errors_are_not_cached(self):
+        """A failed section keeps the body out of the cache and out of downstream caches."""
+        output = {'song': {'name': 'Song'}, 'lyric': {'error': '无法获取歌词'}, 'music_urls': {}}
+        entry = app.render_song(app.QQMusic(), 'key', output, '001abc')
+
+        assert app.song_response_cache.get('key') is None
+        assert app.song_headers(entry)['Cache-Control'] == 'no-store'
+
+
+@pytest.mark.unit
+class TestNegativeCache:
+    """Tests for remembering VIP-locked formats and missing songs."""
+
+    def test_empty_purl_is_not_requested_again(self):
+        """A format that came back empty is skipped until the entry expires."""
+        payload = {'req_1': {'data': {
+            'sip': ['', 'https://cdn/'],
+            'midurlinfo': [
+                {'filename': 'M800abcabc.mp3', 'purl': 'M800abcabc.mp3?vkey=1'},
+                {'filename': 'AI00abcabc.flac', 'purl': ''},
+            ],
+        }}}
+        qqmusic, session = make_client(payload)
+        assert list(qqmusic.get_music_urls('abc', ['320', 'master'])) == ['320']
+        assert qqmusic.get_music_urls('abc', ['320', 'master']) == qqmusic.get_music_urls('abc', ['320'])
+        assert session.post.call_count == 1
+
+    def test_missing_song_is_remembered(self):
+        """A not-found detail lookup is answered locally the next time."""
+        qqmusic, session = make_client({'code': 0, 'data': []})
+        assert qqmusic.get_music_song('abc', 0) == {'msg': '信息获取错误/歌曲不存在'}
+        assert qqmusic.get_music_song('abc', 0) == {'msg': '信息获取错误/歌曲不存在'}
+        assert session.post.call_count == 1
+
+    def test_cookie_change_invalidates(self):
+        """Switching the configured cookie clears the negative cache."""
+        qqmusic, session = make_client({'code': 0, 'data': []})
+        qqmusic.set_cookies('uin=1')
+        qqmusic.get_music_song('abc', 0)
+        qqmusic.set_cookies('uin=1')
+        assert len(app.negative_cache) == 1
+        qqmusic.set_cookies('uin=2')
+        assert len(app.negative_cache) == 0
+
+
+@pytest.mark.unit
+class TestFormatAvailability:
+    """Tests for skipping vkey probes using the detail file block."""
+
+    def test_detail_keeps_size_map(self):
+        """get_music_song keeps the per-format sizes from the file block."""
+        payload = {'data': [{
+            'mid': 'abc', 'id': 1, 'album': {}, 'singer': [],
+            'file': {'size_128mp3': 100, 'size_320mp3': 250, 'size_flac': 0, 'size_new': [0, 0]},
+        }]}
+        qqmusic, _ = make_client(payload)
+        info = qqmusic.get_music_song('abc', 0)
+        assert info['sizes'] == {'128': 100, '320': 250, 'flac': 0, 'master': 0, 'atmos_2': 0}
+
+    def test_zero_size_formats_are_not_probed(self):
+        """Only formats with a non-zero or unknown size are sent to CgiGetVkey."""
+        payload = {'req_1': {'data': {
+            'sip': ['', 'https://cdn/'],
+            'midurlinfo': [{'filename': 'M800abcabc.mp3', 'purl': 'M800abcabc.mp3?vkey=1'}],
+        }}}
+        qqmusic, session = make_client(payload)
+        urls = qqmusic.get_music_urls('abc', ['flac', '320', 'ogg_640'], {'flac': 0, '320': 250})
+
+        filenames = session.post.call_args.kwargs['json']['req_1']['param']['filename']
+        assert filenames == ['M800abcabc.mp3', 'O801abcabc.ogg']
+        assert urls['320']['size'] == 250
+
+
+@pytest.mark.unit
+class TestBulkResolution:
+    """Tests for the batched detail and vkey lookups used by /songs."""
+
+    def test_details_are_chunked(self, monkeypatch):
+        """Detail modules for many songs share one request per chunk."""
+        monkeypatch.setattr(app, 'BULK_DETAIL_CHUNK_SIZE', 2)
+        payload = {
+            'detail_0': {'data': {'track_info': {'mid': 'a', 'id': 1}}},
+            'detail_1': {'code': 0, 'data': {}},
+        }
+        qqmusic, session = make_client(payload)
+        infos = qqmusic.get_music_songs([('a', 0), ('b', 0), ('a', 0), ('c', 0)])
+
+        assert session.post.call_count == 2
+        body = session.post.call_args_list[0].kwargs['json']
+        assert body['detail_1']['param'] == {'song_mid': 'b', 'song_type': 0}
+        assert infos[('a', 0)]['id'] == 1
+        assert infos[('b', 0)] == {'msg': '信息获取错误/歌曲不存在'}
+
+    def test_vkey_pairs_span_songs(self, monkeypatch):
+        """Filename/songmid pairs from several songs are packed into shared chunks."""
+        monkeypatch.setattr(app, 'BULK_VKEY_CHUNK_SIZE', 3)
+        qqmusic, session = make_client()
+
+        def post(url, json=None, **kwargs):
+            param = json['req_1']['param']
+            infos = [{'filename': name, 'purl': f'{name}?vkey=1'} for name in param['filename']]
+            return make_response({'req_1': {'data': {'sip': ['', 'https://cdn/'], 'midurlinfo': infos}}})
+
+        session.post.side_effect = post
+        urls = qqmusic.get_music_urls_bulk(['a', 'b'], ['flac', '320'], {'a': {'flac': 0}})
+
+        assert session.post.call_count == 1
+        assert session.post.call_args.kwargs['json']['req_1']['param']['songmid'] == ['a', 'b', 'b']
+        assert list(urls['a']) == ['320']
+        assert list(urls['b']) == ['flac', '320']
+
+        session.post.reset_mock()
+        preferred = qqmusic.get_music_urls_bulk(['a', 'b'], ['flac', '320'], prefer=True)
+        assert session.post.call_count == 1
+        assert list(preferred['b']) == ['flac']
+
+
+@pytest.mark.unit
+class TestSingleFlight:
+    """Tests for coalescing concurrent identical upstream lookups."""
+
+    def test_concurrent_callers_share_one_call(self):
+        """Callers arriving while a key is in flight wait for its result."""
+        flight = app.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch(keys):
+            calls.append(list(keys))
+            started.set()
+            release.wait(5)
+            return {key: key.upper() for key in keys}
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do_many(['a', 'b'], fetch)))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(flight.do_many(['b', 'c'], fetch)))
+        follower.start()
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        assert calls == [['a', 'b'], ['c']]
+        assert {'b': 'B', 'c': 'C'} in results
+
+    def test_errors_reach_every_waiter(self):
+        """A failing leader raises in the leader and is not cached."""
+        flight = app.SingleFlight()
+        with pytest.raises(RuntimeError):
+            flight.do('k', lambda: (_ for _ in ()).throw(RuntimeError('boom')))
+        assert flight.do('k', lambda: 1) == 1
+
+    def test_music_song_is_coalesced(self):
+        """Concurrent detail lookups for the same song issue one upstream call."""
+        qqmusic, session = make_client()
+        gate = threading.Event()
+
+        def post(*args, **kwargs):
+            gate.wait(5)
+            return make_response({'data': [{'mid': 'abc', 'id': 1}]})
+
+        session.post.side_effect = post
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(qqmusic.get_music_song('abc', 0))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        gate.set()
+        for thread in threads:
+            thread.join(5)
+
+        assert session.post.call_count == 1
+        assert len(results) == 5 and all(result['id'] == 1 for result in results)
+
+
+@pytest.mark.unit
+class TestRateLimiter:
+    """Tests for the shared upstream token-bucket limiter."""
+
+    def test_burst_is_free_then_paced(self):
+        """Requests within the burst cost nothing; later ones wait for tokens."""
+        bucket = app.TokenBucket(rate=10, burst=2)
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+        assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+    def test_rate_is_split_across_workers(self):
+        """Each worker process of serve.py takes its share of the upstream limits."""
+        limiter = app.RateLimiter({'u.y.qq.com': (20, 40)}, share=0.25)
+        assert (limiter.bucket('u.y.qq.com').rate, limiter.bucket('u.y.qq.com').burst) == (5, 10)
+
+    def test_adaptive_backoff_and_recovery(self):
+        """Throttling halves the rate; successes restore it gradually."""
+        limiter = app.RateLimiter({'u.y.qq.com': (20, 5)})
+        limiter.report('u.y.qq.com', False)
+        assert limiter.bucket('u.y.qq.com').rate == 10
+        limiter.report('u.y.qq.com', True)
+        assert limiter.bucket('u.y.qq.com').rate == 11
+        assert limiter.bucket('c.y.qq.com').max_rate == app.UPSTREAM_DEFAULT_RATE[0]
+
+    def test_every_upstream_call_goes_through_limiter(self):
+        """QQMusic acquires a token per host and reports throttled responses."""
+        qqmusic, session = make_client({'data': []})
+        session.post.return_value.status_code = 429
+        qqmusic.limiter = Mock()
+        with pytest.raises(requests.RequestException):
+            qqmusic.get_music_song('abc', 0)
+
+        qqmusic.limiter.acquire.assert_called_once_with('c.y.qq.com')
+        qqmusic.limiter.report.assert_called_once_with('c.y.qq.com', False)
+
+    def test_error_codes_count_as_throttling(self):
+        """musicu.fcg throttles with HTTP 200 and a module code; the limiter and pool still back off."""
+        qqmusic, session = make_client({'code': 0, 'req_1': {'code': 2001}})
+        qqmusic.limiter = Mock()
+        qqmusic.pool = Mock()
+        with pytest.raises(app.UpstreamError):
+            qqmusic.get_music_urls('abc', ['128'])
+
+        qqmusic.limiter.report.assert_called_once_with('u.y.qq.com', False)
+        qqmusic.pool.report.assert_called_once_with(qqmusic.pool.acquire.return_value, True)
+        assert app.negative_cache.get(('url', 'abc', '128', qqmusic.cookie_id)) is None
+
+
+@pytest.mark.unit
+class TestCookiePool:
+    """Tests for the account pool."""
+
+    def make_pool(self):
+        return app.CookiePool([
+            app.Account('uin=1', vip=True),
+            app.Account('uin=2'),
+            app.Account('uin=3', weight=2),
+        ])
+
+    def test_load_from_file(self, temp_dir, json_data):
+        """Accounts are parsed once from the config file; a missing file falls back to cookie_str."""
+        path = temp_dir / 'cookies.json'
+        json_data['create_file']([{'cookie': 'uin=1; a=b', 'vip': True}, {'cookie': 'uin=2'}], path)
+        pool = app.CookiePool.from_file(str(path))
+        assert [account.cookies for account in pool.accounts] == [{'uin': '1', 'a': 'b'}, {'uin': '2'}]
+        assert [account.vip for account in pool.accounts] == [True, False]
+
+        fallback = app.CookiePool.from_file(str(temp_dir / 'missing.json'), 'uin=9')
+        assert fallback.accounts[0].cookies == {'uin': '9'}
+
+    def test_weighted_rotation_keeps_vip_for_vip_formats(self):
+        """Non-VIP calls rotate over non-VIP accounts by weight; VIP calls use VIP accounts."""
+        pool = self.make_pool()
+        picks = [pool.acquire().cookie_str for _ in range(6)]
+        assert 'uin=1' not in picks
+        assert picks.count('uin=3') == 4
+        assert pool.acquire(vip=True).cookie_str == 'uin=1'
+
+    def test_unhealthy_accounts_are_ejected(self):
+        """Accounts with a high error or empty-purl rate are skipped for a while."""
+        pool = self.make_pool()
+        vip, plain = pool.accounts[0], pool.accounts[1]
+        for _ in range(app.ACCOUNT_MIN_SAMPLES):
+            pool.report(plain, True)
+        assert pool.stats()[1]['ejected']
+        assert all(pool.acquire().cookie_str == 'uin=3' for _ in range(3))
+
+        pool.report_urls(vip, app.ACCOUNT_MIN_SAMPLES, app.ACCOUNT_MIN_SAMPLES)
+        pool.report_urls(vip, app.ACCOUNT_MIN_SAMPLES, app.ACCOUNT_MIN_SAMPLES)
+        assert pool.stats()[0]['ejected']
+
+    def test_ejecting_an_expired_vip_forgets_its_empty_results(self):
+        """Empty purls cached under the pool id are dropped, so other VIP accounts get tried."""
+        pool = self.make_pool()
+        app.negative_cache.set(('url', 'abc', 'flac', pool.id), True)
+        pool.report_urls(pool.accounts[0], app.ACCOUNT_MIN_SAMPLES, app.ACCOUNT_MIN_SAMPLES - 1)
+        assert app.negative_cache.get(('url', 'abc', 'flac', pool.id))
+
+        pool.report_urls(pool.accounts[0], app.ACCOUNT_MIN_SAMPLES, app.ACCOUNT_MIN_SAMPLES)
+        assert pool.stats()[0]['ejected']
+        assert app.negative_cache.get(('url', 'abc', 'flac', pool.id)) is None
+
+    def test_vkey_calls_use_pool_accounts(self):
+        """Without set_cookies, vkey calls for VIP formats are sent with a VIP account."""
+        payload = {'req_1': {'data': {'sip': ['', 'https://cdn/'], 'midurlinfo': [{'purl': ''}]}}}
+        session = Mock()
+        session.post.return_value = make_response(payload)
+        qqmusic = app.QQMusic(session=session)
+        qqmusic.pool = self.make_pool()
+
+        qqmusic.get_music_urls('abc', ['flac'])
+        assert session.post.call_args.kwargs['cookies'] == {'uin': '1'}
+        qqmusic.get_music_urls('abc', ['aac_48'])
+        assert session.post.call_args.kwargs['cookies'] in ({'uin': '2'}, {'uin': '3'})
+        assert qqmusic.pool.accounts[0].empty == 1
+
+
+@pytest.mark.unit
+class TestSongLinks:
+    """Tests for link parsing and the short-link cache."""
+
+    @pytest.mark.parametrize('url, expected', [
+        ('https://y.qq.com/n/ryqq/songDetail/001abc', ('001abc', 0)),
+        ('https://y.qq.com/n/ryqq/songDetail/001abc?songtype=0', ('001abc', 0)),
+        ('https://y.qq.com/n/yqq/song/001abc.html', ('001abc', 0)),
+        ('https://i.y.qq.com/v8/playsong.html?ADTAG=share&songmid=001abc&type=0', ('001abc', 0)),
+        ('https://i.y.qq.com/v8/playsong.html?songid=102065756&songmid=001abc', ('001abc', 102065756)),
+        ('https://y.qq.com/portal/player.html#songid=102065756', ('', 102065756)),
+        ('https://i.y.qq.com/n2/m/share/details/taoge.html?id=102065756', None),
+        ('https://y.qq.com/w/song.html#/songDetail/001abc', ('001abc', 0)),
+        ('https://example.com/songDetail/001abc', None),
+        ('https://y.qq.com/', None),
+    ])
+    def test_parse_song_url(self, url, expected):
+        """Known link shapes parse without any network request."""
+        assert app.parse_song_url(url) == expected
+
+    @pytest.mark.parametrize('url, expected', [
+        ('https://y.qq.com/n/ryqq/albumDetail/002fRO0N4FftzY', ('album', '002fRO0N4FftzY')),
+        ('https://y.qq.com/n/yqq/album/002fRO0N4FftzY.html', ('album', '002fRO0N4FftzY')),
+        ('https://i.y.qq.com/n2/m/share/details/album.html?ADTAG=share&albummid=002fRO0N4FftzY', ('album', '002fRO0N4FftzY')),
+        ('https://i.y.qq.com/n2/m/share/details/album.html?albumId=8220', ('album', '8220')),
+        ('https://y.qq.com/n/ryqq/playlist/7256912512', ('playlist', '7256912512')),
+        ('https://i.y.qq.com/n2/m/share/details/taoge.html?platform=11&id=7256912512', ('playlist', '7256912512')),
+        ('https://y.qq.com/n/ryqq/songDetail/001abc', None),
+        ('https://example.com/n/ryqq/playlist/7256912512', None),
+    ])
+    def test_parse_collection_url(self, url, expected):
+        assert app.parse_collection_url(url) == expected
+
+    def test_short_link_resolved_once(self):
+        """A share link is fetched once and served from the cache afterwards."""
+        qqmusic, session = make_client()
+        session.get.return_value.headers = {'Location': 'https://i.y.qq.com/v8/playsong.html?songmid=001abc'}
+        url = 'https://c6.y.qq.com/base/fcgi-bin/u?__=abc'
+
+        assert qqmusic.ids(url) == '001abc'
+        assert qqmusic.ids(url) == '001abc'
+        assert session.get.call_count == 1
+        assert app.short_link_cache.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+    def test_link_cache_persists_with_lru_eviction(self, temp_dir):
+        """Entries survive a reload and the oldest entries are evicted first."""
+        path = str(temp_dir / 'links.json')
+        cache = app.LinkCache(path, maxsize=2, save_every=10)
+        cache.set('a', '1')
+        cache.set('b', '2')
+        cache.get('a')
+        cache.set('c', '3')
+        cache.save()
+
+        reloaded = app.LinkCache(path, maxsize=2)
+        assert reloaded.get('b') is None
+        assert (reloaded.get('a'), reloaded.get('c')) == ('1', '3')
+
+
+@pytest.mark.unit
+class TestMetadataStore:
+    """Tests for the persistent song info and lyric store."""
+
+    def test_lookup_by_either_id(self, temp_dir):
+        """Songs and lyrics are found by mid or id and survive reopening the file."""
+        path = str(temp_dir / 'metadata.db')
+        store = app.MetadataStore(path)
+        store.put_song({'mid': '001abc', 'id': 42, 'name': 'Song', 'sizes': {'320': 250}})
+        store.put_lyric(42, {'lyric': '[00:00.00]歌词', 'tylyric': ''})
+
+        reopened = app.MetadataStore(path)
+        assert reopened.get_song(mid='001abc')['id'] == 42
+        assert reopened.get_song(sid=42)['sizes'] == {'320': 250}
+        assert reopened.get_lyric(mid='001abc') == {'lyric': '[00:00.00]歌词', 'tylyric': ''}
+        assert reopened.get_song(mid='002def') is None
+
+    def test_stale_entries_are_ignored(self, temp_dir):
+        """Entries older than max_age are treated as missing."""
+        store = app.MetadataStore(str(temp_dir / 'metadata.db'), max_age=0)
+        store.put_song({'mid': '001abc', 'id': 42})
+        store.put_lyric(42, {'lyric': '', 'tylyric': ''})
+        assert store.get_song(sid=42) is None
+        assert store.get_lyric(sid=42) is None
+
+    def test_errors_are_not_stored(self, temp_dir):
+        store = app.MetadataStore(str(temp_dir / 'metadata.db'))
+        store.put_song({'msg': '信息获取错误/歌曲不存在'})
+        store.put_lyric(42, {'error': '无法获取歌词'})
+        assert store.stats() == {'songs': 0, 'lyrics': 0}
+
+    def test_client_reads_through_store(self, sample_lyric_response):
+        """A new client with cold in-memory caches makes no metadata requests."""
+        song = {'data': [{'mid': '001abc', 'id': 42, 'name': 'Song', 'album': {}, 'singer': []}]}
+        qqmusic, session = make_client(song)
+        qqmusic.get_music_song('001abc', 0)
+        session.post.return_value = make_response(sample_lyric_response)
+        qqmusic.get_music_lyric_new(42)
+        assert session.post.call_count == 2
+
+        restarted, fresh_session = make_client()
+        assert restarted.get_music_song('', 42)['mid'] == '001abc'
+        assert restarted.get_music_lyric_new(42)['lyric'].startswith('[00:00.00]')
+        fresh_session.post.assert_not_called()
+
+
+@pytest.mark.unit
+class TestCacheWarmer:
+    """Tests for the refresh-ahead warmer."""
+
+    def test_hot_ranking_decays(self):
+        warmer = app.CacheWarmer(top_n=1)
+        warmer.track('a', ['320'])
+        for _ in range(3):
+            warmer.track('b', ['flac', '320'])
+        assert warmer.hot() == [('b', ['flac', '320'])]
+
+        warmer._decay()
+        warmer._decay()
+        assert 'a' not in warmer.scores
+        assert warmer.scores['b'] == 0.75
+
+    def test_refreshes_only_entries_close_to_expiry(self):
+        """Hot URLs about to expire are re-fetched in one batched request; fresh ones are left alone."""
+        def post(url, json=None, **kwargs):
+            names = json['req_1']['param']['filename']
+            infos = [{'filename': name, 'purl': f'{name}?vkey=2'} for name in names]
+            return make_response({'req_1': {'data': {'sip': ['', 'https://cdn/'], 'midurlinfo': infos}}})
+
+        qqmusic, session = make_client()
+        session.post.side_effect = post
+        qqmusic.store = None
+        cid = qqmusic.cookie_id
+        qqmusic.url_cache.set(('001abc', '320', cid), {'url': 'old', 'bitrate': '320kbps'}, 10)
+        qqmusic.url_cache.set(('002def', '320', cid), {'url': 'old', 'bitrate': '320kbps'}, 1000)
+        warmer = app.CacheWarmer(ahead=60)
+        warmer.track('001abc', ['320'])
+        warmer.track('002def', ['320'])
+
+        assert warmer.run_once(qqmusic) == {'urls': 1, 'songs': 0}
+        assert session.post.call_count == 1
+        assert session.post.call_args.kwargs['json']['req_1']['param']['songmid'] == ['001abc']
+        assert qqmusic.url_cache.get(('001abc', '320', cid))['url'].endswith('?vkey=2')
+        assert qqmusic.url_cache.get(('002def', '320', cid))['url'] == 'old'
+
+    def test_refreshes_missing_song_details(self):
+        qqmusic, session = make_client({'detail_0': {'data': {'track_info': {'mid': '001abc', 'id': 42}}}})
+        warmer = app.CacheWarmer()
+        warmer.track('001abc', [])
+
+        assert warmer.run_once(qqmusic) == {'urls': 0, 'songs': 1}
+        assert qqmusic.store.get_song('001abc')['id'] == 42
+        assert warmer.run_once(qqmusic) == {'urls': 0, 'songs': 0}
+
+
+@pytest.mark.unit
+class TestMetrics:
+    """Tests for the Prometheus metrics registry."""
+
+    def test_render_counters_and_histograms(self):
+        metrics = app.Metrics(buckets=(0.1, 1))
+        metrics.inc('qqmusic_vkey_empty_total', (('file_type', 'flac'),))
+        metrics.inc('qqmusic_vkey_empty_total', (('file_type', 'flac'),))
+        metrics.observe('qqmusic_upstream_duration_seconds', (('op', 'vkey'),), 0.05)
+        metrics.observe('qqmusic_upstream_duration_seconds', (('op', 'vkey'),), 0.5)
+        text = metrics.render([('qqmusic_upstream_rate', (('host', 'u.y.qq.com'),), 20)])
+
+        assert '# TYPE qqmusic_vkey_empty_total counter' in text
+        assert 'qqmusic_vkey_empty_total{file_type="flac"} 2' in text
+        assert 'qqmusic_upstream_duration_seconds_bucket{op="vkey",le="0.1"} 1' in text
+        assert 'qqmusic_upstream_duration_seconds_bucket{op="vkey",le="1"} 2' in text
+        assert 'qqmusic_upstream_duration_seconds_bucket{op="vkey",le="+Inf"} 2' in text
+        assert 'qqmusic_upstream_duration_seconds_count{op="vkey"} 2' in text
+        assert 'qqmusic_upstream_rate{host="u.y.qq.com"} 20' in text
+
+    def test_label_values_are_escaped(self):
+        metrics = app.Metrics()
+        metrics.inc('x_total', (('path', 'a"b\\c\n'),))
+        assert 'x_total{path="a\\"b\\\\c\\n"} 1' in metrics.render()
+
+
+@pytest.mark.unit
+class TestTrace:
+    """Tests for the per-request span recorder."""
+
+    def test_spans_nest_under_the_current_span(self):
+        root, token = app.start_trace()
+        with app.trace_span('detail'):
+            with app.trace_span('upstream.detail'):
+                pass
+        with app.trace_span('urls'):
+            with app.trace_span('upstream.vkey'):
+                pass
+            with app.trace_span('upstream.vkey'):
+                pass
+        app.end_trace(root, token)
+
+        tree = app.trace_tree(root)
+        assert [child['name'] for child in tree['children']] == ['detail', 'urls']
+        assert [child['name'] for child in tree['children'][1]['children']] == ['upstream.vkey', 'upstream.vkey']
+        header = app.server_timing(root)
+        assert header.split(', ')[0].startswith('detail;dur=')
+        assert 'upstream.vkey;dur=' in header and 'upstream.vkey-2;dur=' in header
+        assert header.split(', ')[-1].startswith('total;dur=')
+
+    def test_no_trace_outside_a_request(self):
+        """Background work such as the warmer records nothing."""
+        with app.trace_span('detail') as span:
+            assert span is None
+        assert app._current_span.get() is None
@@ -0,0 +1,77 @@
+"""
+Unit tests for the serve.py configuration loader.
+"""
+
+import json
+
+import pytest
+
+import serve
+
+
+@pytest.mark.unit
+class TestLoadConfig:
+    """Tests for merging defaults, the config file, the environment and arguments."""
+
+    def test_precedence(self, tmp_path):
+        path = tmp_path / 'serve.json'
+        path.write_text(json.dumps({'port': 6000, 'workers': 3, 'threads': 8, 'async': True}))
+        config, _ = serve.load_config(str(path), environ={'QQMUSIC_WORKERS': '5'}, overrides={'threads': 12})
+
+        assert config['port'] == 6000
+        assert config['workers'] == 5
+        assert config['threads'] == 12
+        assert config['async'] is True
+        assert config['host'] == serve.DEFAULTS['host']
+
+    def test_app_settings_are_passed_as_environment(self, tmp_path):
+        path = tmp_path / 'serve.json'
+        path.write_text(json.dumps({'workers': 4, 'cookie': 'uin=1; qm_keyst=abc', 'warmer': False, 'cache': 'redis://r:6379/0'}))
+        _, app_env = serve.load_config(str(path), environ={'QQMUSIC_CACHE': 'memory'})
+
+        assert app_env == {'QQMUSIC_COOKIE': 'uin=1; qm_keyst=abc', 'QQMUSIC_WARMER': '0', 'QQMUSIC_WORKERS': '4'}
+
+    def test_config_file_from_environment(self, tmp_path):
+        path = tmp_path / 'serve.json'
+        path.write_text(json.dumps({'max_requests': 1000}))
+        config, _ = serve.load_config(environ={'QQMUSIC_CONFIG': str(path)})
+        assert config['max_requests'] == 1000
+
+    @pytest.mark.parametrize('data', [{'port': 1, 'prot': 2}, {'workers': 0}])
+    def test_invalid_config(self, tmp_path, data):
+        path = tmp_path / 'serve.json'
+        path.write_text(json.dumps(data))
+        with pytest.raises(ValueError):
+            serve.load_config(str(path), environ={})
+
+
+@pytest.mark.unit
+class TestRespawnBackoff:
+    """Tests for how the master paces workers that die while booting."""
+
+    def test_delay_doubles_and_the_master_gives_up(self):
+        master = serve.Master(dict(serve.DEFAULTS), worker=lambda sock, config: None)
+        delays = []
+        for _ in range(serve.BOOT_FAILURE_LIMIT - 1):
+            master._boot_failed()
+            delays.append(master._delay)
+
+        assert delays == [serve.RESPAWN_DELAY * 2 ** i for i in range(serve.BOOT_FAILURE_LIMIT - 1)]
+        assert not master._stopping
+        master._boot_failed()
+        assert master._stopping
+        assert master.exit_code == serve.WORKER_BOOT_ERROR
+
+    def test_a_booted_worker_resets_the_backoff(self):
+        master = serve.Master(dict(serve.DEFAULTS), worker=lambda sock, config: None)
+        master._boot_failed()
+        master._boot_failed()
+        master._failed_at -= serve.WORKER_BOOT_TIME * 2
+        master.workers[1] = master._failed_at - 1  # up for long, but started before the failure
+        master._check_booted()
+        assert master._failures == 2
+
+        master.workers[2] = master._failed_at + 1  # started after the failure and survived booting
+        master._check_booted()
+        assert master._failures == 0
+        assert master._delay == 0